@@ -3,8 +3,10 @@
 # Copyright (C) 2009 Paul Kölle
 # All rights reserved.
 
+from config import Option, BoolOption, IntOption, FloatOption
 from core import implements, Component, ExtensionPoint, SysTracError
 from interfaces import ISystemModule, IBaseModule
+from jsonenc import constant_response
 import cherrypy as cp
 
 #setup the set_content_type Tool before loading any pagehandlers
@@ -42,15 +44,74 @@ class SystemBaseModule(Component):
 
     @cp.expose
     @cp.tools.set_content_type()
+    @constant_response
     def index(self, *args, **kwargs):
         subpaths = [c.get_path() for c in self.children]
         return self.json.dumps({"children": subpaths})
 
         
-#fixme, use one of the cherrypy dispatchers
 class Dispatcher(Component):
     children = ExtensionPoint(IBaseModule)
 
+    request_dispatcher = Option('systrac', 'request_dispatcher', 'compiled',
+        """`compiled` routes requests through a table built from the
+        component tree on the first request (see lib/routing.py), `objects`
+        uses cherrypy's default object traversal.""")
+
+    autoscale = BoolOption('server', 'autoscale', 'false',
+        """Grow and shrink the HTTP server's worker threads with the load
+        (see lib/poolctl.py). Without it cherrypy's fixed pool of 10
+        threads serves all requests. Off by default: it cuts the latency of
+        fast requests queued behind slow ones, but the extra threads compete
+        for the CPU, which made service scripts slower in the load test.""")
+
+    min_threads = IntOption('server', 'min_threads', 4,
+        """Worker threads started and kept at least when autoscaling.""")
+
+    max_threads = IntOption('server', 'max_threads', 40,
+        """Upper bound for the number of worker threads.""")
+
+    spare_threads = IntOption('server', 'spare_threads', 2,
+        """Idle threads kept ready for new connections.""")
+
+    slow_request = FloatOption('server', 'slow_request', 1.0,
+        """Seconds; while the p99 request latency is above this the pool
+        grows twice as fast.""")
+
+    shrink_delay = FloatOption('server', 'shrink_delay', 10,
+        """Seconds of surplus idle threads before half of them are
+        stopped.""")
+
+    reactor = BoolOption('server', 'reactor', 'false',
+        """Wait for requests on idle keep-alive connections in an epoll
+        loop instead of a worker thread each (see lib/reactor.py). Only
+        used where epoll is available and without SSL. Off by default
+        until it has seen more use.""")
+
+    instrument = BoolOption('server', 'instrument', 'true',
+        """Record latency histograms and /proc reads, forks and munin
+        round trips per route, served at /monitoring/self.""")
+
+    keepalive_timeout = IntOption('server', 'keepalive_timeout', 60,
+        """Seconds an idle keep-alive connection is kept open by the epoll
+        loop.""")
+
+    cache = BoolOption('cache', 'enabled', 'true',
+        """Answer repeated requests for routes with a TTL from a response
+        cache (see lib/respcache.py). TTLs are set per route as
+        `ttl.<route> = seconds` in this section.""")
+
+    cache_default_ttl = IntOption('cache', 'default_ttl', 0,
+        """Seconds responses of routes without a `ttl.<route>` are cached,
+        `0` caches only the configured routes.""")
+
+    cache_shards = IntOption('cache', 'shards', 16,
+        """Number of separately locked parts of the cache.""")
+
+    cache_max_entries = IntOption('cache', 'max_entries', 1000,
+        """Responses kept at most; those closest to expiry are dropped
+        first.""")
+
     def __init__(self, *args):
         # add IBaseModuleProviders as direct pagehandlers
         #self.log.debug(" Providers: %s" % self.children)
@@ -62,13 +123,61 @@ class Dispatcher(Component):
             print "Adding provider %s for path /%s" % (provider.__class__.__name__, path)
             setattr(self, path, provider)
             self.subpaths.append(path)
+        self.pool_controller = None
+        self.response_cache = None
 
 
     def __call__(self, host, port):
         cp.server.socket_host = host
         cp.server.socket_port = port
-        cp.quickstart(self)
+        if self.autoscale:
+            cp.server.thread_pool = self.min_threads
+        if self.reactor and not cp.server.ssl_certificate:
+            import reactor
+            if reactor.available:
+                cp.server.instance = reactor.ReactorWSGIServer(
+                                                    self.keepalive_timeout)
+        config = self.app_config()
+        if self.autoscale:
+            from poolctl import PoolController
+            self.pool_controller = PoolController(cp.engine,
+                self.min_threads, self.max_threads, self.spare_threads,
+                self.slow_request, self.shrink_delay)
+            self.pool_controller.subscribe()
+            config['/'].update(self.pool_controller.config())
+        cp.quickstart(self, config=config)
+
+    def app_config(self):
+        """The application config: request dispatcher, instrumentation and
+        response cache."""
+        config = {'/': {}}
+        if self.request_dispatcher == 'compiled':
+            from routing import RoutingDispatcher
+            config['/']['request.dispatch'] = RoutingDispatcher()
+        if self.instrument:
+            import instrument
+            instrument.install()
+            config['/']['tools.instrument.on'] = True
+        if self.cache:
+            from respcache import ResponseCache
+            self.response_cache = ResponseCache(self._cache_ttls(),
+                self.cache_default_ttl, self.cache_shards,
+                self.cache_max_entries)
+            config['/'].update(self.response_cache.config())
+        return config
+
+    def _cache_ttls(self):
+        ttls = {}
+        for name, value in self.config.options('cache'):
+            if name.startswith('ttl.'):
+                try:
+                    ttls[name[4:].rstrip('/') or '/'] = float(value)
+                except ValueError:
+                    self.log.warn("Ignoring [cache] %s = %r" % (name,
+                                                                 value))
+        return ttls
 
     @cp.expose
+    @constant_response
     def index(self, *args, **kwargs):
         return self.json.dumps({"children": self.subpaths})
\ No newline at end of file
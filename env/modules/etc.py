@@ -5,13 +5,15 @@
 
 import os
 from os.path import join as joinpath
-from subprocess import Popen, PIPE
 
 from config import Option
 from core import implements, Component, ExtensionPoint, SysTracError
 import cherrypy as cp
 
 from interfaces import IConfigModule, IBaseModule
+from jobs import JobModule
+from jsonenc import constant_response
+from util.jsonstream import iterencode
         
 class ConfigBaseModule(Component):
     implements(IBaseModule)
@@ -36,6 +38,7 @@ class ConfigBaseModule(Component):
 
     @cp.expose
     @cp.tools.set_content_type()
+    @constant_response
     def index(self, *args, **kwargs):
         subpaths = [c.get_path() for c in self.children]
         return self.json.dumps({"children": subpaths})
@@ -60,6 +63,7 @@ class MuninConfig(Component):
     
     @cp.expose
     @cp.tools.set_content_type()
+    @constant_response
     def index(self):
         return self.json.dumps(
             {'methods':['plugins', 'plugin', 'disable']})
@@ -70,7 +74,9 @@ class MuninConfig(Component):
     def plugins(self):
         enabled = os.listdir(self.enabled_plugindir)
         all = os.listdir(self.all_plugindir)
-        return self.json.dumps({'all': all, 'enabled': enabled})
+        cp.response.stream = True
+        return iterencode({'all': iter(all), 'enabled': iter(enabled)},
+                          self.json)
         
     @cp.expose
     @cp.tools.set_content_type()
@@ -140,10 +146,9 @@ class MuninConfig(Component):
         src = joinpath(self.enabled_plugindir, name)
         
         if os.path.isfile(src):
-            p =Popen(src, shell=True, stdout=PIPE)
-            p.wait()
-            return self.json.dumps(dict([l.split() 
-                    for l in p.stdout.readlines()]))
+            jobs = self.env[JobModule]
+            return jobs.respond(jobs.submit([src], 'munin', lambda job:
+                dict([l.split() for l in job.stdout.splitlines()])))
         else:
             return self.json.dumps({'errors': ['plugin %s not found' % name]})
             
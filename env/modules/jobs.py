@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+import cherrypy as cp
+
+from config import IntOption, FloatOption, ListOption
+from core import implements, Component, SysTracError
+from execution import CommandPool, Job, QueueFull, DONE, REJECTED
+from instrument import count
+from interfaces import ISystemModule
+from jsonenc import constant_response
+
+
+class JobModule(Component):
+    """Central execution service for external commands.
+
+    Other components hand their commands to `submit()` or `execute()`
+    instead of calling Popen themselves. `respond()` waits `sync_wait`
+    seconds for a job; if it takes longer the request returns 202 with the
+    job URL (/system/jobs/info/<id>) instead of pinning a server thread.
+    With `max_queue` commands waiting, new ones are rejected and answered
+    with 503 and a Retry-After header.
+
+    The `parse` function passed with a command turns the finished job into
+    the data the request answers with; it is stored as the job's `result`
+    so /system/jobs/info can return it later.
+    """
+    implements(ISystemModule)
+
+    workers = IntOption('jobs', 'workers', 4,
+        """Number of threads running commands.""")
+
+    limits = ListOption('jobs', 'limits', 'apt:1, service:2, status:4, munin:2, pcp:2',
+        doc="""Maximum number of concurrently running commands per class,
+        as a list of `class:count` pairs.""")
+
+    timeout = FloatOption('jobs', 'timeout', 120,
+        """Seconds a command may run before it is killed.""")
+
+    max_output = IntOption('jobs', 'max_output', 4 * 1024 * 1024,
+        """Bytes of stdout and stderr kept per command.""")
+
+    max_queue = IntOption('jobs', 'max_queue', 100,
+        """Maximum number of commands waiting for a worker.""")
+
+    keep = IntOption('jobs', 'keep', 600,
+        """Seconds finished jobs can be retrieved.""")
+
+    sync_wait = FloatOption('jobs', 'sync_wait', 5,
+        """Seconds a request waits for its command before answering with
+        202 and the job URL.""")
+
+    wait_grace = FloatOption('jobs', 'wait_grace', 30,
+        """Seconds `execute()` waits for a command beyond its timeout (time
+        spent in the queue, killing it) before giving up.""")
+
+    def __init__(self):
+        limits = {}
+        for item in self.limits:
+            cls, sep, count = item.partition(':')
+            if sep:
+                limits[cls.strip()] = int(count)
+        self.pool = CommandPool(self.workers, limits, self.max_queue,
+                                self.max_output, self.keep)
+        cp.engine.subscribe('stop', self.pool.stop)
+
+    @classmethod
+    def supported_plattform(cls, p, f, r):
+      """check plattform, flavour, release"""
+      return True
+
+    def description(self):
+        return "Asynchronous command execution"
+
+    def get_path(self):
+        return 'jobs'
+
+    def submit(self, argv, cls, parse=None, timeout=None):
+        """Queue `argv` and return the `Job`, see `execution.Job`. If the
+        queue is full the job is returned rejected."""
+        job = Job(argv, cls, timeout or self.timeout, parse)
+        try:
+            self.pool.submit(job)
+        except QueueFull, e:
+            job.reject(str(e))
+            return job
+        count('forks')
+        return job
+
+    def execute(self, argv, cls, parse=None, timeout=None):
+        """Run `argv` on the pool and wait for it, return the `Job`. Raises
+        SysTracError if it hasn't finished `wait_grace` seconds after its
+        timeout."""
+        job = self.submit(argv, cls, parse, timeout)
+        if not job.wait(job.timeout + self.wait_grace):
+            raise SysTracError('%s did not finish within %s seconds (%s)' % (
+                               argv[0], job.timeout + self.wait_grace,
+                               job.state))
+        return job
+
+    def render(self, job):
+        """Return the encoded answer for a finished `job`."""
+        if job.state != DONE:
+            return self.json.envelope([], -1, [job.error])
+        if job.parse is None:
+            return self.json.envelope([job.stdout], job.returncode,
+                                      [job.stderr])
+        return self.json.dumps(job.result)
+
+    def respond(self, job):
+        """Return `render(job)` if `job` finishes within `sync_wait`
+        seconds, otherwise set the response status to 202 and return the
+        job URL. Rejected jobs are answered with 503."""
+        if job.state == REJECTED:
+            cp.response.status = 503
+            cp.response.headers['Retry-After'] = str(max(1,
+                                                         int(self.sync_wait)))
+            return self.json.envelope([], 503, [job.error])
+        if job.wait(self.sync_wait):
+            return self.render(job)
+        url = cp.url('/system/jobs/info/%s' % job.id)
+        cp.response.status = 202
+        cp.response.headers['Location'] = url
+        return self.json.envelope([{'job': job.id, 'url': url,
+                                    'state': job.state}], 202)
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def info(self, job_id):
+        """State and output of a job; with the job done, `result` holds
+        what the original request would have returned."""
+        job = self.pool.get(job_id)
+        if job is None:
+            return self.json.dumps({'status':404, 'errors':['JOB_NOT_FOUND']})
+        return self.json.envelope([job.as_dict()], 0, job.error and
+                                  [job.error] or [])
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def list(self):
+        jobs = [{'id': job.id, 'argv': job.argv, 'class': job.cls,
+                 'state': job.state, 'created': job.created}
+                for job in self.pool.jobs()]
+        return self.json.envelope([{'jobs': jobs,
+                                    'pool': self.pool.stats()}])
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    @constant_response
+    def index(self):
+        return self.json.dumps(
+            {'methods':['list', 'info(job_id)'],
+             'desc': "asynchronous command execution"})
@@ -4,20 +4,210 @@
 # All rights reserved.
 
 import sys, os, time
-import telnetlib
+import select, socket, threading
+from collections import OrderedDict
 from os.path import join as joinpath
+from Queue import Queue
 import cherrypy as cp
 
 from subprocess import Popen, PIPE
 from core import implements, Component, ExtensionPoint, SysTracError
 from config import Option, IntOption, ListOption
 
+import instrument
+from base import Dispatcher
 from interfaces import IMonitoringModule, IBaseModule
+from jsonenc import constant_response
+
+
+class _Flight(object):
+    """A load in progress that other callers wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class MetricsCache(object):
+    """Size bounded LRU cache with per-entry TTLs and stale-while-revalidate.
+
+    `get(key, loader, ttl)` returns the cached value while it is younger
+    than `ttl` seconds. An expired value is still returned for up to
+    `max_stale` more seconds while a single background thread reloads
+    it; older entries (and misses) are loaded synchronously, once: callers
+    asking for a key that is being loaded wait for that load. At most
+    `size` entries are kept, the least recently used are evicted first.
+
+    Values are {'status', 'response', 'errors'} dicts; those with a
+    non-zero status are returned but not stored, and a failed refresh
+    keeps the previous value until it is too stale.
+    """
+
+    def __init__(self, size=128, max_stale=600, log=None):
+        self.size = size
+        self.max_stale = max_stale
+        self.log = log
+        self._data = OrderedDict() # key -> [value, loaded_at, ttl, loading]
+        self._inflight = {}        # key -> _Flight
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._worker = None
+        self.stats = dict.fromkeys(('hits', 'stale_hits', 'misses', 'joined',
+                                    'refreshes', 'errors', 'evictions'), 0)
+
+    def get(self, key, loader, ttl):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._data[key] = entry # most recently used goes last
+                age = now - entry[1]
+                if age < entry[2]:
+                    self.stats['hits'] += 1
+                    return entry[0]
+                if age < entry[2] + self.max_stale:
+                    self.stats['stale_hits'] += 1
+                    if not entry[3]:
+                        entry[3] = True
+                        self._refresh(key, loader, ttl)
+                    return entry[0]
+            flight = self._inflight.get(key)
+            if flight is None:
+                self.stats['misses'] += 1
+                self._inflight[key] = leader = _Flight()
+            else:
+                self.stats['joined'] += 1
+                leader = None
+        finally:
+            self._lock.release()
+        if leader is None:
+            return flight.wait()
+        try:
+            value = loader()
+        except Exception:
+            self._land(key, leader, exc_info=sys.exc_info())
+            raise
+        if self._valid(value):
+            self.set(key, value, ttl)
+        self._land(key, leader, value)
+        return value
+
+    def _land(self, key, flight, value=None, exc_info=None):
+        """Finish the load of `key` and wake up its waiters."""
+        self._lock.acquire()
+        try:
+            del self._inflight[key]
+        finally:
+            self._lock.release()
+        flight.value = value
+        flight.exc_info = exc_info
+        flight.event.set()
+
+    def _valid(self, value):
+        return not (isinstance(value, dict) and value.get('status'))
+
+    def set(self, key, value, ttl):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = [value, time.time(), ttl, False]
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def info(self):
+        """Return the counters plus the current and maximum size."""
+        self._lock.acquire()
+        try:
+            res = dict(self.stats)
+            res.update({'size': len(self._data), 'max_size': self.size})
+        finally:
+            self._lock.release()
+        return res
+
+    def _refresh(self, key, loader, ttl):
+        # called with self._lock held
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run,
+                                            name='MetricsCache')
+            self._worker.setDaemon(True)
+            self._worker.start()
+        self._queue.put((key, loader, ttl))
+
+    def _run(self):
+        while True:
+            key, loader, ttl = self._queue.get()
+            try:
+                value = loader()
+                if not self._valid(value):
+                    raise SysTracError("%r" % (value.get('errors'),))
+            except Exception:
+                # keep serving the previous value until it is too stale
+                self._lock.acquire()
+                try:
+                    self.stats['errors'] += 1
+                    entry = self._data.get(key)
+                    if entry is not None:
+                        entry[3] = False
+                finally:
+                    self._lock.release()
+                if self.log:
+                    self.log.warn("Refreshing %r failed" % (key,),
+                                  exc_info=True)
+                continue
+            self.set(key, value, ttl)
+            self._lock.acquire()
+            self.stats['refreshes'] += 1
+            self._lock.release()
+
+
+def _merge(results):
+    """Merge the {'status', 'response', 'errors'} dicts of several
+    children into one, the last non-zero status wins."""
+    res = {'status':0, 'response':[], 'errors':[]}
+    for r in results:
+        if not r:
+            continue
+        res['response'].extend(r['response'])
+        res['errors'].extend(r['errors'])
+        if r['status']:
+            res['status'] = r['status']
+    return res
+
 
 class MonitoringBaseModule(Component):
     implements(IBaseModule)
 
     children = ExtensionPoint(IMonitoringModule)
+
+    cache_ttl = IntOption('monitoring', 'cache_ttl', 60,
+        """Seconds a child's metric listing is served from the cache.
+        Can be overridden per child with `ttl.<ClassName>`, `0` disables
+        caching.""")
+
+    cache_max_stale = IntOption('monitoring', 'cache_max_stale', 600,
+        """Seconds an expired listing may still be served while it is
+        refreshed in the background.""")
+
+    cache_size = IntOption('monitoring', 'cache_size', 128,
+        """Maximum number of cached listings.""")
     
     @classmethod
     def supported_plattform(cls, p, f, r):
@@ -26,16 +216,19 @@ class MonitoringBaseModule(Component):
         
     def __init__(self):
         self.log.debug("IMonitoringModule Providers: %s" % self.children)
-        self._cached_metrics = {}
+        self.metrics_cache = MetricsCache(self.cache_size,
+                                          self.cache_max_stale, self.log)
 
     def get_path(self):
         return 'monitoring'
 
     @cp.expose
     @cp.tools.set_content_type()
+    @constant_response
     def index(self):
         return self.json.dumps(
-            {'methods':['metrics', 'values(*metrics)'],
+            {'methods':['metrics(NS)', 'values(*metrics, m=[...])', 'cache',
+                        'self(reset)'],
              'desc': "monitoring info"})
 
     def default(self, *args, **kwargs):
@@ -44,32 +237,245 @@ class MonitoringBaseModule(Component):
     #IMonitoringModule methods
     @cp.expose
     @cp.tools.set_content_type()
-    def metrics(self):
-        res = []
-        for child in self.children:
-            r = child.metrics()
-            if r:
-                self._cached_metrics[child] = r
-                res.extend(r)
+    def metrics(self, NS='.'):
+        return self.json.dumps(_merge([self._child_metrics(child, NS)
+                                       for child in self.children]))
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def cache(self):
+        """Hit/miss counters of the metrics cache."""
+        return self.json.dumps(self.metrics_cache.info())
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def instrumentation(self, reset=None):
+        """Latency histograms and /proc reads, forks and munin round
+        trips per route of the agent itself, see lib/instrument.py. Served
+        as /monitoring/self; `reset=1` starts over after answering."""
+        res = instrument.snapshot()
+        if reset:
+            instrument.reset()
         return self.json.dumps(res)
+
+    def _child_metrics(self, child, NS):
+        name = child.__class__.__name__
+        ttl = self.config.getint('monitoring', 'ttl.' + name, self.cache_ttl)
+        if ttl <= 0:
+            return child.metrics(NS)
+        return self.metrics_cache.get((name, 'metrics', NS),
+                                      lambda: child.metrics(NS), ttl)
         
     @cp.expose
     @cp.tools.set_content_type()
-    def values(self, *metrics):
-        res =[]
-        if self._cached_metrics:
-            for child,metrics in self._cached_children.items():
-                res.extend(child.metrics(*metrics))
-            return self.json.dumps(res)
-
-        for child in self.children:
-            res.extend(child.values( *metrics))
+    def values(self, *metrics, **kwargs):
+        """Values for the metrics given as path segments and/or as
+        repeated `m` arguments (`/monitoring/values?m=cpu&m=load`)."""
+        m = kwargs.get('m', [])
+        if isinstance(m, basestring):
+            m = [m]
+        metrics = list(metrics) + list(m)
+        routes, unknown = self._route(metrics)
+        res = _merge([child.values(*names) for child, names in routes])
+        res['errors'].extend(['unknown metric %s' % m for m in unknown])
         return self.json.dumps(res)
+
+    def _route(self, metrics):
+        """Split `metrics` among the children providing them. A metric no
+        child claims goes to the children that can't tell (their backend
+        is down, so the error is reported), else it is unknown. Returns
+        [(child, [metric, ...]), ...] and the unknown metrics."""
+        children = list(self.children)
+        routes = dict([(child, []) for child in children])
+        down = set()    # children which couldn't tell, not asked again
+        unknown = []
+        for metric in metrics:
+            answers = []
+            for child in children:
+                answer = None
+                if child not in down:
+                    answer = child.provides(metric)
+                    if answer is None:
+                        down.add(child)
+                answers.append((child, answer))
+            owners = [c for c, a in answers if a] or \
+                     [c for c, a in answers if a is None]
+            if not owners:
+                unknown.append(metric)
+            for child in owners:
+                routes[child].append(metric)
+        return [(c, routes[c]) for c in children if routes[c]], unknown
         
+# /monitoring/self
+MonitoringBaseModule.self = MonitoringBaseModule.__dict__['instrumentation']
+
+class MuninConnection(object):
+    """A single connection to munin-node speaking the text protocol.
+
+    The banner is read once on connect; replies are framed on the
+    protocol itself (a single line for `list`, `version` and `cap`, a
+    line containing only "." for everything else) instead of waiting for
+    the socket to drain.
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.banner = self._readline()
+        self.last_used = time.time()
+
+    def _readline(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError("munin-node closed the connection")
+        return line.rstrip('\r\n')
+
+    def send(self, *commands):
+        """Send one or more commands without waiting for a reply."""
+        instrument.count('munin_roundtrips')
+        self.sock.sendall(''.join(['%s\n' % c for c in commands]))
+
+    def read_reply(self, multiline=True):
+        """Return the lines of the next reply."""
+        if multiline:
+            lines = []
+            line = self._readline()
+            while line != '.':
+                lines.append(line)
+                line = self._readline()
+        else:
+            lines = [self._readline()]
+        self.last_used = time.time()
+        return lines
+
+    def command(self, cmd, multiline=True):
+        self.send(cmd)
+        return self.read_reply(multiline)
+
+    def is_alive(self):
+        """A healthy idle connection has nothing to read; if it polls
+        readable munin-node has closed it (or left junk behind)."""
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class MuninNodePool(object):
+    """Keep-alive pool of `MuninConnection` objects.
+
+    Up to `size` idle connections are kept and handed out to one caller at
+    a time. Connections idle for longer than `max_idle` seconds or closed
+    by the node are discarded on checkout, and a command failing on a
+    reused connection is retried once on a fresh one.
+    """
+
+    def __init__(self, host='localhost', port=4949, size=4, timeout=10,
+                 max_idle=60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        return MuninConnection(self.host, self.port, self.timeout)
+
+    def acquire(self):
+        """Return a healthy connection, reusing an idle one if possible."""
+        now = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            finally:
+                self._lock.release()
+            if now - conn.last_used < self.max_idle and conn.is_alive():
+                return conn
+            conn.close()
+        return self.connect()
+
+    def release(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def run(self, func):
+        """Call `func(conn)` on a pooled connection and return its result,
+        reconnecting once if the connection turns out to be dead."""
+        conn = self.acquire()
+        try:
+            try:
+                res = func(conn)
+            except (socket.error, EOFError):
+                conn.close()
+                conn = self.connect()
+                res = func(conn)
+        except:
+            conn.close()
+            raise
+        self.release(conn)
+        return res
+
+    def command(self, cmd, multiline=True):
+        return self.run(lambda conn: conn.command(cmd, multiline))
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            conn.close()
+
+
 class MuninNodeProxy(Component):
     implements(IMonitoringModule)
 
-    port = 4949
+    host = Option('munin', 'node_host', 'localhost',
+        """Host munin-node is listening on.""")
+
+    port = IntOption('munin', 'node_port', 4949,
+        """Port munin-node is listening on.""")
+
+    pool_size = IntOption('munin', 'pool_size', 4,
+        """Number of idle munin-node connections kept open.""")
+
+    timeout = IntOption('munin', 'timeout', 10,
+        """Socket timeout in seconds for talking to munin-node.""")
+
+    pipeline_depth = IntOption('munin', 'pipeline_depth', 32,
+        """Maximum number of `fetch` commands sent to munin-node before
+        reading their replies.""")
+
+    plugins_ttl = IntOption('munin', 'plugins_ttl', 60,
+        """Seconds the list of munin-node's plugins is kept to tell which
+        metrics are munin's.""")
+
+    def __init__(self):
+        self.pool = MuninNodePool(self.host, self.port, self.pool_size,
+                                  self.timeout)
+        self._plugins = (0, None)   # (timestamp, frozenset of names)
+        cp.engine.subscribe('stop', self.pool.close)
 
     @classmethod
     def supported_plattform(cls, p, f, r):
@@ -79,40 +485,116 @@ class MuninNodeProxy(Component):
 
     def metrics(self, NS='.'):
         """return a list/tree of metrics starting at 'root'"""
-        t = telnetlib.Telnet('localhost', self.port)
-        time.sleep(.2)
-        res = t.read_eager() #read the banner
-        t.write('list\n')
-        time.sleep(.2)
-        data = ''
         try:
-            res = t.read_eager()
-            while res: 
-                data += res
-                res = t.read_eager()
-        except EOFError, e:
+            out = self.pool.command('list', multiline=False)[0].split()
+        except (socket.error, EOFError), e:
             return {'status':-1, 'response':[], 'errors':[str(e)]}
-        out = data.strip().split() #return list of metric names
         return {'status':0, 'response':[out], 'errors':[]}
 
+    def provides(self, metric):
+        stamp, plugins = self._plugins
+        if time.time() - stamp > self.plugins_ttl:
+            try:
+                plugins = frozenset(
+                    self.pool.command('list', multiline=False)[0].split())
+            except (socket.error, EOFError):
+                plugins = None      # asked again after plugins_ttl
+            self._plugins = (time.time(), plugins)
+        if plugins is None:
+            return None
+        return metric in plugins
+
     def values(self, *metric):
-        """get current values for each metric in *metrics"""
-        t = telnetlib.Telnet('localhost', self.port)
-        time.sleep(.2)
-        res = t.read_eager() #read the banner
-        t.write('fetch %s\n' % metric)
-        time.sleep(.2)
-        data = ''
+        """get current values for each metric in *metrics
+
+        All fetch commands are pipelined over one connection (in windows of
+        `pipeline_depth` commands) and the replies are parsed as they
+        arrive. The response holds one {metric: {field: value}} dict;
+        unknown plugins are reported in `errors`.
+        """
+        def fetch(conn):
+            res, errors = {}, []
+            depth = self.pipeline_depth
+            for i in xrange(0, len(metric), depth):
+                window = metric[i:i + depth]
+                conn.send(*['fetch %s' % m for m in window])
+                for m in window:
+                    fields = _parse_fetch(conn.read_reply())
+                    if fields is None:
+                        errors.append('unknown metric %s' % m)
+                    else:
+                        res[m] = fields
+            return res, errors
+        if not metric:
+            return {'status':0, 'response':[], 'errors':[]}
         try:
-            res = t.read_eager()
-            while res: 
-                data += res
-                res = t.read_eager()
-        except EOFError:
+            out, errors = self.pool.run(fetch)
+        except (socket.error, EOFError), e:
             return {'status':-1, 'response':[], 'errors':[str(e)]}
-        out = data.strip().split('\n')
-        return {'status':0, 'response':[out], 'errors':[]}
-        
-        
+        return {'status':0, 'response':[out], 'errors':errors}
 
 
+_SERVER_METRICS = ('threadpool', 'threadpool.decisions', 'connections',
+                   'cache')
+
+class ServerMonitor(Component):
+    """Metrics of the agent's own HTTP server.
+
+    `threadpool` holds the size and state of the worker pool and the
+    decisions of the autoscaling controller, `threadpool.decisions` the
+    most recent of them. `connections` counts the connections handled by
+    the epoll front-end and those currently waiting in it.
+    """
+    implements(IMonitoringModule)
+
+    @classmethod
+    def supported_plattform(cls, p, f, r):
+      """check plattform, flavour, release"""
+      return True
+
+    def description(self):
+        return "HTTP server metrics"
+
+    def metrics(self, NS='.'):
+        return {'status':0, 'response':[list(_SERVER_METRICS)], 'errors':[]}
+
+    def provides(self, metric):
+        return metric in _SERVER_METRICS
+
+    def values(self, *metric):
+        dispatcher = self.env[Dispatcher]
+        controller = dispatcher.pool_controller
+        res = {}
+        if controller is not None:
+            if 'threadpool' in metric:
+                res['threadpool'] = controller.state()
+            if 'threadpool.decisions' in metric:
+                res['threadpool.decisions'] = list(controller.decisions)
+        server = getattr(cp.server, 'httpserver', None)
+        if 'connections' in metric and hasattr(server, 'waiting'):
+            res['connections'] = dict(server.counters(),
+                                      waiting=server.waiting())
+        if 'cache' in metric and dispatcher.response_cache is not None:
+            res['cache'] = dispatcher.response_cache.stats()
+        return {'status':0, 'response':[res], 'errors':[]}
+
+
+def _parse_fetch(lines):
+    """Turn the lines of a munin `fetch` reply into a {field: value} dict.
+    Returns None if munin-node doesn't know the plugin. Unknown values
+    ("U") become None."""
+    fields = {}
+    for line in lines:
+        if line.startswith('#'):
+            if line.startswith('# Unknown service'):
+                return None
+            continue
+        parts = line.split(None, 1)
+        if len(parts) != 2 or not parts[0].endswith('.value'):
+            continue
+        try:
+            value = float(parts[1])
+        except ValueError:
+            value = None
+        fields[parts[0][:-6]] = value
+    return fields
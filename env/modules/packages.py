@@ -5,12 +5,15 @@
 
 import os
 from os.path import join as joinpath
-from subprocess import Popen, PIPE
-from config import Option, ExtensionOption
+from config import Option, BoolOption, ExtensionOption, IntOption
 from core import implements, Component, ExtensionPoint,\
         SysTracError
 
 from interfaces import IPackageManager, ISystemModule
+from jobs import JobModule
+from jsonenc import constant_response
+from util.aptindex import AptIndex, parse_stanza, parse_stanzas
+from util.jsonstream import iterencode
 
 import cherrypy as cp
 
@@ -28,9 +31,9 @@ class PackageManagerModule(Component):
         self.log.debug("Got IPackageManager providers %s" % self.children)
         
     @classmethod
-    def supported_platform(cls, p, f, r):
+    def supported_plattform(cls, p, f, r):
       """check plattform, flavour, release"""
-      return self.default_manager.default.supported_plattform(p, f, r)
+      return AptPackageManager.supported_plattform(p, f, r)
         
     def description(self):
         return "Package management"
@@ -45,8 +48,25 @@ class PackageManagerModule(Component):
     
     @cp.expose
     @cp.tools.set_content_type()
-    def info(self, pkgname):
+    def info(self, pkgname=None, pkg=None):
+        """Info for `pkgname`, or for all packages given as (repeated)
+        `pkg` arguments: /system/packages/info?pkg=a&pkg=b"""
+        if pkg is not None:
+            if isinstance(pkg, basestring):
+                pkg = [pkg]
+            return self.default_manager.bulk_info(pkg)
+        if pkgname is None:
+            return self.json.dumps({'status':510, 'errors':['INVALID_ARGUMENT']})
         return self.default_manager.info(pkgname)
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def inventory(self, fields=None):
+        """All installed packages; `fields=Package,Version,...` limits the
+        fields returned per package."""
+        if fields:
+            fields = [f for f in fields.split(',') if f]
+        return self.default_manager.inventory(fields)
     
     @cp.expose
     @cp.tools.set_content_type()
@@ -56,11 +76,29 @@ class PackageManagerModule(Component):
 class AptPackageManager(Component):
     implements(IPackageManager)
 
+    use_index = BoolOption('apt', 'use_index', 'true',
+        """Answer search and info from an in-process index of the package
+        lists instead of running apt-cache and dpkg.""")
+
+    status_file = Option('apt', 'status_file', '/var/lib/dpkg/status',
+        """The dpkg status file.""")
+
+    lists_dir = Option('apt', 'lists_dir', '/var/lib/apt/lists',
+        """Directory holding the `*_Packages` files.""")
+
+    index_check = IntOption('apt', 'index_check', 10,
+        """Seconds between checks of the indexed files for changes.""")
+
     def __init__(self):
         self.answer = {
                 'status':200,
                 'result': 'success',
                 'errors':[]}
+        self.pkgindex = None
+        self._status = (None, [])   # (signature, installed stanzas)
+        if self.use_index:
+            self.pkgindex = AptIndex(self.status_file, self.lists_dir,
+                                     self.index_check)
                 
     @classmethod
     def supported_plattform(cls, p, f, r):
@@ -74,36 +112,118 @@ class AptPackageManager(Component):
     
 
     def search(self, pkgname):
-        res = []
-        p = Popen('apt-cache search %s | grep %s' % (pkgname, pkgname), shell=True, stdout=PIPE, stderr=PIPE)
-        for line in p.stdout.readlines():
-            parts = line.split(' - ', 1)
-            if len(parts) == 2:
-                res.append({'name':parts[0], 'desc':parts[1].rstrip()})
-            else: print "invalid package "+line
-        out = self.answer.copy()
-        out.update({'data':res})
-        return self.json.dumps(out)
+        if self.pkgindex is not None:
+            out = self.answer.copy()
+            out.update({'data':self.pkgindex.search(pkgname)})
+            return self.json.dumps(out)
+
+        def parse(job):
+            packages = []
+            for line in job.stdout.splitlines():
+                # apt-cache also matches descriptions, keep the lines
+                # mentioning the name like `grep` used to
+                if pkgname not in line:
+                    continue
+                parts = line.split(' - ', 1)
+                if len(parts) == 2:
+                    packages.append({'name':parts[0], 'desc':parts[1].rstrip()})
+            out = self.answer.copy()
+            out.update({'data':packages})
+            return out
+        jobs = self.env[JobModule]
+        return jobs.respond(jobs.submit(['apt-cache', 'search', pkgname],
+                                        'apt', parse))
     
 
     def info(self, pkgname):
-        out = self.answer.copy()
-        res = {}
-        p = Popen('dpkg -s %s' % pkgname, shell=True, stdout=PIPE, stderr=PIPE)
-        err = p.stderr.read()
-        if err: 
-            out.update({'status':404, 'errors':[err]})
+        if self.pkgindex is not None:
+            out = self.answer.copy()
+            res = self.pkgindex.info(pkgname)
+            if res is None:
+                out.update({'status':404,
+                            'errors':['package %s not found' % pkgname]})
+            else:
+                out.update({'data':res})
             return self.json.dumps(out)
+
+        def parse(job):
+            out = self.answer.copy()
+            if job.stderr:
+                out.update({'status':404, 'errors':[job.stderr]})
+                return out
+            out.update({'data':parse_stanza(job.stdout)})
+            return out
+        jobs = self.env[JobModule]
+        return jobs.respond(jobs.submit(['dpkg', '-s', pkgname], 'apt',
+                                        parse))
+
+    def bulk_info(self, pkgnames):
+        """{name: fields} for all `pkgnames`, unknown packages are listed
+        in `errors`."""
+        if self.pkgindex is not None:
+            res, errors = {}, []
+            for name in pkgnames:
+                info = self.pkgindex.info(name)
+                if info is None:
+                    errors.append('package %s not found' % name)
+                else:
+                    res[name] = info
+            return self.json.dumps(self._bulk_answer(res, errors))
+
+        def parse(job):
+            # one dpkg run for all packages, it reports the unknown ones on
+            # stderr
+            res = dict([(info.get('Package'), info)
+                        for info in parse_stanzas(job.stdout)])
+            errors = [line for line in job.stderr.splitlines()
+                      if line.startswith('dpkg')]
+            return self._bulk_answer(res, errors)
+        jobs = self.env[JobModule]
+        return jobs.respond(jobs.submit(['dpkg', '-s'] + list(pkgnames),
+                                        'apt', parse))
+
+    def _bulk_answer(self, res, errors):
+        out = self.answer.copy()
+        out.update({'data':res, 'errors':errors})
+        if errors and not res:
+            out['status'] = 404
+        return out
+
+    def inventory(self, fields=None):
+        """Stream all installed packages from the dpkg status file."""
+        if self.pkgindex is not None:
+            packages = self.pkgindex.installed(fields)
+        else:
+            packages = self._read_status(fields)
+        out = self.answer.copy()
+        out.update({'data':packages})
+        cp.response.stream = True
+        return iterencode(out, self.json)
+
+    def _read_status(self, fields):
+        """Yield the installed packages of the status file. The parsed
+        stanzas are kept until the file's (ino, size, mtime) changes, as
+        `AptIndex` does."""
+        st = os.stat(self.status_file)
+        sig = (st.st_ino, st.st_size, st.st_mtime)
+        cached, packages = self._status
+        if sig != cached:
+            fileobj = open(self.status_file)
+            try:
+                data = fileobj.read()
+            finally:
+                fileobj.close()
+            packages = [info for info in parse_stanzas(data)
+                        if info.get('Status', '').endswith(' installed')]
+            self._status = (sig, packages)
+        for info in packages:
+            if fields:
+                info = dict([(f, info.get(f)) for f in fields])
+            yield info
             
-        for line in p.stdout.readlines():
-          parts = line.split(':')
-          if len(parts) == 2:
-            res[parts[0].strip()] = parts[1].strip()
-  
-        out.update({'data':res})
-        return self.json.dumps(out)
-            
+    @constant_response
     def index(self):
         return self.json.dumps(
-            {'methods':['search(pkgname)', 'info(pkgname)'],
+            {'methods':['search(pkgname)', 'info(pkgname)', 'info(pkg, pkg...)',
+                        'inventory(fields)'],
              'desc': "simple interface to the systems package manager"})
@@ -3,72 +3,414 @@
 # Copyright (C) 2009 Paul Kölle
 # All rights reserved.
 
-from subprocess import Popen, PIPE
+import os, shlex, time, threading
 
 from core import *
+from config import Option, IntOption
 from interfaces import IMonitoringModule
-from lib.util import nodes
+from util import nodes
 
 pcp_error = False
 have_pcp = True
 try:
-    import pcpi
-    from pcpi import *
+    from pcp import pmapi
+    import cpmapi as c_api
 except ImportError, e:
     have_pcp = False
     pcp_error = e
 
+def _errors():
+    """Exceptions meaning pmcd or pminfo is unavailable."""
+    if have_pcp:
+        return (SysTracError, EnvironmentError, pmapi.pmErr)
+    return (SysTracError, EnvironmentError)
+
 class PCPProxy(Component):
+    """Metrics from Performance Co-Pilot.
+
+    With the PCP python bindings installed a single PMAPI context to pmcd
+    is kept open for the lifetime of the agent: the PMNS is traversed once
+    (and again every `pmns_ttl` seconds), pmids and descriptors are cached
+    and all requested metrics are fetched with one pmFetch. Without the
+    bindings we fall back to pminfo(1) for the namespace and a single
+    pmprobe(1) per values() call. If pmcd can't be reached the answer has
+    status -1 and the error, like the munin children.
+    """
     implements(IMonitoringModule)
 
+    host = Option('pcp', 'host', 'local:',
+        """pmcd to connect to, `local:` uses the unix domain socket.""")
+
+    pmns_ttl = IntOption('pcp', 'pmns_ttl', 300,
+        """Seconds the metric namespace is cached.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._context = None
+        self._tree = None
+        self._tree_loaded = 0
+        self._pmids = {}
+        self._descs = {}
+
     @classmethod
     def supported_plattform(cls, p, f, r):
         """check plattform, flavour, release"""
         #FIXME check for running pmcd (open socket on localhost)
-        return os.path.exists('/usr/bin/pminfo')
-
-        #if not have_pcp:
-        #    print "Failed to load PCP library. PCP not installed (%s)" % pcp_error
-        #    return False
-        #return True
+        return have_pcp or os.path.exists('/usr/bin/pminfo')
 
     def metrics(self, NS='.'):
         """return a list/tree of metrics starting at 'NS' """
-        ret, out, err = self._run_cmd("/usr/bin/pminfo mem")
-        if ret != 0:
-            raise SysTracError("Error running pminfo -> %s" % err)
-        lines = [l.strip() for l in out.split('\n')]
-        root = nodes.Node(None, "pcp")
-        for line in lines:
-            _create_nodes(root, line)
-
-        out = [node.position for node in nodes.Node._instances]
-        #for node in nodes.Node._instances:
-        #    if node.children:
-        #        print "Node %s has %d children" % (node.position, len(node.children))
-        return {'status':0, 'response':[out], 'errors':[]}
+        try:
+            tree = self._get_pmns()
+        except _errors(), e:
+            return {'status':-1, 'response':[], 'errors':[str(e)]}
+        return {'status':0, 'response':[tree.serialize(NS)], 'errors':[]}
+
+    def provides(self, metric):
+        try:
+            return self._get_pmns().findNode(metric) is not None
+        except _errors():
+            return None
 
     def values(self, *metric):
-        """get current values for each metric in *metrics"""
+        """get current values for each metric in *metrics
+
+        Non-leaf names are expanded to all metrics below them. The response
+        holds one {metric: value} dict, metrics with an instance domain map
+        to an {instance: value} dict instead.
+        """
+        try:
+            return self._values(metric)
+        except _errors(), e:
+            return {'status':-1, 'response':[], 'errors':[str(e)]}
+
+    def _values(self, metric):
+        tree = self._get_pmns()
+        names, errors = [], []
+        for m in metric:
+            node = tree.findNode(m)
+            if node is None:
+                errors.append('unknown metric %s' % m)
+            elif node.children:
+                names.extend([p.split('.', 1)[1] for p in tree.leaves(m)])
+            else:
+                names.append(m)
+        if not names:
+            return {'status':0, 'response':[], 'errors':errors}
+        if have_pcp:
+            out, errs = self._locked(self._fetch, names)
+        else:
+            out, errs = self._probe(names)
+        return {'status':0, 'response':[out], 'errors':errors + errs}
+
+    def _locked(self, func, *args):
+        """Run `func` holding the context lock; reconnect once if pmcd
+        went away. A context that can't be reconnected is dropped, the
+        next call creates a new one."""
+        self._lock.acquire()
+        try:
+            try:
+                return func(*args)
+            except pmapi.pmErr:
+                if self._context is None:
+                    raise
+                try:
+                    self._context.pmReconnectContext()
+                except pmapi.pmErr:
+                    self._context = None
+                    raise
+                return func(*args)
+        finally:
+            self._lock.release()
+
+    def _get_pmns(self):
+        """Return the (cached) namespace as a nodes.Tree."""
+        if self._tree is None or \
+           time.time() - self._tree_loaded > self.pmns_ttl:
+            if have_pcp:
+                names = self._locked(self._traverse)
+            else:
+                ret, out, err = self._run_cmd(["/usr/bin/pminfo"])
+                if ret != 0:
+                    raise SysTracError("Error running pminfo -> %s" % err)
+                names = (out or '').split('\n')
+            tree = nodes.Tree("pcp")
+            for name in names:
+                name = name.strip()
+                if name:
+                    tree.insert(name)
+            self._tree, self._tree_loaded = tree, time.time()
+        return self._tree
+
+    # PMAPI backend, called with self._lock held
+
+    def _get_context(self):
+        if self._context is None:
+            self._context = pmapi.pmContext(c_api.PM_CONTEXT_HOST, self.host)
+        return self._context
+
+    def _traverse(self):
+        names = []
+        self._get_context().pmTraversePMNS('', names.append)
+        # the pmids may have changed with the namespace
+        self._pmids.clear()
+        self._descs.clear()
+        return names
+
+    def _lookup(self, names):
+        """Return [(name, pmid, desc)] for all known names and a list of
+        errors for the others, resolving uncached names in one call."""
+        ctx = self._get_context()
+        missing = [n for n in names if n not in self._pmids]
+        if missing:
+            try:
+                pmids = ctx.pmLookupName(missing)
+            except pmapi.pmErr:
+                # at least one unknown name, resolve them one by one
+                pmids = []
+                for name in missing:
+                    try:
+                        pmids.append(ctx.pmLookupName(name)[0])
+                    except pmapi.pmErr:
+                        pmids.append(None)
+            new = [(n, p) for n, p in zip(missing, pmids)
+                   if p is not None and p != c_api.PM_ID_NULL]
+            if new:
+                descs = ctx.pmLookupDescs([p for n, p in new])
+                for (name, pmid), desc in zip(new, descs):
+                    self._pmids[name] = pmid
+                    self._descs[name] = desc
+        res, errors = [], []
+        for name in names:
+            if name in self._pmids:
+                res.append((name, self._pmids[name], self._descs[name]))
+            else:
+                errors.append('unknown metric %s' % name)
+        return res, errors
+
+    def _fetch(self, names):
+        ctx = self._get_context()
+        metrics, errors = self._lookup(names)
+        if not metrics:
+            return {}, errors
+        result = ctx.pmFetch([pmid for name, pmid, desc in metrics])
+        out = {}
+        try:
+            for i, (name, pmid, desc) in enumerate(metrics):
+                numval = result.contents.get_numval(i)
+                if numval < 0:
+                    errors.append('%s: %s' % (name, pmapi.pmErr(numval)))
+                    continue
+                vtype = desc.contents.type
+                valfmt = result.contents.get_valfmt(i)
+                values = {}
+                for j in xrange(numval):
+                    vlist = result.contents.get_vlist(i, j)
+                    atom = ctx.pmExtractValue(valfmt, vlist, vtype, vtype)
+                    value = atom.dref(vtype)
+                    if desc.contents.indom == c_api.PM_INDOM_NULL:
+                        values = value
+                        break
+                    values[ctx.pmNameInDom(desc, vlist.inst)] = value
+                out[name] = values
+        finally:
+            ctx.pmFreeResult(result)
+        return out, errors
+
+    # pmprobe fallback
+
+    def _probe(self, names):
+        """Fetch all `names` with a single pmprobe(1) run."""
+        ret, out, err = self._run_cmd(["/usr/bin/pmprobe", "-v", "-I"] + names)
+        if ret != 0:
+            return {}, [err]
+        res, errors = {}, []
+        for line in (out or '').split('\n'):
+            # name numval value... "instance"...
+            parts = shlex.split(line)
+            if len(parts) < 2:
+                continue
+            name, numval = parts[0], int(parts[1])
+            if numval < 0:
+                errors.append('%s: %s' % (name, ' '.join(parts[2:])))
+                continue
+            values = [_number(v) for v in parts[2:2 + numval]]
+            instances = parts[2 + numval:2 + 2 * numval]
+            if len(instances) == numval:
+                res[name] = dict(zip(instances, values))
+            elif values:
+                res[name] = values[0]
+        return res, errors
+
+    def _run_cmd(self, argv):
+        # not at the top, so the module loads without the page handler
+        # tools, for the tests below
+        from jobs import JobModule
+        job = self.env[JobModule].execute(argv, 'pcp')
+        if job.returncode != 0:
+            return job.returncode, None, job.error or job.stderr+job.stdout
+        return job.returncode, job.stdout or None, job.stderr or None
+
+
+def _number(value):
+    """pmprobe prints everything as text, convert numeric values."""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+if __name__ == '__main__':
+    # PYTHONPATH=lib python env/modules/pcpclient.py: run PCPProxy against
+    # a stand-in pmcd behind fake PMAPI bindings
+    import tempfile, unittest
+    from config import Configuration
+    from core import ComponentManager
+
+    class Struct(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class FakePmcd(object):
+        """pmcd serving a few metrics. Clear `up` to take it down,
+        `restart()` invalidates the connections of existing contexts."""
+
+        metrics = {'kernel.all.load': (1, None, {None: 0.5}),
+                   'mem.physmem': (2, None, {None: 1024}),
+                   'disk.dev.read': (3, 7, {0: 10, 1: 20})}
+        instances = {0: 'sda', 1: 'sdb'}
+
+        def __init__(self):
+            self.up = True
+            self.generation = 0
+            self.fetches = 0
+
+        def restart(self):
+            self.generation += 1
+
+    class pmErr(Exception):
         pass
 
-    def _run_cmd(self, cmd):
-        #print "command passed to Popen: %s" % cmd+' '+action
-        p = Popen(cmd, stderr=PIPE, stdout=PIPE, shell=True)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            return p.returncode, None, err+out
-        return p.returncode, out or None, err or None
+    class FakeContext(object):
+
+        def __init__(self, kind, host):
+            self._connect()
+
+        def _connect(self):
+            if not pmcd.up:
+                raise pmErr("No route to host")
+            self.generation = pmcd.generation
+
+        def _check(self):
+            if not pmcd.up or self.generation != pmcd.generation:
+                raise pmErr("IPC protocol failure")
+
+        def pmReconnectContext(self):
+            self._connect()
+
+        def pmTraversePMNS(self, prefix, callback):
+            self._check()
+            for name in sorted(pmcd.metrics):
+                callback(name)
+
+        def pmLookupName(self, names):
+            self._check()
+            if isinstance(names, basestring):
+                names = [names]
+            try:
+                return [pmcd.metrics[name][0] for name in names]
+            except KeyError, e:
+                raise pmErr("Unknown metric name %s" % e)
+
+        def pmLookupDescs(self, pmids):
+            self._check()
+            indoms = dict([(m[0], m[1]) for m in pmcd.metrics.values()])
+            return [Struct(contents=Struct(type=0,
+                        indom=indoms[p] is None and -1 or indoms[p]))
+                    for p in pmids]
+
+        def pmFetch(self, pmids):
+            self._check()
+            pmcd.fetches += 1
+            values = dict([(m[0], m[2]) for m in pmcd.metrics.values()])
+            vlists = [[Struct(inst=i, value=v)
+                       for i, v in sorted(values[p].items())] for p in pmids]
+            return Struct(contents=Struct(
+                get_numval=lambda i: len(vlists[i]),
+                get_valfmt=lambda i: 0,
+                get_vlist=lambda i, j: vlists[i][j]))
+
+        def pmExtractValue(self, valfmt, vlist, intype, outtype):
+            return Struct(dref=lambda vtype: vlist.value)
+
+        def pmNameInDom(self, desc, inst):
+            return pmcd.instances[inst]
+
+        def pmFreeResult(self, result):
+            pass
+
+    pmapi = Struct(pmContext=FakeContext, pmErr=pmErr)
+    c_api = Struct(PM_CONTEXT_HOST=1, PM_ID_NULL=-1, PM_INDOM_NULL=-1)
+    have_pcp = True
+
+    class TestEnv(ComponentManager):
+
+        def __init__(self, config):
+            ComponentManager.__init__(self)
+            self.config = config
+
+        def component_activated(self, component):
+            component.env = self
+            component.config = self.config
+
+    class TestPCPProxy(unittest.TestCase):
+
+        def setUp(self):
+            global pmcd
+            pmcd = FakePmcd()
+            fd, self.ini = tempfile.mkstemp(suffix='.ini')
+            os.write(fd, "[pcp]\nhost = local:\n")
+            os.close(fd)
+            self.proxy = TestEnv(Configuration(self.ini))[PCPProxy]
+
+        def tearDown(self):
+            os.unlink(self.ini)
+
+        def test_fetch(self):
+            r = self.proxy.values('kernel.all.load', 'disk', 'nosuch')
+            self.assertEqual(r['status'], 0)
+            self.assertEqual(r['response'], [{'kernel.all.load': 0.5,
+                'disk.dev.read': {'sda': 10, 'sdb': 20}}])
+            self.assertEqual(r['errors'], ['unknown metric nosuch'])
+            self.assertEqual(pmcd.fetches, 1)
+            r = self.proxy.metrics('mem')
+            self.assertEqual(r['status'], 0)
 
+        def test_reconnect(self):
+            self.proxy.values('mem.physmem')
+            context = self.proxy._context
+            pmcd.restart()
+            r = self.proxy.values('mem.physmem')
+            self.assertEqual(r['status'], 0)
+            self.assertEqual(r['response'], [{'mem.physmem': 1024}])
+            self.assert_(self.proxy._context is context)
 
-def _create_nodes(parent, line):
-    parts = line.split('.', 1)
-    if len(parts) == 1:
-        parent.appendNode(parts[0])
-        return
+        def test_pmcd_down(self):
+            pmcd.up = False
+            for r in (self.proxy.metrics(), self.proxy.values('mem')):
+                self.assertEqual(r['status'], -1)
+                self.assertEqual(r['errors'], ['No route to host'])
+            pmcd.up = True
+            self.assertEqual(self.proxy.values('mem')['status'], 0)
 
-    current =  nodes.Node.findNode(parent.position+'.'+parts[0])
-    if not current:
-        current = parent.appendNode(parts[0])
+        def test_pmcd_goes_away(self):
+            self.proxy.values('mem.physmem')
+            pmcd.up = False
+            r = self.proxy.values('mem.physmem')
+            self.assertEqual(r['status'], -1)
+            self.assert_(self.proxy._context is None)
+            pmcd.up = True
+            r = self.proxy.values('mem.physmem')
+            self.assertEqual(r['response'], [{'mem.physmem': 1024}])
 
-    _create_nodes(current, parts[1])
\ No newline at end of file
+    unittest.main()
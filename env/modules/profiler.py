@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+import cherrypy as cp
+
+from config import IntOption, ListOption
+from core import implements, Component
+from interfaces import ISystemModule
+from jsonenc import constant_response
+from stackprof import StackSampler
+
+
+class ProfilerModule(Component):
+    """On-demand sampling profiler of the agent itself.
+
+    `start` samples the stacks of all threads `hz` times per second for
+    `seconds` seconds, `result` returns them as folded stacks for
+    flamegraph.pl (`curl -u user:pw .../result | flamegraph.pl > p.svg`).
+    All methods require HTTP basic auth against `[profiler] users`;
+    without users the profiler can't be used at all.
+    """
+    implements(ISystemModule)
+
+    users = ListOption('profiler', 'users', '',
+        doc="""Users allowed to run the profiler as `name:md5(password)`
+        pairs, e.g. from `python -c "import md5; print
+        md5.new('secret').hexdigest()"`.""")
+
+    hz = IntOption('profiler', 'hz', 100,
+        """Default sampling frequency.""")
+
+    seconds = IntOption('profiler', 'seconds', 30,
+        """Default duration of a profile.""")
+
+    max_seconds = IntOption('profiler', 'max_seconds', 600,
+        """Longest profile that can be requested.""")
+
+    def __init__(self):
+        self.sampler = None
+        self._cp_config = {'tools.basic_auth.on': True,
+                           'tools.basic_auth.realm': 'systrac profiler',
+                           'tools.basic_auth.users': self._users}
+        cp.engine.subscribe('stop', self._stop)
+
+    @classmethod
+    def supported_plattform(cls, p, f, r):
+      """check plattform, flavour, release"""
+      return True
+
+    def description(self):
+        return "Sampling profiler"
+
+    def get_path(self):
+        return 'profiler'
+
+    def _users(self):
+        users = {}
+        for item in self.users:
+            name, sep, password = item.partition(':')
+            if sep:
+                users[name.strip()] = password.strip()
+        return users
+
+    def _stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def start(self, hz=None, seconds=None):
+        """Start profiling, unless a profile is running already."""
+        if self.sampler is not None and self.sampler.running():
+            return self.json.dumps({'status':409,
+                                    'errors':['PROFILER_RUNNING']})
+        try:
+            hz = int(hz or self.hz)
+            seconds = int(seconds or self.seconds)
+        except ValueError:
+            return self.json.dumps({'status':510, 'errors':['INVALID_ARGUMENT']})
+        if not 0 < hz <= 1000 or not 0 < seconds <= self.max_seconds:
+            return self.json.dumps({'status':510, 'errors':['INVALID_ARGUMENT']})
+        self.sampler = StackSampler(hz, seconds)
+        self.sampler.start()
+        return self.json.envelope([self.sampler.state()])
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def stop(self):
+        """Stop the running profile early."""
+        if self.sampler is None:
+            return self.json.dumps({'status':404, 'errors':['NO_PROFILE']})
+        self.sampler.stop()
+        return self.json.envelope([self.sampler.state()])
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    def state(self):
+        if self.sampler is None:
+            return self.json.dumps({'status':404, 'errors':['NO_PROFILE']})
+        return self.json.envelope([self.sampler.state()])
+
+    @cp.expose
+    @cp.tools.set_content_type(ct='text/plain')
+    def result(self):
+        """Folded stacks of the last profile, also while it is running."""
+        if self.sampler is None:
+            raise cp.HTTPError(404)
+        return self.sampler.folded()
+
+    @cp.expose
+    @cp.tools.set_content_type()
+    @constant_response
+    def index(self):
+        return self.json.dumps(
+            {'methods':['start(hz, seconds)', 'stop', 'state', 'result'],
+             'desc': "sampling profiler, result in folded stack format"})
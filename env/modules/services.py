@@ -1,16 +1,34 @@
-import os
+import os, re, threading, time
 from os.path import join as joinpath
-from subprocess import Popen, PIPE
-from config import Option, ExtensionOption
+from config import Option, ExtensionOption, FloatOption
 from core import implements, Component, ExtensionPoint, SysTracError
 
 import cherrypy as cp
 
 from interfaces import ISystemModule, IServiceManager
+from jobs import JobModule
+from jsonenc import constant_response
+from processes import ProcessModule
+from psutil import get_process_table
+from respcache import invalidator
+from util.jsonstream import iterencode
+
+_ASSIGNMENT = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)=(\S*)\s*$', re.M)
+_VARIABLE = re.compile(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)\}?')
+_INTERPRETER = re.compile(
+    r'^(python|perl|ruby|java|node|nodejs|php|lua|tclsh|sh|bash|dash)[0-9.]*$')
 
             
 class SysVServiceManager(Component):
     implements(IServiceManager)
+
+    status_ttl = FloatOption('services', 'status_ttl', 5,
+        """Seconds the result of a bulk status query is cached.""")
+
+    status_timeout = FloatOption('services', 'status_timeout', 5,
+        """Seconds an init script may take to answer `status` when the
+        state of a service can't be told from its pidfile or the process
+        table.""")
     
     def __init__(self):
         self.basedir = '/etc/init.d'
@@ -36,6 +54,10 @@ class SysVServiceManager(Component):
                 'status':None,
                 'content': [],
                 'errors':[]}
+        self._scripts = {}          # name -> (mtime, pidfile, daemon)
+        self._status = (0, None)    # (timestamp, encoded answer)
+        self._changed = None        # new token per finished action
+        self._status_lock = threading.Lock()
                 
     @classmethod
     def supported_plattform(cls, p, f, r):
@@ -50,38 +72,151 @@ class SysVServiceManager(Component):
  
 
     def list(self):
-        raw =  [e for e in os.listdir('/etc/init.d')
-                if not e.endswith('.sh')]
-        srv = [e for e in raw if e not in self.blacklist]
-        return self.json.dumps({'status': 200, 'content': [srv]})
+        cp.response.stream = True
+        return iterencode({'status': 200, 'content': [self._services()]},
+                          self.json)
+
+    def _services(self):
+        return (e for e in os.listdir(self.basedir)
+                if not e.endswith('.sh') and e not in self.blacklist)
+
+    def bulk_status(self):
+        """State of all services as {name: {'state', 'pid', 'source'}}.
+
+        `state` is one of running, stopped, dead (pidfile without a
+        process) or unknown. It is derived from the pidfile (the one named
+        in the init script or the usual ones under /var/run) and the daemon
+        named in the init script, checked against the process table. Only
+        where that doesn't tell, `<script> status` is run, for all of them
+        in parallel on the job pool. The answer is cached for `status_ttl`
+        seconds.
+        """
+        stamp, answer = self._status
+        if answer is not None and time.time() - stamp < self.status_ttl:
+            return answer
+        self._status_lock.acquire()
+        try:
+            stamp, answer = self._status
+            if answer is None or time.time() - stamp >= self.status_ttl:
+                changed = self._changed
+                answer = self.json.envelope([self._collect_status()], 200)
+                if changed is self._changed:
+                    # else a service changed while collecting, don't keep it
+                    self._status = (time.time(), answer)
+            return answer
+        finally:
+            self._status_lock.release()
+
+    def _collect_status(self):
+        table = self._process_table()
+        running = {}
+        for i in xrange(len(table)):
+            argv0 = table.get_cmdline(i).split(' ', 1)[0]
+            running.setdefault(table.name[i], table.pid[i])
+            running.setdefault(os.path.basename(argv0), table.pid[i])
+        pids = set(table.pid)
+        res, jobs = {}, {}
+        for name in self._services():
+            pidfile, daemon = self._script_info(name)
+            state = None
+            for path in pidfile and [pidfile] or _pidfile_candidates(name):
+                pid = _read_pidfile(path)
+                if pid is not None:
+                    if pid in pids:
+                        state = {'state': 'running', 'pid': pid}
+                    else:
+                        state = {'state': 'dead', 'pid': pid}
+                    state['source'] = 'pidfile'
+                    break
+            if state is None and daemon:
+                # comm names are cut at 15 characters
+                pid = running.get(daemon) or running.get(daemon[:15])
+                state = {'state': pid and 'running' or 'stopped', 'pid': pid,
+                         'source': 'process'}
+            if state is None:
+                jobs[name] = self.env[JobModule].submit(
+                    [joinpath(self.basedir, name), 'status'], 'status',
+                    timeout=self.status_timeout)
+            else:
+                res[name] = state
+        for name, job in jobs.items():
+            # a stuck job would block all bulk queries on _status_lock
+            job.wait(self.status_timeout + 1)
+            # LSB: 0 running, 1 dead with pidfile, 3 not running; no
+            # returncode if rejected, killed or not done yet
+            state = {0: 'running', 1: 'dead', 3: 'stopped'}.get(
+                job.returncode, 'unknown')
+            res[name] = {'state': state, 'pid': None, 'source': 'script'}
+        return res
+
+    def _process_table(self):
+        processes = self.env[ProcessModule]
+        sample = processes and processes.sampler and \
+                 processes.sampler.latest()
+        if sample:
+            return sample[1]
+        return get_process_table()
+
+    def _script_info(self, name):
+        """Return the pidfile and daemon name set in the init script
+        `name`, with the script's own variables expanded."""
+        path = joinpath(self.basedir, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None, None
+        cached = self._scripts.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1:]
+        try:
+            fileobj = open(path)
+            try:
+                script = fileobj.read()
+            finally:
+                fileobj.close()
+        except IOError:
+            return None, None
+        env = {'NAME': name}
+        for key, value in _ASSIGNMENT.findall(script):
+            value = value.strip('"\'')
+            if '`' in value or '$(' in value:
+                continue
+            env[key] = _VARIABLE.sub(lambda m: env.get(m.group(1), ''), value)
+        pidfile = env.get('PIDFILE')
+        if not pidfile or not pidfile.startswith('/'):
+            pidfile = None
+        daemon = env.get('DAEMON')
+        if daemon:
+            daemon = os.path.basename(daemon)
+            if _INTERPRETER.match(daemon):
+                # any python or java process would do, ask the script
+                daemon = None
+        self._scripts[name] = (mtime, pidfile, daemon)
+        return pidfile, daemon
 
  
     def start(self, name):
         cmd = joinpath(self.basedir, name)
         if self._filter_cmd(cmd):
-            ret, out, err = self._run_cmd(cmd, 'start')
-            return self.json.dumps({'status':ret, 'response':[out], 'errors':[err]})
+            return self._run_cmd(cmd, 'start')
         return self.json.dumps({'status':404, 'errors':['service not found']})
         
     def status(self, name):
         cmd = joinpath(self.basedir, name)
         if self._filter_cmd(cmd):
-            ret, out, err = self._run_cmd(cmd, 'status')
-            return self.json.dumps({'status':ret, 'response':[out], 'errors':[err]})
+            return self._run_cmd(cmd, 'status')
         return self.json.dumps({'status':404, 'errors':['service not found']})
         
     def stop(self, name):
         cmd = joinpath(self.basedir, name)
         if self._filter_cmd(cmd):
-            ret, out, err = self._run_cmd(cmd, 'stop')
-            return self.json.dumps({'status':ret, 'response':[out], 'errors':[err]})
+            return self._run_cmd(cmd, 'stop')
         return self.json.dumps({'status':404, 'errors':['service not found']})
     
     def restart(self, name):
         cmd = joinpath(self.basedir, name)
         if self._filter_cmd(cmd):
-            ret, out, err = self._run_cmd(cmd, 'restart')
-            return self.json.dumps({'status':ret, 'response':[out], 'errors':[err]})
+            return self._run_cmd(cmd, 'restart')
         return self.json.dumps({'status':404, 'errors':['service not found']})
 
 
@@ -91,12 +226,42 @@ class SysVServiceManager(Component):
         return False
 
     def _run_cmd(self, cmd, action):
-        #print "command passed to Popen: %s" % cmd+' '+action
-        p = Popen(cmd+' '+action, stderr=PIPE, stdout=PIPE, shell=True)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            return p.returncode, None, err+'\n'+out
-        return p.returncode, out or None, err or None
+        jobs = self.env[JobModule]
+        parse = _action_result
+        if action != 'status':
+            drop = invalidator()
+            def parse(job):
+                # the cached status and list answers are outdated once the
+                # script is done, possibly after answering with 202
+                self._changed = object()
+                self._status = (0, None)
+                drop()
+                return _action_result(job)
+        return jobs.respond(jobs.submit([cmd, action], 'service', parse))
+
+
+def _pidfile_candidates(name):
+    for rundir in ('/var/run', '/run'):
+        yield '%s/%s.pid' % (rundir, name)
+        yield '%s/%s/%s.pid' % (rundir, name, name)
+
+def _read_pidfile(path):
+    try:
+        fileobj = open(path)
+        try:
+            return int(fileobj.readline().strip())
+        finally:
+            fileobj.close()
+    except (IOError, ValueError):
+        return None
+
+def _action_result(job):
+    out, err = job.stdout, job.stderr
+    if job.returncode != 0:
+        return {'status': job.returncode, 'response': [None],
+                'errors': [err+'\n'+out]}
+    return {'status': job.returncode, 'response': [out or None],
+            'errors': [err or None]}
 
 class UpstartServiceManager(Component):
     implements(IServiceManager)
@@ -129,6 +294,9 @@ class UpstartServiceManager(Component):
     def status(self, service):
         pass
 
+    def bulk_status(self):
+        pass
+
 class ServiceModule(Component):
     implements(ISystemModule)
     
@@ -169,7 +337,10 @@ class ServiceModule(Component):
         
     @cp.expose
     @cp.tools.set_content_type()
-    def status(self, name):
+    def status(self, name=None):
+        """Status of service `name`, or of all services without it."""
+        if name is None:
+            return self.default_manager.bulk_status()
         return self.default_manager.status(name)
     
     @cp.expose
@@ -179,6 +350,7 @@ class ServiceModule(Component):
     
     @cp.expose
     @cp.tools.set_content_type()
+    @constant_response
     def index(self):
         return self.json.dumps(
             {'methods':['list', 'start', 'stop', 'restart', 'status']})
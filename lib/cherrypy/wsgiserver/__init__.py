@@ -1326,7 +1326,7 @@ class ThreadPool(object):
         """Kill off worker threads (not below self.min)."""
         # Grow/shrink the pool if necessary.
         # Remove any dead threads from our list
-        for t in self._threads:
+        for t in self._threads[:]:
             if not t.isAlive():
                 self._threads.remove(t)
                 amount -= 1
@@ -14,9 +14,11 @@
 
 from ConfigParser import ConfigParser
 import os
+import threading
 
 
 from core import *
+from util.filewatch import FileWatcher
 from util.text import printout, to_unicode, CRLF
 
 __all__ = ['Configuration', 'Option', 'BoolOption', 'IntOption', 'ListOption',
@@ -25,25 +27,56 @@ __all__ = ['Configuration', 'Option', 'BoolOption', 'IntOption', 'ListOption',
 
 _TRUE_VALUES = ('yes', 'true', 'enabled', 'on', 'aye', '1', 1, True)
 
+_MISSING = object()
+
 
 class ConfigurationError(SysTracError):
     """Exception raised when a value in the configuration file is not valid."""
 
 
+class _Snapshot(object):
+    """The flattened, read-only state of a configuration (including its
+    parents) at one point in time.
+
+    `values` maps `(section, option)` to the raw string and `origins` to the
+    file it came from, `sections` holds the option names of each section in
+    file order. `cache` is filled by the `Option` descriptors with converted
+    values. A changed configuration gets a new snapshot, this one is never
+    modified.
+    """
+    __slots__ = ['values', 'origins', 'sections', 'cache']
+
+    def __init__(self, values, origins, sections):
+        self.values = values
+        self.origins = origins
+        self.sections = sections
+        self.cache = {}
+
+
 class Configuration(object):
     """Thin layer over `ConfigParser` from the Python standard library.
 
-    In addition to providing some convenience methods, the class remembers
-    the last modification time of the configuration file, and reparses it
-    when the file has changed.
+    The file is parsed once into a `_Snapshot`; all reads are served from
+    that snapshot, so reading an option is a dict lookup and never touches
+    the file system. `parse_if_needed()` reparses the file if it changed
+    and swaps in a new snapshot in a single assignment, readers see either
+    the old or the new configuration but never a mix. `watch()` calls it
+    whenever the file is written. `generation` is incremented on every
+    change, so callers can cheaply tell whether values they derived are
+    stale.
     """
     def __init__(self, filename):
         self.filename = filename
         self.parser = ConfigParser()
+        self.generation = 0
         self.parent = None
-        self._lastmtime = 0
+        self._lastsig = None
         self._sections = {}
-        self.parse_if_needed()
+        self._lock = threading.RLock()
+        self._watcher = None
+        self._snapshot = _Snapshot({}, {}, {})
+        if not self.parse_if_needed():
+            self._rebuild()
 
     def __contains__(self, name):
         """Return whether the configuration contains a section of the given
@@ -125,17 +158,17 @@ class Configuration(object):
 
     def remove(self, section, name):
         """Remove the specified option."""
-        if self.parser.has_section(section):
-            self.parser.remove_option(section, name)
+        self._lock.acquire()
+        try:
+            if self.parser.has_section(section):
+                self.parser.remove_option(section, name)
+                self._rebuild()
+        finally:
+            self._lock.release()
 
     def sections(self):
         """Return a list of section names."""
-        sections = set(self.parser.sections())
-        parent = self.parent
-        while parent:
-            sections |= set(parent.parser.sections())
-            parent = parent.parent
-        return sorted(sections)
+        return sorted(self._snapshot.sections)
 
     def has_option(self, section, option):
         """Returns True if option exists in section in either project or
@@ -192,32 +225,95 @@ class Configuration(object):
             fileobj.close()
 
     def parse_if_needed(self):
-        if not self.filename or not os.path.isfile(self.filename):
+        """Reparse the file (and the inherited ones) if it has been changed
+        and return whether it was."""
+        if not self.filename:
             return False
+        self._lock.acquire()
+        try:
+            try:
+                st = os.stat(self.filename)
+            except OSError:
+                return False
+            changed = False
+            sig = (st.st_ino, st.st_size, st.st_mtime)
+            if sig != self._lastsig:
+                # parse into a new parser, the current one keeps serving
+                # until the snapshot is replaced
+                parser = ConfigParser()
+                parser.read(self.filename)
+                self.parser = parser
+                self._lastsig = sig
+                changed = True
 
-        changed = False
-        modtime = os.path.getmtime(self.filename)
-        if modtime > self._lastmtime:
-            self.parser._sections = {}
-            self.parser.read(self.filename)
-            self._lastmtime = modtime
-            changed = True
-
-        if self.parser.has_option('inherit', 'file'):
-            filename = self.parser.get('inherit', 'file')
-            if not os.path.isabs(filename):
-                filename = os.path.join(os.path.dirname(self.filename),
-                                        filename)
-            if not self.parent or self.parent.filename != filename:
-                self.parent = Configuration(filename)
+            if self.parser.has_option('inherit', 'file'):
+                filename = self.parser.get('inherit', 'file')
+                if not os.path.isabs(filename):
+                    filename = os.path.join(os.path.dirname(self.filename),
+                                            filename)
+                if not self.parent or self.parent.filename != filename:
+                    self.parent = Configuration(filename)
+                    changed = True
+                else:
+                    changed |= self.parent.parse_if_needed()
+            elif self.parent:
                 changed = True
-            else:
-                changed |= self.parent.parse_if_needed()
-        elif self.parent:
-            changed = True
-            self.parent = None
+                self.parent = None
 
-        return changed
+            if changed:
+                self._rebuild()
+            return changed
+        finally:
+            self._lock.release()
+
+    def _rebuild(self):
+        """Flatten parser and parents into a new snapshot and publish it."""
+        chain = []
+        config = self
+        while config:
+            chain.append(config)
+            config = config.parent
+        values, origins, sections = {}, {}, {}
+        for config in reversed(chain):
+            parser = config.parser
+            for section in parser.sections():
+                names = sections.setdefault(section, [])
+                for name in parser.options(section):
+                    key = (section, name)
+                    if key not in values:
+                        names.append(name)
+                    values[key] = parser.get(section, name)
+                    origins[key] = config.filename
+        # the snapshot lists the child's options first, like Section.__iter__
+        # used to
+        for section, names in sections.items():
+            own = self.parser.has_section(section) and \
+                  self.parser.options(section) or []
+            sections[section] = own + [n for n in names if n not in own]
+        self._snapshot = _Snapshot(values, origins, sections)
+        self.generation += 1
+
+    def watch(self, interval=2.0, callback=None):
+        """Reload the configuration whenever the file (or an inherited one)
+        changes, see `util.filewatch`. `callback` is called after each
+        reload."""
+        if self._watcher is not None or not self.filename:
+            return
+        paths = []
+        config = self
+        while config:
+            paths.append(config.filename)
+            config = config.parent
+        def reload():
+            if self.parse_if_needed() and callback:
+                callback(self)
+        self._watcher = FileWatcher(paths, reload, interval)
+        self._watcher.start()
+
+    def unwatch(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
 
     def touch(self):
         if self.filename and os.path.isfile(self.filename) \
@@ -238,22 +334,10 @@ class Section(object):
         self.overridden = {}
 
     def __contains__(self, name):
-        if self.config.parser.has_option(self.name, name):
-            return True
-        if self.config.parent:
-            return name in self.config.parent[self.name]
-        return False
+        return (self.name, name.lower()) in self.config._snapshot.values
 
     def __iter__(self):
-        options = set()
-        if self.config.parser.has_section(self.name):
-            for option in self.config.parser.options(self.name):
-                options.add(option.lower())
-                yield option
-        if self.config.parent:
-            for option in self.config.parent[self.name]:
-                if option.lower() not in options:
-                    yield option
+        return iter(self.config._snapshot.sections.get(self.name, ()))
 
     def __repr__(self):
         return '<Section [%s]>' % (self.name)
@@ -263,11 +347,9 @@ class Section(object):
         
         Valid default input is a string. Returns a string.
         """
-        if self.config.parser.has_option(self.name, name):
-            value = self.config.parser.get(self.name, name)
-        elif self.config.parent:
-            value = self.config.parent[self.name].get(name, default)
-        else:
+        value = self.config._snapshot.values.get((self.name, name.lower()),
+                                                 _MISSING)
+        if value is _MISSING:
             option = Option.registry.get((self.name, name))
             if option:
                 value = option.default or default
@@ -345,18 +427,16 @@ class Section(object):
 
         Valid default input is a string. Returns a string with normalised path.
         """
-        if self.config.parser.has_option(self.name, name):
-            path = self.config.parser.get(self.name, name)
-            if not path:
-                return default
-            if not os.path.isabs(path):
-                path = os.path.join(os.path.dirname(self.config.filename),
-                                    path)
-            return os.path.normcase(os.path.realpath(path))
-        elif self.config.parent:
-            return self.config.parent[self.name].getpath(name, default)
-        else:
+        snapshot = self.config._snapshot
+        key = (self.name, name.lower())
+        path = snapshot.values.get(key)
+        if path is None:
             return default
+        if not path:
+            return default
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(snapshot.origins[key]), path)
+        return os.path.normcase(os.path.realpath(path))
 
     def options(self):
         """Return `(name, value)` tuples for every option in the section."""
@@ -368,14 +448,20 @@ class Section(object):
         
         These changes are not persistent unless saved with `save()`.
         """
-        if not self.config.parser.has_section(self.name):
-            self.config.parser.add_section(self.name)
-        if value is None:
-            self.overridden[name] = True
-            value = ''
-        else:
-            value = to_unicode(value).encode('utf-8')
-        return self.config.parser.set(self.name, name, value)
+        config = self.config
+        config._lock.acquire()
+        try:
+            if not config.parser.has_section(self.name):
+                config.parser.add_section(self.name)
+            if value is None:
+                self.overridden[name] = True
+                value = ''
+            else:
+                value = to_unicode(value).encode('utf-8')
+            config.parser.set(self.name, name, value)
+            config._rebuild()
+        finally:
+            config._lock.release()
 
 
 class Option(object):
@@ -404,9 +490,14 @@ class Option(object):
             return self
         config = getattr(instance, 'config', None)
         if config and isinstance(config, Configuration):
-            section = config[self.section]
-            value = self.accessor(section, self.name, self.default)
-            return value
+            cache = config._snapshot.cache
+            try:
+                return cache[self]
+            except KeyError:
+                value = self.accessor(config[self.section], self.name,
+                                      self.default)
+                cache[self] = value
+                return value
         return None
 
     def __set__(self, instance, value):
@@ -439,6 +530,13 @@ class ListOption(Option):
         self.sep = sep
         self.keep_empty = keep_empty
 
+    def __get__(self, instance, owner):
+        value = Option.__get__(self, instance, owner)
+        if isinstance(value, list):
+            # the cached list is shared, hand out copies
+            return list(value)
+        return value
+
     def accessor(self, section, name, default):
         return section.getlist(name, default, self.sep, self.keep_empty)
 
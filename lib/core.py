@@ -16,8 +16,10 @@
 # Author: Jonas Borgström <jonas@edgewall.com>
 #         Christopher Lenz <cmlenz@gmx.de>
 
+import sys, threading, traceback
+
 __all__ = ['Component', 'ExtensionPoint', 'implements', 'Interface',
-           'SysTracError']
+           'SysTracError', 'defer_extensions']
 
 __version__ = '0.0.1'
 
@@ -59,8 +61,7 @@ class ExtensionPoint(property):
         """Return a list of components that declare to implement the extension
         point interface.
         """
-        extensions = ComponentMeta._registry.get(self.interface, [])
-        return filter(None, [component.compmgr[cls] for cls in extensions])
+        return component.compmgr.extensions(self.interface)
 
     def __repr__(self):
         """Return a textual representation of the extension point."""
@@ -74,6 +75,8 @@ class ComponentMeta(type):
     """
     _components = []
     _registry = {}
+    _generation = 0 # bumped whenever the registry changes
+    _deferred = {}  # 'module.Interface' -> [callables importing providers]
 
     def __new__(cls, name, bases, d):
         """Create the component class."""
@@ -114,6 +117,7 @@ class ComponentMeta(type):
             return new_class
 
         ComponentMeta._components.append(new_class)
+        ComponentMeta._generation += 1
         registry = ComponentMeta._registry
         for interface in d.get('_implements', []):
             registry.setdefault(interface, []).append(new_class)
@@ -177,6 +181,47 @@ class Component(object):
 implements = Component.implements
 
 
+def _interface_key(interface):
+    return '%s.%s' % (interface.__module__, interface.__name__)
+
+def defer_extensions(interface_name, load):
+    """Register `load`, a callable that imports components implementing the
+    interface called `interface_name` ('module.IName'). It is called (once)
+    right before the extensions of that interface are first resolved.
+    """
+    ComponentMeta._deferred.setdefault(interface_name, []).append(load)
+
+_deferred_lock = threading.RLock()
+
+def _load_deferred(interface, log=None):
+    """Call the loaders registered for `interface`. A loader that raises
+    is logged and kept to be tried again on the next resolution, the
+    others are dropped."""
+    key = _interface_key(interface)
+    _deferred_lock.acquire()
+    try:
+        loaders = ComponentMeta._deferred.get(key)
+        if not loaders:
+            return
+        failed = []
+        for load in list(loaders):
+            try:
+                load()
+            except Exception:
+                failed.append(load)
+                if log:
+                    log.error("Loading components for %s failed" % key,
+                              exc_info=True)
+                else:
+                    traceback.print_exc(file=sys.stderr)
+        if failed:
+            ComponentMeta._deferred[key] = failed
+        else:
+            del ComponentMeta._deferred[key]
+    finally:
+        _deferred_lock.release()
+
+
 class ComponentManager(object):
     """The component manager keeps a pool of active components."""
 
@@ -184,6 +229,9 @@ class ComponentManager(object):
         """Initialize the component manager."""
         self.components = {}
         self.enabled = {}
+        self._disabled = set()
+        self._extensions = {}
+        self._extensions_generation = None
         if isinstance(self, Component):
             self.components[self.__class__] = self
 
@@ -195,6 +243,7 @@ class ComponentManager(object):
         """Activate the component instance for the given class, or return the
         existing the instance if the component has already been activated.
         """
+        self._check_generation()
         if cls not in self.enabled:
             self.enabled[cls] = self.is_component_enabled(cls)
         if not self.enabled[cls]:
@@ -211,6 +260,51 @@ class ComponentManager(object):
         #print "ComponentManager.__getitem__, returning %s" % component
         return component
 
+    def extensions(self, interface):
+        """Return the list of enabled components implementing `interface`.
+
+        The result is memoized per manager and recomputed only after the
+        component registry or `generation()` has changed.
+        """
+        if ComponentMeta._deferred:
+            _load_deferred(interface, getattr(self, 'log', None))
+        self._check_generation()
+        extensions = self._extensions.get(interface)
+        if extensions is None:
+            extensions = self._extensions[interface] = \
+                         self._resolve_extensions(interface)
+        return list(extensions)
+
+    def extensions_generation(self):
+        """A value that changes whenever the components returned by
+        extension points may have changed: the registry or `generation()`.
+        """
+        return (ComponentMeta._generation, self.generation())
+
+    def _check_generation(self):
+        """Forget the memoized extensions and enabled states if the
+        registry or `generation()` has changed."""
+        generation = self.extensions_generation()
+        if generation != self._extensions_generation:
+            self._extensions = {}
+            self.enabled = dict.fromkeys(self._disabled, False)
+            self._extensions_generation = generation
+
+    def reset_extensions(self):
+        """Forget the memoized extensions, they are resolved again on the
+        next access. The enabled states are kept."""
+        self._extensions = {}
+
+    def _resolve_extensions(self, interface):
+        extensions = ComponentMeta._registry.get(interface, [])
+        return filter(None, [self[cls] for cls in extensions])
+
+    def generation(self):
+        """Can be overridden by sub-classes to return a value that changes
+        whenever the set of enabled components may have changed (e.g. after
+        a configuration reload), invalidating memoized extensions."""
+        return None
+
     def disable_component(self, component):
         """Force a component to be disabled.
         
@@ -218,8 +312,10 @@ class ComponentManager(object):
         """
         if not isinstance(component, type):
             component = component.__class__
+        self._disabled.add(component)
         self.enabled[component] = False
         self.components[component] = None
+        self._extensions_generation = None
 
     def component_activated(self, component):
         """Can be overridden by sub-classes so that special initialization for
@@ -235,5 +331,3 @@ class ComponentManager(object):
         """
         return True
 
-    
-
@@ -19,22 +19,14 @@ try:
     import threading
 except ImportError:
     import dummy_threading as threading
-import setuptools
 import sys
 from urlparse import urlsplit
 
-try:
-    import json
-except ImportError:
-    try: 
-        import simplejson as json
-    except ImportError:
-        raise ImportError("no usable json module found")
-
 import core
 from config import *
 from core import Component, ComponentManager, implements, Interface, \
                       ExtensionPoint, SysTracError
+from jsonenc import encoder_factory
 from util import arity, copytree, get_pkginfo, makedirs
 from util.text import exception_to_unicode, printerr, printout
 
@@ -88,6 +80,20 @@ class Environment(Component, ComponentManager):
             
     default_content_type = Option('systrac', 'default_content_type', 'application/json',
             """The default content type for the set_content_type Tool""")
+
+    json_encoder = Option('systrac', 'json_encoder', 'auto',
+            """JSON encoder handed to the components. One of 'ujson', 'cjson',
+            'simplejson', 'json' or 'auto' for the fastest one installed""")
+
+    config_reload = FloatOption('systrac', 'config_reload', 2.0,
+            """Reload systrac.ini when it changes. Uses inotify where
+            available, otherwise the file is checked every `config_reload`
+            seconds. 0 disables reloading""")
+
+    lazy_loading = BoolOption('systrac', 'lazy_loading', 'false',
+            """Import modules only when an extension point for one of their
+            interfaces is first used. Which module implements what is cached
+            in a manifest in the modules directory""")
             
     def __init__(self, path, create=False, options=[]):
         """Initialize the Trac environment.
@@ -104,24 +110,43 @@ class Environment(Component, ComponentManager):
         self.path = path
         self.setup_config(load_defaults=create)
         self.setup_log()
+        self.log.info("My platform: %s (%s, version: %s)" % self.get_platform())
+        self.json = encoder_factory(self.json_encoder)
+        self.log.debug("Using json encoder %s" % self.json.name)
+        if self.config_reload > 0:
+            self.config.watch(self.config_reload, self._config_reloaded)
+            cp.engine.subscribe('stop', self.config.unwatch)
 
-        from core import  __version__ as VERSION
-        self.systeminfo = [
-            ('SysTrac', get_pkginfo(core).get('version', VERSION)),
-            ('Python', sys.version),
-            ('setuptools', setuptools.__version__),
-            ]
-
-        
         from loader import load_components
         #FIXME: remove hardcoded string, reenable config
         plugins_dir = os.path.abspath('../modules')
         load_components(self, plugins_dir and (plugins_dir,))
 
 
+    def systeminfo(self):
+        # setuptools and pkg_resources are slow to import, only do it when
+        # someone asks
+        import setuptools
+        from core import  __version__ as VERSION
+        return [
+            ('SysTrac', get_pkginfo(core).get('version', VERSION)),
+            ('Python', sys.version),
+            ('setuptools', setuptools.__version__),
+            ]
+    systeminfo = property(systeminfo)
+
     def get_platform(self):
         return (self.platform, self.flavour, self.release)
+
+    def generation(self):
+        """Memoized extension points are recomputed after the configuration
+        has been changed or reloaded."""
+        return self.config.generation
         
+    def _config_reloaded(self, config):
+        self.log.info("Reloaded %s (generation %d)" % (config.filename,
+                                                       config.generation))
+
     def component_activated(self, component):
         """Initialize additional member variables for components.
         
@@ -132,18 +157,17 @@ class Environment(Component, ComponentManager):
         component.config = self.config
         component.log = self.log
         
-        #add a reference to the json module for convenience
-        component.json = json
+        #add a reference to the json encoder for convenience
+        component.json = self.json
 
     def is_component_enabled(self, cls):
         """FIXME: make comparison case insensitive"""
         whitelist = ['Dispatcher']
         if cls.__name__ in whitelist: return True
         
-        p = self.config.get('systrac', 'platform')
-        f = self.config.get('systrac', 'flavour')
-        r = self.config.get('systrac', 'release')
-        self.log.info("My platform: %s (%s, version: %s)\n" % (p, f, r))
+        p, f, r = self.get_platform()
+        self.log.debug("Checking %s for platform %s (%s, version: %s)" % (
+                       cls.__name__, p, f, r))
         try:
             #print "Checking supported_platform on %s" % cls.__name__
             return cls.supported_plattform(p, f, r)
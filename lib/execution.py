@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Running external commands off the request threads.
+
+`CommandPool` executes `Job`s on its own bounded set of worker threads.
+Commands are always run from an argv list, never through a shell, with a
+timeout and a cap on the output kept. Every job belongs to a class
+('service', 'apt', ...) and each class can be limited to a number of
+concurrently running commands, so a burst of slow `apt-cache` calls can't
+starve the service scripts.
+"""
+
+import errno, itertools, os, select, signal, threading, time
+from collections import deque
+from subprocess import Popen, PIPE
+
+from core import SysTracError
+
+__all__ = ['CommandPool', 'Job', 'QueueFull', 'run_argv']
+
+QUEUED, RUNNING, DONE, FAILED, TIMEOUT, REJECTED = \
+    'queued', 'running', 'done', 'failed', 'timeout', 'rejected'
+
+
+class QueueFull(SysTracError):
+    """Raised by `CommandPool.submit` if `max_queue` jobs are waiting."""
+
+
+def run_argv(argv, timeout=None, max_output=None):
+    """Run `argv` and return `(returncode, stdout, stderr, flags)`.
+
+    stdout and stderr are cut at `max_output` bytes each (the rest is read
+    and discarded); `flags` is a set containing 'truncated' and/or
+    'timeout'. After `timeout` seconds the process is terminated, killed
+    if it doesn't exit within another second, and the returncode is None.
+    """
+    p = Popen(argv, stdout=PIPE, stderr=PIPE, close_fds=True)
+    stdout, stderr = p.stdout.fileno(), p.stderr.fileno()
+    out = {stdout: [], stderr: []}
+    size = dict.fromkeys(out, 0)
+    flags = set()
+    deadline = timeout and time.time() + timeout
+    fds = out.keys()
+    while fds:
+        wait = None
+        if deadline:
+            wait = deadline - time.time()
+            if wait <= 0:
+                flags.add('timeout')
+                break
+        try:
+            ready = select.select(fds, [], [], wait)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                fds.remove(fd)
+                continue
+            if max_output is not None and size[fd] + len(data) > max_output:
+                data = data[:max(0, max_output - size[fd])]
+                flags.add('truncated')
+            size[fd] += len(data)
+            if data:
+                out[fd].append(data)
+    if 'timeout' in flags:
+        _terminate(p)
+        returncode = None
+    else:
+        returncode = p.wait()
+    p.stdout.close()
+    p.stderr.close()
+    return returncode, ''.join(out[stdout]), ''.join(out[stderr]), flags
+
+def _terminate(p):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.kill(p.pid, sig)
+        except OSError:
+            break
+        for i in xrange(10):
+            if p.poll() is not None:
+                return
+            time.sleep(0.1)
+    p.wait()
+
+
+class Job(object):
+    """One command execution. `parse`, if given, is called with the
+    finished job in the worker thread and its return value stored as
+    `result`."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, argv, cls, timeout=None, parse=None):
+        self.id = '%x-%x' % (int(time.time()), self._ids.next())
+        self.argv = list(argv)
+        self.cls = cls
+        self.timeout = timeout
+        self.parse = parse
+        self.state = QUEUED
+        self.returncode = None
+        self.stdout = self.stderr = ''
+        self.truncated = False
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<Job %s %s %r>' % (self.id, self.state, self.argv)
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish, return whether it has."""
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def reject(self, error):
+        """Finish the job without running it."""
+        self.state = REJECTED
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def as_dict(self):
+        return {'id': self.id, 'argv': self.argv, 'class': self.cls,
+                'state': self.state, 'returncode': self.returncode,
+                'stdout': self.stdout, 'stderr': self.stderr,
+                'truncated': self.truncated, 'result': self.result,
+                'error': self.error, 'created': self.created,
+                'started': self.started, 'finished': self.finished}
+
+    def _run(self, max_output):
+        self.state = RUNNING
+        self.started = time.time()
+        try:
+            try:
+                self.returncode, self.stdout, self.stderr, flags = \
+                    run_argv(self.argv, self.timeout, max_output)
+                self.truncated = 'truncated' in flags
+                if 'timeout' in flags:
+                    self.state = TIMEOUT
+                    self.error = 'timed out after %s seconds' % self.timeout
+                else:
+                    self.state = DONE
+                    if self.parse is not None:
+                        self.result = self.parse(self)
+            except Exception, e:
+                self.state = FAILED
+                self.error = str(e) or e.__class__.__name__
+        finally:
+            self.finished = time.time()
+            self._done.set()
+
+
+class CommandPool(object):
+    """Bounded worker pool for `Job`s.
+
+    `limits` maps a job class to the number of its jobs allowed to run at
+    the same time, classes not listed are only limited by `workers`. At
+    most `max_queue` jobs may wait, finished jobs are kept `keep` seconds
+    for `get()`.
+    """
+
+    def __init__(self, workers=4, limits=None, max_queue=100,
+                 max_output=1024 * 1024, keep=600):
+        self.workers = workers
+        self.limits = limits or {}
+        self.max_queue = max_queue
+        self.max_output = max_output
+        self.keep = keep
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = deque()
+        self._running = {}      # class -> number of running jobs
+        self._jobs = {}         # id -> job, until `keep` expired
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        self._cond.acquire()
+        try:
+            self._stopped = False
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker,
+                                     name='CommandPool-%d' % len(self._threads))
+                t.setDaemon(True)
+                self._threads.append(t)
+                t.start()
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """Stop the workers once they've finished their current job, queued
+        jobs are rejected."""
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            while self._pending:
+                self._pending.popleft().reject('pool stopped')
+            self._cond.notifyAll()
+            threads, self._threads = self._threads, []
+        finally:
+            self._cond.release()
+        for t in threads:
+            if t is not threading.currentThread():
+                t.join(1)
+
+    def submit(self, job):
+        """Queue `job` and return it. Raises QueueFull if the queue is
+        full."""
+        if not self._threads:
+            self.start()
+        self._cond.acquire()
+        try:
+            self._expire()
+            if len(self._pending) >= self.max_queue:
+                raise QueueFull('command queue full (%d jobs waiting)' %
+                                   len(self._pending))
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        return sorted(self._jobs.values(), key=lambda j: j.created)
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {'workers': len(self._threads),
+                    'queued': len(self._pending),
+                    'running': dict(self._running),
+                    'jobs': len(self._jobs)}
+        finally:
+            self._cond.release()
+
+    def _expire(self):
+        # called with the lock held
+        limit = time.time() - self.keep
+        for job_id, job in self._jobs.items():
+            if job.finished is not None and job.finished < limit:
+                del self._jobs[job_id]
+
+    def _next(self):
+        # called with the lock held: the oldest job whose class has room
+        for job in self._pending:
+            limit = self.limits.get(job.cls)
+            if not limit or self._running.get(job.cls, 0) < limit:
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            self._cond.acquire()
+            try:
+                job = None
+                while not self._stopped:
+                    job = self._next()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+                self._running[job.cls] = self._running.get(job.cls, 0) + 1
+            finally:
+                self._cond.release()
+            try:
+                job._run(self.max_output)
+            finally:
+                self._cond.acquire()
+                try:
+                    self._running[job.cls] -= 1
+                    # a job of this class may have been waiting for room
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
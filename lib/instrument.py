@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Always-on request instrumentation, served at /monitoring/self.
+
+The `instrument` tool (enabled for the whole tree by the Dispatcher)
+records for every request, keyed by route (the path without the
+positional arguments of the handler, so /system/processes/info/1234 counts
+as /system/processes/info):
+
+ - the latency in a `Histogram`,
+ - how often the request read a file under /proc, forked a command and
+   talked to munin-node. Code doing so calls `count(name)`, which adds to
+   the counters of the request running in the current thread (and to the
+   totals, so work done by background threads shows up there). Totals
+   are kept per thread without locking and summed by `snapshot()`.
+
+The time connections waited in the queue of the thread pool is recorded
+with `record_queue_wait()`, by the epoll front-end and, once `install()`
+has run, by the connections of the stock server.
+
+`install()` also wraps the /proc readers of psutil so that they are
+counted without psutil knowing about this module.
+"""
+
+import threading, time
+from array import array
+
+import cherrypy as cp
+from cherrypy import _cpwsgi_server
+
+__all__ = ['Histogram', 'count', 'record_queue_wait', 'snapshot', 'reset',
+           'install', 'route']
+
+COUNTERS = ('proc_reads', 'forks', 'munin_roundtrips')
+
+
+class Histogram(object):
+    """Log-linear histogram of microsecond values, like HdrHistogram with
+    16 sub-buckets per power of two: values below 32 are exact, larger
+    ones are kept with a relative error of at most 1/16. Recording is a
+    few integer operations, the buckets grow as larger values arrive."""
+
+    SUB_BITS = 4
+    SUB = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = array('L')
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < 2 * self.SUB:
+            return value
+        shift = value.bit_length() - self.SUB_BITS - 1
+        return shift * self.SUB + (value >> shift)
+
+    def _value(self, index):
+        """Midpoint of the values in bucket `index`."""
+        if index < 2 * self.SUB:
+            return index
+        shift = index // self.SUB - 1
+        low = (index % self.SUB + self.SUB) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """The `pct` percentile in microseconds, 0 if empty."""
+        if not self.count:
+            return 0
+        rank = max(1, int(pct / 100.0 * self.count + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        """Count and mean, percentiles and max in milliseconds."""
+        res = {'count': self.count,
+               'mean': self.count and self.total / 1000.0 / self.count or 0,
+               'max': self.max / 1000.0}
+        for name, pct in (('p50', 50), ('p90', 90), ('p99', 99),
+                          ('p999', 99.9)):
+            res[name] = self.percentile(pct) / 1000.0
+        return res
+
+
+class _Route(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def as_dict(self):
+        requests = self.latency.count
+        return {'requests': requests, 'errors': self.errors,
+                'latency_ms': self.latency.as_dict(),
+                'totals': dict(self.counters),
+                'per_request': dict([(k, requests and float(v) / requests)
+                                     for k, v in self.counters.items()])}
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_routes = {}
+_threads = []                               # (thread, its totals)
+_retired = dict.fromkeys(COUNTERS, 0)       # totals of finished threads
+_offset = dict.fromkeys(COUNTERS, 0)        # totals at the last reset
+_queue_wait = Histogram()
+_since = time.time()
+
+
+def count(name, n=1):
+    """Add `n` to counter `name` of the current request and the totals."""
+    try:
+        totals = _local.totals
+    except AttributeError:
+        totals = _local.totals = dict.fromkeys(COUNTERS, 0)
+        _lock.acquire()
+        try:
+            _threads.append((threading.currentThread(), totals))
+        finally:
+            _lock.release()
+    # only this thread writes to its totals
+    totals[name] += n
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] += n
+
+def _totals():
+    # called with _lock held: the totals of all threads since reset()
+    for item in _threads[:]:
+        thread, totals = item
+        if not thread.isAlive():
+            _threads.remove(item)
+            for name, n in totals.iteritems():
+                _retired[name] += n
+    res = dict(_retired)
+    for thread, totals in _threads:
+        for name, n in totals.items():
+            res[name] += n
+    for name, n in _offset.iteritems():
+        res[name] -= n
+    return res
+
+def record_queue_wait(seconds):
+    _lock.acquire()
+    try:
+        _queue_wait.record(seconds)
+    finally:
+        _lock.release()
+
+def snapshot():
+    """All routes, totals and the queue wait as a dict."""
+    _lock.acquire()
+    try:
+        return {'since': _since, 'totals': _totals(),
+                'queue_wait_ms': _queue_wait.as_dict(),
+                'routes': dict([(route, r.as_dict())
+                                for route, r in _routes.items()])}
+    finally:
+        _lock.release()
+
+def reset():
+    global _queue_wait, _since
+    _lock.acquire()
+    try:
+        _routes.clear()
+        # other threads keep counting, remember where they were
+        for name, n in _totals().iteritems():
+            _offset[name] += n
+        _queue_wait = Histogram()
+        _since = time.time()
+    finally:
+        _lock.release()
+
+
+def route():
+    """The route of the current request, kept on the request once known
+    (the response cache drops the handler of requests it answers)."""
+    request = cp.request
+    path = getattr(request, 'route', None)
+    if path is not None:
+        return path
+    if getattr(request.handler, 'callable', None) is None:
+        # 404s and the like, don't let scanners create a route per url
+        return '(unrouted)'
+    path = request.path_info.rstrip('/') or '/'
+    args = getattr(request.handler, 'args', None)
+    if args:
+        path = '/'.join(path.split('/')[:-len(args)]) or '/'
+    request.route = path
+    return path
+
+def _start():
+    _local.counters = dict.fromkeys(COUNTERS, 0)
+
+def _end():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        return
+    _local.counters = None
+    elapsed = time.time() - cp.response.time
+    name = route()
+    error = cp.response.status and str(cp.response.status)[:1] == '5'
+    _lock.acquire()
+    try:
+        r = _routes.get(name)
+        if r is None:
+            r = _routes[name] = _Route()
+        r.latency.record(elapsed)
+        if error:
+            r.errors += 1
+        for name, n in counters.iteritems():
+            r.counters[name] += n
+    finally:
+        _lock.release()
+
+
+class InstrumentTool(cp.Tool):
+    """Tool attaching the start and end hooks of the instrumentation."""
+
+    def __init__(self):
+        cp.Tool.__init__(self, 'on_start_resource', _start)
+
+    def _setup(self):
+        cp.request.hooks.attach('on_start_resource', _start)
+        cp.request.hooks.attach('on_end_request', _end)
+
+cp.tools.instrument = InstrumentTool()
+
+
+def _counted(func, name):
+    def wrapper(*args, **kwargs):
+        count(name)
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class _QueuedHTTPConnection(_cpwsgi_server.CPHTTPConnection):
+    """Connection of the stock server recording how long it waited for a
+    worker thread (the epoll front-end does that itself)."""
+
+    def __init__(self, *args):
+        _cpwsgi_server.CPHTTPConnection.__init__(self, *args)
+        self.queued = time.time()
+
+    def communicate(self):
+        record_queue_wait(time.time() - self.queued)
+        _cpwsgi_server.CPHTTPConnection.communicate(self)
+
+def install():
+    """Count the /proc reads of psutil and record the queue wait of the
+    stock server's connections, once."""
+    _cpwsgi_server.CPWSGIServer.ConnectionClass = _QueuedHTTPConnection
+    try:
+        from psutil import _pslinux
+    except ImportError:
+        return
+    if getattr(_pslinux, '_instrumented', False):
+        return
+    _pslinux._read_proc = _counted(_pslinux._read_proc, 'proc_reads')
+    # the rest of _pslinux opens /proc files with the builtin open()
+    _pslinux.open = _counted(open, 'proc_reads')
+    _pslinux._instrumented = True
@@ -55,6 +55,11 @@ class IMonitoringModule(Interface):
       {"sda":[0.1, 0.4, 1.1], "sdb":[0.3, 2.0, 2.1]}
       """
 
+    def provides(metric):
+      """return True if `metric` is one of ours, False if it isn't
+      and None if that can't be told right now (backend down).
+      values() is only called with the metrics a child provides."""
+
 class IPackageManager(Interface):
     def search(pkgname):
       "search for package"
@@ -77,13 +82,20 @@ class IPackageManager(Interface):
     def info(pkgname):
         """detailed info for package 'name'"""
 
+    def bulk_info(pkgnames):
+        """detailed info for all packages in the list 'pkgnames'"""
+
+    def inventory(fields=None):
+        """all installed packages, optionally only the listed 'fields'"""
+
 
 class IProcessInfo(Interface):
     def info(pid):
         "return a json dict with process information"
 
-    def list():
-        "return a list of running processes"
+    def list(fields=None, **filters):
+        """return a list of running processes, or a dict of the columns
+        in `fields` for the processes matching `filters`"""
 
     def kill(pid):
         """kill process by pid"""
@@ -103,4 +115,7 @@ class IServiceManager(Interface):
         """list available services"""
 
     def status():
-        """return service status"""
\ No newline at end of file
+        """return service status"""
+
+    def bulk_status():
+        """return the status of all services at once"""
\ No newline at end of file
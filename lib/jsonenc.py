@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Pluggable JSON encoders.
+
+`encoder_factory(name)` returns an object with the `dumps`, `loads` and
+`load` functions of the json module, backed by one of the encoders below.
+`auto` picks the fastest one that can be imported.
+"""
+
+import time
+
+__all__ = ['encoder_factory', 'constant_response', 'ENCODERS']
+
+# in order of preference for 'auto'
+ENCODERS = ('ujson', 'cjson', 'simplejson', 'json')
+
+
+class Encoder(object):
+    """The subset of the json module interface handlers rely on, plus
+    `envelope()` for the {'status', 'response', 'errors'} answers."""
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+    def load(self, fp):
+        return self.loads(fp.read())
+
+    def envelope(self, response, status=0, errors=()):
+        """Return the encoded standard answer without building and
+        encoding the surrounding dict."""
+        return '{"status": %s, "response": %s, "errors": %s}' % (
+            self.dumps(status), self.dumps(response), self.dumps(list(errors)))
+
+
+def _load(name):
+    if name == 'ujson':
+        import ujson
+        return Encoder(name, ujson.dumps, ujson.loads)
+    elif name == 'cjson':
+        import cjson
+        return Encoder(name, cjson.encode, cjson.decode)
+    elif name == 'simplejson':
+        import simplejson
+        return Encoder(name, simplejson.dumps, simplejson.loads)
+    elif name == 'json':
+        import json
+        return Encoder(name, json.dumps, json.loads)
+    raise ValueError('unknown json encoder %r' % name)
+
+def encoder_factory(name='auto'):
+    """Return the `Encoder` called `name` (one of `ENCODERS` or `auto`).
+    Raises ImportError if it is not installed."""
+    name = (name or 'auto').lower()
+    if name != 'auto':
+        return _load(name)
+    for name in ENCODERS:
+        try:
+            return _load(name)
+        except ImportError:
+            continue
+    raise ImportError("no usable json module found")
+
+
+def constant_response(func):
+    """Decorator for page handlers whose answer only changes with the set
+    of enabled components, like the `index` method listings. The response
+    is encoded on the first call and returned as-is until the enabled
+    components may have changed (`ComponentManager.extensions_generation`,
+    e.g. after a configuration reload)."""
+    attr = '_constant_' + func.__name__
+    def wrapper(self, *args, **kwargs):
+        generation = self.compmgr.extensions_generation()
+        cached = self.__dict__.get(attr)
+        if cached is None or cached[0] != generation:
+            cached = (generation, func(self, *args, **kwargs))
+            setattr(self, attr, cached)
+        return cached[1]
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def benchmark(payload, rounds=20):
+    """Print the time it takes each available encoder to encode
+    `payload` `rounds` times."""
+    print "%-12s %10s %10s" % ("ENCODER", "SECONDS", "BYTES")
+    for name in ENCODERS:
+        try:
+            enc = _load(name)
+        except ImportError:
+            print "%-12s %10s" % (name, "n/a")
+            continue
+        start = time.time()
+        for i in xrange(rounds):
+            out = enc.dumps(payload)
+        print "%-12s %10.4f %10d" % (name, time.time() - start, len(out))
+
+if __name__ == '__main__':
+    # encode the row format of /system/processes/list, repeated to the
+    # size of a busy host
+    import psutil
+    rows = [{'pid': p.pid, 'name': p.name, 'cmdline': ' '.join(p.cmdline),
+             'info': 'http://localhost:1111/system/processes/info/%s' % p.pid}
+            for p in psutil.snapshot_iter()]
+    benchmark((rows * (8000 // len(rows) + 1))[:8000])
@@ -16,16 +16,16 @@
 
 from glob import glob
 import imp
-import pkg_resources
-from pkg_resources import working_set, DistributionNotFound, VersionConflict, \
-                          UnknownExtra
 import os
 import sys
 
+from core import ComponentMeta, defer_extensions, _interface_key
 from util.text import exception_to_unicode
 
 __all__ = ['load_components']
 
+MANIFEST = '.components.manifest'
+
 def _enable_plugin(env, module):
     """Enable the given plugin module by adding an entry to the configuration.
     """
@@ -35,6 +35,16 @@ def _enable_plugin(env, module):
 def load_eggs(entry_point_name):
     """Loader that loads any eggs on the search path and `sys.path`."""
     def _load_eggs(env, search_path, auto_enable=None):
+        if env.lazy_loading and not [p for p in search_path
+                                     if glob(os.path.join(p, '*.egg*'))]:
+            # importing pkg_resources is a large part of the startup time,
+            # don't unless there are eggs to load
+            env.log.debug('No eggs in %s, skipping pkg_resources' %
+                          search_path)
+            return
+        import pkg_resources
+        from pkg_resources import working_set, DistributionNotFound, \
+                                  VersionConflict, UnknownExtra
         # Note that the following doesn't seem to support unicode search_path
         distributions, errors = working_set.find_plugins(
             pkg_resources.Environment(search_path)
@@ -73,28 +83,96 @@ def load_eggs(entry_point_name):
                     _enable_plugin(env, entry.module_name)
     return _load_eggs
 
+def _read_manifest(env, path):
+    try:
+        fileobj = open(path)
+        try:
+            return env.json.loads(fileobj.read())
+        finally:
+            fileobj.close()
+    except (IOError, ValueError):
+        return {}
+
+def _write_manifest(env, path, manifest):
+    try:
+        fileobj = open(path, 'w')
+        try:
+            fileobj.write(env.json.dumps(manifest))
+        finally:
+            fileobj.close()
+    except IOError, e:
+        env.log.debug('Unable to write %s: %s' % (path,
+                                                  exception_to_unicode(e)))
+
+def _import_plugin(env, plugin_name, plugin_file):
+    """Import `plugin_file` and return the interfaces implemented by the
+    components it defines."""
+    if plugin_name in sys.modules:
+        module = sys.modules[plugin_name]
+    else:
+        env.log.debug('Loading file plugin %s from %s' % (plugin_name,
+                                                          plugin_file))
+        module = imp.load_source(plugin_name, plugin_file)
+    interfaces = set()
+    for cls in ComponentMeta._components:
+        if cls.__module__ == module.__name__:
+            for base in cls.__mro__:
+                for interface in base.__dict__.get('_implements', ()):
+                    interfaces.add(_interface_key(interface))
+    return sorted(interfaces)
+
+def _deferred_import(env, plugin_name, plugin_file):
+    def load():
+        if plugin_name not in sys.modules:
+            _import_plugin(env, plugin_name, plugin_file)
+    return load
+
 def load_py_files():
     """Loader that look for Python source files in the plugins directories,
     which simply get imported, thereby registering them with the component
     manager if they define any components.
+
+    With `[systrac] lazy_loading` enabled a manifest of the interfaces each
+    file implements is kept in the plugins directory. Files whose size and
+    mtime match the manifest are not imported at startup but when an
+    `ExtensionPoint` for one of their interfaces is first resolved.
     """
     def _load_py_files(env, search_path, auto_enable=None):
+        lazy = env.lazy_loading
         for path in search_path:
             plugin_files = glob(os.path.join(path, '*.py'))
             env.log.debug( "_load_py_files found plugins %s" % plugin_files)
+            manifest_file = os.path.join(path, MANIFEST)
+            manifest = lazy and _read_manifest(env, manifest_file) or {}
+            updated = {}
             for plugin_file in plugin_files:
                 try:
                     plugin_name = os.path.basename(plugin_file[:-3])
-                    env.log.debug('Loading file plugin %s from %s' % \
-                                  (plugin_name, plugin_file))
-                    if plugin_name not in sys.modules:
-                        module = imp.load_source(plugin_name, plugin_file)
+                    st = os.stat(plugin_file)
+                    # microseconds, floats don't survive every json encoder
+                    mtime = int(st.st_mtime * 1000000)
+                    entry = manifest.get(plugin_name)
+                    if entry and entry['mtime'] == mtime and \
+                       entry['size'] == st.st_size and entry['interfaces']:
+                        for interface in entry['interfaces']:
+                            defer_extensions(interface, _deferred_import(
+                                env, plugin_name, plugin_file))
+                        env.log.debug('Deferred loading of %s (%s)' % (
+                                      plugin_name,
+                                      ', '.join(entry['interfaces'])))
+                    else:
+                        entry = {'mtime': mtime, 'size': st.st_size,
+                                 'interfaces': _import_plugin(env, plugin_name,
+                                                              plugin_file)}
+                    updated[plugin_name] = entry
                     if path == auto_enable:
                         _enable_plugin(env, plugin_name)
                 except Exception, e:
                     raise
                     #env.log.debug('Failed to load plugin from %s', plugin_file,
                     #              exception_to_unicode(e, traceback=True))
+            if lazy and updated != manifest:
+                _write_manifest(env, manifest_file, updated)
 
     return _load_py_files
 
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Autoscaling of the HTTP server's worker threads.
+
+The bundled wsgiserver serves each connection on one thread of a fixed
+`ThreadPool`; a few slow requests (`/system/packages/search`, service
+scripts) occupy all of them and everything else waits in the queue.
+`PoolController` looks at the pool every `frequency` seconds and
+
+ - grows it when connections are queued or fewer than `spare` threads are
+   idle, by more if the recent p99 latency is above `slow` seconds
+   (slow requests hold their threads longer, so more spares are needed),
+ - shrinks it by half the surplus when more than twice `spare` threads
+   have been idle for `shrink_delay` seconds,
+
+always staying between `min_threads` and `max_threads`. Latencies are
+recorded by the `pool_latency` tool (enabled by `PoolController.config`).
+"""
+
+import math, threading, time
+from collections import deque
+
+import cherrypy as cp
+from cherrypy.process.plugins import Monitor
+
+__all__ = ['PoolController', 'percentile']
+
+
+def percentile(values, pct):
+    """The `pct` percentile of `values` (nearest rank), None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class PoolController(Monitor):
+    """Bus plugin resizing `cp.server.httpserver.requests`.
+
+    The last `history` decisions are kept as dicts with the time, the
+    action (`grow` or `shrink`), the number of threads added or removed,
+    the reason and the pool state the decision was based on.
+    """
+
+    def __init__(self, bus, min_threads=4, max_threads=40, spare=2,
+                 slow=1.0, shrink_delay=10, frequency=1, window=1000,
+                 history=50):
+        Monitor.__init__(self, bus, self.adjust, frequency)
+        self.min_threads = max(1, min_threads)
+        self.max_threads = max(self.min_threads, max_threads)
+        self.spare = spare
+        self.slow = slow
+        self.shrink_delay = shrink_delay
+        self.latencies = deque(maxlen=window)
+        self.decisions = deque(maxlen=history)
+        self.counters = dict.fromkeys(('grown', 'shrunk', 'requests'), 0)
+        self._idle_since = None
+        self._lock = threading.Lock()           # adjust()
+        self._stats_lock = threading.Lock()     # latencies and counters
+
+    def config(self):
+        """The cherrypy config enabling the latency tool, to be merged
+        into the application config."""
+        return {'tools.pool_latency.on': True,
+                'tools.pool_latency.controller': self}
+
+    def record(self, seconds):
+        """Record the duration of a finished request."""
+        self._stats_lock.acquire()
+        try:
+            self.latencies.append(seconds)
+            self.counters['requests'] += 1
+        finally:
+            self._stats_lock.release()
+
+    def _pool(self):
+        server = getattr(cp.server, 'httpserver', None)
+        return getattr(server, 'requests', None)
+
+    def state(self):
+        """Current pool size, idle threads, queued connections, bounds
+        and latency percentiles of the last requests."""
+        pool = self._pool()
+        self._stats_lock.acquire()
+        try:
+            latencies = list(self.latencies)
+            counters = self.counters.copy()
+        finally:
+            self._stats_lock.release()
+        res = {'min': self.min_threads, 'max': self.max_threads,
+               'p50': percentile(latencies, 50),
+               'p99': percentile(latencies, 99)}
+        res.update(counters)
+        if pool is None:
+            res.update(threads=0, idle=0, queued=0)
+        else:
+            threads = [t for t in pool._threads if t.isAlive()]
+            res.update(threads=len(threads),
+                       idle=len([t for t in threads if t.conn is None]),
+                       queued=pool._queue.qsize())
+        return res
+
+    def adjust(self):
+        """Grow or shrink the pool once, see the module docs."""
+        pool = self._pool()
+        if pool is None:
+            return
+        self._lock.acquire()
+        try:
+            pool.min = self.min_threads
+            pool.max = self.max_threads
+            # cull threads which took a shutdown request
+            pool.shrink(0)
+            state = self.state()
+            threads, idle, queued = (state['threads'], state['idle'],
+                                     state['queued'])
+            if queued or idle < self.spare:
+                self._idle_since = None
+                amount = queued + self.spare - idle
+                reason = queued and 'queued' or 'spare'
+                if state['p99'] is not None and state['p99'] > self.slow:
+                    amount *= 2
+                    reason += ',slow'
+                amount = min(amount, self.max_threads - threads)
+                if amount > 0:
+                    pool.grow(amount)
+                    self._decide('grow', amount, reason, state)
+            elif idle > 2 * self.spare and threads > self.min_threads:
+                now = time.time()
+                if self._idle_since is None:
+                    self._idle_since = now
+                elif now - self._idle_since >= self.shrink_delay:
+                    amount = min(max(1, (idle - 2 * self.spare) // 2),
+                                 threads - self.min_threads)
+                    pool.shrink(amount)
+                    self._idle_since = now
+                    self._decide('shrink', amount, 'idle', state)
+            else:
+                self._idle_since = None
+        finally:
+            self._lock.release()
+
+    def _decide(self, action, amount, reason, state):
+        self._stats_lock.acquire()
+        try:
+            self.counters[action == 'grow' and 'grown' or 'shrunk'] += amount
+        finally:
+            self._stats_lock.release()
+        self.decisions.append({'time': time.time(), 'action': action,
+                               'amount': amount, 'reason': reason,
+                               'threads': state['threads'],
+                               'idle': state['idle'],
+                               'queued': state['queued']})
+        self.bus.log("Thread pool: %s by %d (%s), %d threads, %d idle, "
+                     "%d queued" % (action, amount, reason, state['threads'],
+                                    state['idle'], state['queued']))
+
+
+def _record_latency(controller):
+    controller.record(time.time() - cp.response.time)
+cp.tools.pool_latency = cp.Tool('on_end_request', _record_latency)
+
+
+if __name__ == '__main__':
+    # python lib/poolctl.py [-c clients] [-n requests] URL...: request the
+    # URLs round robin from `clients` threads and print latency percentiles
+    # per URL, e.g. a fast and a slow endpoint mixed
+    import getopt, sys, urllib2
+    opts, urls = getopt.getopt(sys.argv[1:], 'c:n:')
+    opts = dict(opts)
+    clients = int(opts.get('-c', 20))
+    count = int(opts.get('-n', 50))
+    results = dict([(url, []) for url in urls])
+
+    def client(offset):
+        for i in xrange(count):
+            url = urls[(offset + i) % len(urls)]
+            start = time.time()
+            try:
+                urllib2.urlopen(url).read()
+            except Exception, e:
+                print >>sys.stderr, url, e
+                continue
+            results[url].append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in xrange(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print "%d clients, %d requests in %.1f s" % (
+        clients, clients * count, time.time() - start)
+    print "%-60s %6s %8s %8s" % ("URL", "N", "p50 ms", "p99 ms")
+    for url in urls:
+        times = results[url]
+        if times:
+            print "%-60s %6d %8.1f %8.1f" % (url[-60:], len(times),
+                                             percentile(times, 50) * 1000,
+                                             percentile(times, 99) * 1000)
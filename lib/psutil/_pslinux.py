@@ -100,14 +100,15 @@ def get_system_cpu_times():
 
 def prevent_zombie(method):
     """Call method(self, pid) into a try/except clause so that if an
-    IOError "No such file" exception is raised we assume the process
-    has died and raise psutil.NoSuchProcess instead.
+    IOError or OSError "No such file" exception is raised we assume the
+    process has died and raise psutil.NoSuchProcess instead.
     """
     def wrapper(self, pid, *args, **kwargs):
         try:
             return method(self, pid, *args, **kwargs)
-        except IOError, err:
-            if err.errno == errno.ENOENT:  # no such file or directory
+        except (IOError, OSError), err:
+            # ESRCH: the process went away between open() and read()
+            if err.errno in (errno.ENOENT, errno.ESRCH):
                 if not self.pid_exists(pid):
                     raise NoSuchProcess(pid)
             raise
@@ -129,8 +130,91 @@ def wrap_privileges(callable):
     return wrapper
 
 
+def _read_proc(pid, name):
+    """Read /proc/<pid>/<name> with a single open/read/close sequence,
+    bypassing the buffering (and extra fstat) of Python file objects.
+    """
+    fd = os.open("/proc/%s/%s" % (pid, name), os.O_RDONLY)
+    try:
+        data = os.read(fd, 8192)
+        if len(data) == 8192:
+            chunks = [data]
+            while data:
+                data = os.read(fd, 8192)
+                chunks.append(data)
+            data = ''.join(chunks)
+        return data
+    finally:
+        os.close(fd)
+
+def _parse_status(data):
+    """Return (ppid, uid, gid, vms, rss) from the contents of
+    /proc/<pid>/status.
+    Memory sizes are returned in bytes; kernel threads have no Vm* lines
+    and report 0.
+    """
+    ppid = uid = gid = None
+    vms = rss = 0
+    for line in data.split('\n'):
+        if line.startswith('PPid:'):
+            ppid = int(line.split()[1])
+        elif line.startswith('Uid:'):
+            # real, effective, saved set and file system UIDs; we want
+            # the real UID only
+            uid = int(line.split()[1])
+        elif line.startswith('Gid:'):
+            gid = int(line.split()[1])
+        elif line.startswith('VmSize:'):
+            vms = int(line.split()[1]) * 1024
+        elif line.startswith('VmRSS:'):
+            rss = int(line.split()[1]) * 1024
+            break
+    return ppid, uid, gid, vms, rss
+
+
 class Impl(object):
 
+    @prevent_zombie
+    @wrap_privileges
+    def get_process_snapshot(self, pid):
+        """Return everything we know about a process in one pass.
+
+        Reads /proc/<pid>/stat, status and cmdline exactly once each and
+        returns a tuple of
+        (pid, ppid, name, path, cmdline, uid, gid, rss, vms,
+         utime, stime, create_time).
+        """
+        if pid == 0:
+            # special case for 0 (kernel process) PID
+            return (pid, 0, 'sched', '', [], 0, 0, 0, 0, 0.0, 0.0, _UPTIME)
+
+        stat = _read_proc(pid, 'stat')
+        status = _read_proc(pid, 'status')
+        cmdline = [x for x in _read_proc(pid, 'cmdline').split('\x00') if x]
+
+        # the executable name may contain spaces and parens, the last ')'
+        # terminates it
+        end = stat.rfind(')')
+        _exe = stat[stat.find('(') + 1:end]
+        values = stat[end + 2:].split(' ')
+        utime = float(values[11]) / _CLOCK_TICKS
+        stime = float(values[12]) / _CLOCK_TICKS
+        create_time = (float(values[19]) / _CLOCK_TICKS) + _UPTIME
+
+        try:
+            _exe = os.readlink("/proc/%s/exe" % pid)
+        except OSError:
+            pass
+        if os.path.isabs(_exe):
+            path, name = os.path.split(_exe)
+        else:
+            path = ''
+            name = _exe
+
+        ppid, uid, gid, vms, rss = _parse_status(status)
+        return (pid, ppid, name, path, cmdline, uid, gid, rss, vms,
+                utime, stime, create_time)
+
     @prevent_zombie
     @wrap_privileges
     def get_process_info(self, pid):
@@ -164,9 +248,8 @@ class Impl(object):
         finally:
             f.close()
 
-        return (pid, self._get_ppid(pid), name, path, cmdline,
-                                  self._get_process_uid(pid),
-                                  self._get_process_gid(pid))
+        ppid, uid, gid = _parse_status(_read_proc(pid, 'status'))[:3]
+        return (pid, ppid, name, path, cmdline, uid, gid)
 
     @wrap_privileges
     def kill_process(self, pid, sig=signal.SIGKILL):
@@ -234,6 +317,21 @@ class Impl(object):
         starttime = (float(values[19]) / _CLOCK_TICKS) + _UPTIME
         return starttime
 
+    @prevent_zombie
+    @wrap_privileges
+    def get_io_counters(self, pid):
+        """Return (read_bytes, write_bytes) from /proc/<pid>/io."""
+        if pid == 0:
+            return (0, 0)
+        read_bytes = write_bytes = 0
+        for line in _read_proc(pid, 'io').split('\n'):
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line.split()[1])
+            elif line.startswith('write_bytes:'):
+                write_bytes = int(line.split()[1])
+                break
+        return (read_bytes, write_bytes)
+
     @prevent_zombie
     @wrap_privileges
     def get_memory_info(self, pid):
@@ -253,32 +351,3 @@ class Impl(object):
                 break
         f.close()
         return (resident_size * 1024, virtual_size * 1024)
-
-    def _get_ppid(self, pid):
-        f = open("/proc/%s/status" % pid)
-        for line in f:
-            if line.startswith("PPid:"):
-                # PPid: nnnn
-                f.close()
-                return int(line.split()[1])
-
-    def _get_process_uid(self, pid):
-        f = open("/proc/%s/status" %pid)
-        for line in f:
-            if line.startswith('Uid:'):
-                # Uid line provides 4 values which stand for real,
-                # effective, saved set, and file system UIDs.
-                # We want to provide real UID only.
-                f.close()
-                return int(line.split()[1])
-
-    def _get_process_gid(self, pid):
-        f = open("/proc/%s/status" %pid)
-        for line in f:
-            if line.startswith('Gid:'):
-                # Uid line provides 4 values which stand for real,
-                # effective, saved set, and file system GIDs.
-                # We want to provide real GID only.
-                f.close()
-                return int(line.split()[1])
-
@@ -19,6 +19,14 @@ __all__ = [
     "get_pid_list",
     "process_iter",
     "get_process_list",
+    "ProcessSnapshot",
+    "get_process_snapshot",
+    "snapshot_iter",
+    "ProcessTable",
+    "get_process_table",
+    "start_scan_pool",
+    "stop_scan_pools",
+    "get_io_counters",
     "TOTAL_PHYMEM",
     "avail_phymem",
     "used_phymem",
@@ -32,6 +40,8 @@ __all__ = [
 import sys
 import os
 import time
+import threading
+from array import array
 
 # exceptions are imported here, but may be overriden by platform
 # module implementation later
@@ -114,6 +124,157 @@ class ProcessInfo(object):
         self.create = None
 
 
+class ProcessSnapshot(object):
+    """Immutable, compact record of a process' state at one point in time.
+
+    Unlike Process, a snapshot is filled in with a single pass over the
+    platform-specific data sources and never touches the system again.
+    Memory sizes are in bytes, CPU times in seconds.
+    """
+    __slots__ = ['pid', 'ppid', 'name', 'path', 'cmdline', 'uid', 'gid',
+                 'rss', 'vms', 'utime', 'stime', 'create_time']
+
+    def __init__(self, pid, ppid, name, path, cmdline, uid, gid, rss, vms,
+                       utime, stime, create_time):
+        self.pid = pid
+        self.ppid = ppid
+        self.name = name
+        # same fallback as ProcessInfo: derive the path from argv[0]
+        if cmdline and not path:
+            path = os.path.dirname(cmdline[0])
+        self.path = path
+        self.cmdline = cmdline
+        self.uid = uid
+        self.gid = gid
+        self.rss = rss
+        self.vms = vms
+        self.utime = utime
+        self.stime = stime
+        self.create_time = create_time
+
+    def __repr__(self):
+        return "<psutil.ProcessSnapshot PID:%s; NAME:'%s'>" % (self.pid,
+                                                               self.name)
+
+    def as_dict(self):
+        """Return the snapshot as a plain dict, e.g. for serialisation."""
+        return dict([(attr, getattr(self, attr)) for attr in self.__slots__])
+
+
+class ProcessTable(object):
+    """Column oriented (struct-of-arrays) snapshot of the process table.
+
+    Numeric columns are stored in typed arrays, command lines are kept in
+    a single string buffer indexed by `cmdline_offsets` (row i spans
+    offsets[i]:offsets[i+1]). Rows are addressed by index; `select()`
+    returns the indexes matching a set of column filters and
+    `to_columns()` projects them into plain lists, ready for json.
+    """
+
+    columns = ('pid', 'ppid', 'uid', 'name', 'cmdline', 'rss', 'utime',
+               'stime', 'create_time')
+
+    def __init__(self, snapshots=None):
+        self.pid = array('l')
+        self.ppid = array('l')
+        self.uid = array('l')
+        self.name = []
+        self.rss = array('l')
+        self.utime = array('d')
+        self.stime = array('d')
+        self.create_time = array('d')
+        self.cmdline_offsets = array('l', [0])
+        self._cmdbuf = ''
+        if snapshots is not None:
+            self.extend(snapshots)
+
+    def __len__(self):
+        return len(self.pid)
+
+    def extend(self, snapshots):
+        """Append the ProcessSnapshot objects in `snapshots`."""
+        cmdlines = [self._cmdbuf]
+        offset = self.cmdline_offsets[-1]
+        for snap in snapshots:
+            self.pid.append(snap.pid)
+            self.ppid.append(snap.ppid or 0)
+            # uid is unknown for processes that vanished half way
+            if snap.uid is None:
+                self.uid.append(-1)
+            else:
+                self.uid.append(snap.uid)
+            self.name.append(snap.name)
+            self.rss.append(snap.rss)
+            self.utime.append(snap.utime)
+            self.stime.append(snap.stime)
+            self.create_time.append(snap.create_time)
+            cmdline = ' '.join(snap.cmdline)
+            cmdlines.append(cmdline)
+            offset += len(cmdline)
+            self.cmdline_offsets.append(offset)
+        self._cmdbuf = ''.join(cmdlines)
+
+    def get_cmdline(self, row):
+        """Return the command line of `row` as a single string."""
+        return self._cmdbuf[self.cmdline_offsets[row]:
+                            self.cmdline_offsets[row + 1]]
+
+    def add_column(self, field, values):
+        """Attach a derived column (an array or list with one value per
+        row) to the table, making it available to `select()` and
+        `to_columns()`."""
+        if len(values) != len(self):
+            raise ValueError("column %r has %d rows, expected %d" % (
+                             field, len(values), len(self)))
+        setattr(self, field, values)
+        self.columns = self.columns + (field,)
+
+    def column(self, field):
+        """Return the column `field` as a list, raises ValueError for
+        unknown fields."""
+        if field not in self.columns:
+            raise ValueError("unknown field %r" % field)
+        if field == 'cmdline':
+            return [self.get_cmdline(i) for i in xrange(len(self))]
+        col = getattr(self, field)
+        if isinstance(col, array):
+            return col.tolist()
+        return col
+
+    def select(self, **filters):
+        """Return the indexes of all rows where every column named in
+        `filters` equals the given value. Values are coerced to the type of
+        the column so query string arguments can be passed in directly.
+        """
+        rows = xrange(len(self))
+        for field, value in filters.items():
+            if field not in self.columns:
+                raise ValueError("unknown field %r" % field)
+            if field == 'cmdline':
+                rows = [i for i in rows if self.get_cmdline(i) == value]
+                continue
+            col = getattr(self, field)
+            if isinstance(col, array):
+                if col.typecode == 'd':
+                    value = float(value)
+                else:
+                    value = int(value)
+            rows = [i for i in rows if col[i] == value]
+        return list(rows)
+
+    def to_columns(self, fields=None, rows=None):
+        """Return a dict mapping each of `fields` (default: all columns)
+        to the list of its values for `rows` (default: all rows)."""
+        fields = fields or self.columns
+        res = {}
+        for field in fields:
+            col = self.column(field)
+            if rows is not None:
+                col = [col[i] for i in rows]
+            res[field] = col
+        return res
+
+
 class Process(object):
     """Represents an OS process."""
 
@@ -343,6 +504,122 @@ def get_process_list():
     """
     return list(process_iter())
 
+def get_process_snapshot(pid):
+    """Return a ProcessSnapshot for the given PID, raises NoSuchProcess
+    if the PID does not exist."""
+    return ProcessSnapshot(*_platform_impl.get_process_snapshot(pid))
+
+def snapshot_iter():
+    """Return an iterator yielding a ProcessSnapshot for every running
+    process on the local machine, skipping processes that disappear or
+    can't be read while iterating.
+    """
+    get_snapshot = _platform_impl.get_process_snapshot
+    for pid in _platform_impl.get_pid_list():
+        try:
+            yield ProcessSnapshot(*get_snapshot(pid))
+        except (NoSuchProcess, AccessDenied):
+            continue
+
+def get_io_counters(pid):
+    """Return a tuple of (read_bytes, write_bytes) the process caused to
+    be fetched from or sent to the storage layer."""
+    return _platform_impl.get_io_counters(pid)
+
+def _snapshot_chunk(pids):
+    """Return the raw snapshot tuples for `pids`, skipping processes that
+    disappear or can't be read. Runs inside scan pool workers."""
+    get_snapshot = _platform_impl.get_process_snapshot
+    res = []
+    for pid in pids:
+        try:
+            res.append(get_snapshot(pid))
+        except (NoSuchProcess, AccessDenied):
+            continue
+    return res
+
+_scan_pools = {}
+_scan_pools_lock = threading.Lock()
+
+def start_scan_pool(workers, mode='processes'):
+    """Create the pool `get_process_table` uses for `workers` and `mode`.
+
+    Process pools are only created this way and should be started before
+    the application starts its threads: forking while another thread
+    holds a lock (logging, the import lock, ...) can deadlock the child.
+    Thread pools are also created on first use.
+    """
+    if mode == 'processes':
+        from multiprocessing import Pool
+    elif mode == 'threads':
+        from multiprocessing.pool import ThreadPool as Pool
+    else:
+        raise ValueError("unknown scan mode %r" % mode)
+    key = (workers, mode)
+    _scan_pools_lock.acquire()
+    try:
+        pool = _scan_pools.get(key)
+        if pool is None:
+            pool = _scan_pools[key] = Pool(workers)
+        return pool
+    finally:
+        _scan_pools_lock.release()
+
+def stop_scan_pools():
+    """Terminate all scan pools."""
+    _scan_pools_lock.acquire()
+    try:
+        pools = _scan_pools.values()
+        _scan_pools.clear()
+    finally:
+        _scan_pools_lock.release()
+    for pool in pools:
+        pool.terminate()
+        pool.join()
+
+def _get_scan_pool(workers, mode):
+    """Return the cached worker pool of the given size. `mode` is either
+    'threads' or 'processes'; process pools must have been started with
+    `start_scan_pool`."""
+    pool = _scan_pools.get((workers, mode))
+    if pool is not None:
+        return pool
+    if mode == 'processes':
+        raise RuntimeError("process scan pool of %d workers not started"
+                           % workers)
+    return start_scan_pool(workers, mode)
+
+def _scan(pids, workers=0, mode='threads'):
+    """Return the raw snapshot tuples for `pids`, in order. With more than
+    one worker the pid list is split into contiguous chunks which are read
+    concurrently by a pool of threads or processes."""
+    if workers < 2 or len(pids) < workers:
+        return _snapshot_chunk(pids)
+    size = len(pids) // workers + 1
+    chunks = [pids[i:i + size] for i in xrange(0, len(pids), size)]
+    res = []
+    for chunk in _get_scan_pool(workers, mode).map(_snapshot_chunk, chunks):
+        res.extend(chunk)
+    return res
+
+def get_process_table(kernel_threads=False, workers=0, mode='threads'):
+    """Return a ProcessTable filled in one sweep over all running
+    processes. Kernel threads (processes without a path) are skipped
+    unless `kernel_threads` is True.
+
+    If `workers` is greater than 1, /proc is scanned in parallel by a pool
+    of that many threads (`mode='threads'`) or processes
+    (`mode='processes'`) and the results are merged into one table.
+    """
+    if workers > 1:
+        snapshots = (ProcessSnapshot(*t) for t in
+                     _scan(get_pid_list(), workers, mode))
+    else:
+        snapshots = snapshot_iter()
+    if not kernel_threads:
+        snapshots = (s for s in snapshots if s.path)
+    return ProcessTable(snapshots)
+
 def cpu_times():
     """Return system CPU times as a CPUTimes object."""
     values = get_system_cpu_times()
@@ -427,5 +704,33 @@ def test():
         else:
             print line
 
+def bench_scan(counts=(250, 1000, 4000, 16000), workers=(0, 2, 4, 8),
+               modes=('threads', 'processes')):
+    """Print the time needed to snapshot `counts` pids serially and with
+    pools of `workers` threads or processes. The pids of this host are
+    repeated as needed to reach the larger counts.
+    """
+    pids = get_pid_list()
+    print "%d cpus, %d pids" % (NUM_CPUS, len(pids))
+    for n in workers:
+        if n > 1 and 'processes' in modes:
+            start_scan_pool(n, 'processes')
+    print "%7s %-10s %7s %10s" % ("PIDS", "MODE", "WORKERS", "SECONDS")
+    for count in counts:
+        sample = (pids * (count // len(pids) + 1))[:count]
+        for mode in modes:
+            for n in workers:
+                if n < 2 and mode != modes[0]:
+                    continue
+                _scan(sample, n, mode) # warm up pools and caches
+                start = time.time()
+                _scan(sample, n, mode)
+                print "%7d %-10s %7d %10.4f" % (count,
+                    n < 2 and 'serial' or mode, n, time.time() - start)
+    stop_scan_pools()
+
 if __name__ == "__main__":
-    test()
+    if sys.argv[1:] == ['bench']:
+        bench_scan()
+    else:
+        test()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""epoll front-end for the bundled wsgiserver.
+
+The stock server hands every accepted connection to a worker thread which
+then blocks in `recv()` until the client sends its next request, so each
+idle keep-alive connection (monitoring pollers keep them open for good)
+pins a thread. `ReactorWSGIServer` instead waits for all connections in one
+epoll loop, running in the thread that used to block in `accept()`:
+
+ - accepted connections and connections returned by a worker after a
+   response are registered with epoll; workers queue the connections they
+   return and wake the loop through a pipe, only the loop thread touches
+   epoll and the table of waiting connections,
+ - their data is read without blocking until a complete request head
+   (or more than `max_request_header_size` bytes) has arrived,
+ - then the connection, with what was read put into its read buffer, is
+   queued for the `ThreadPool` like before.
+
+A worker keeps serving pipelined requests that are already buffered and
+returns the connection to the loop as soon as the buffer is empty. Idle
+connections are closed after `keepalive_timeout` seconds, connections
+with an incomplete head after `timeout` seconds.
+
+On `stop()` the loop is woken up through the pipe and closes epoll, the
+pipe and the waiting connections itself before the listening socket is
+closed and the workers are stopped.
+
+SSL connections are not supported, use the plain `CPWSGIServer` for them.
+"""
+
+import errno, fcntl, os, select, socket, sys, threading, time
+
+import cherrypy as cp
+import instrument
+from cherrypy import _cpwsgi_server
+from cherrypy.wsgiserver import (FatalSSLAlert, NoSSLError, format_exc,
+    prevent_socket_inheritance, socket_errors_nonblocking,
+    socket_errors_to_ignore, socket_error_eintr)
+
+__all__ = ['ReactorWSGIServer', 'available']
+
+available = hasattr(select, 'epoll')
+
+_HEAD_END = ('\r\n\r\n', '\n\n')
+
+
+def _buffered(rfile):
+    """Number of bytes read from the socket but not consumed yet."""
+    buf = rfile._rbuf
+    if isinstance(buf, basestring):
+        return len(buf)
+    buf.seek(0, 2)
+    return buf.tell()
+
+def _prefill(rfile, data):
+    """Put `data` into the read buffer of `rfile`."""
+    if isinstance(rfile._rbuf, basestring):
+        rfile._rbuf += data
+    else:
+        rfile._rbuf.seek(0, 2)
+        rfile._rbuf.write(data)
+
+
+class ReactorHTTPConnection(_cpwsgi_server.CPHTTPConnection):
+    """A connection which goes back to the reactor instead of waiting for
+    the next request on a worker thread."""
+
+    def __init__(self, sock, wsgi_app, environ, server):
+        _cpwsgi_server.CPHTTPConnection.__init__(self, sock, wsgi_app,
+                                                 environ)
+        self.server = server
+        self.head = ''
+        self.since = time.time()
+        self.parked = False
+        self.queued = None
+
+    def communicate(self):
+        """Read each buffered request and respond appropriately, see
+        `HTTPConnection.communicate`."""
+        self.parked = False
+        if self.queued is not None:
+            instrument.record_queue_wait(time.time() - self.queued)
+            self.queued = None
+        req = None
+        try:
+            while True:
+                if not _buffered(self.rfile):
+                    # wait for the next request in the reactor
+                    self.parked = True
+                    return
+                req = None
+                req = self.RequestHandlerClass(self.wfile, self.environ,
+                                               self.wsgi_app)
+                req.parse_request()
+                if not req.ready:
+                    return
+                req.respond()
+                if req.close_connection:
+                    return
+        except socket.error, e:
+            errnum = e.args[0]
+            if errnum == 'timed out':
+                if req and not req.sent_headers:
+                    req.simple_response("408 Request Timeout")
+            elif errnum not in socket_errors_to_ignore:
+                if req and not req.sent_headers:
+                    req.simple_response("500 Internal Server Error",
+                                        format_exc())
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except (FatalSSLAlert, NoSSLError):
+            pass
+        except Exception, e:
+            if req and not req.sent_headers:
+                req.simple_response("500 Internal Server Error", format_exc())
+
+    def close(self):
+        """Hand a parked connection back to the reactor, close all
+        others."""
+        if self.parked and self.server.ready:
+            self.parked = False
+            self.server.park(self)
+        else:
+            _cpwsgi_server.CPHTTPConnection.close(self)
+
+
+class ReactorWSGIServer(_cpwsgi_server.CPWSGIServer):
+    """`CPWSGIServer` with an epoll loop in front of the thread pool."""
+
+    def __init__(self, keepalive_timeout=60):
+        _cpwsgi_server.CPWSGIServer.__init__(self)
+        self.keepalive_timeout = keepalive_timeout
+        self.max_head = cp.server.max_request_header_size or 64 * 1024
+        self._epoll = None
+        self._waiting = {}      # fd -> connection
+        self._parked = []       # connections returned by workers
+        self._wakeup = None     # (read fd, write fd) of the wakeup pipe
+        self._lock = threading.Lock()
+        self._loop = None       # thread running the loop
+        self._closed = threading.Event()
+        self._closed.set()
+        self._expired = 0
+        self.stats = dict.fromkeys(('accepted', 'dispatched', 'parked',
+                                    'expired', 'closed'), 0)
+
+    def waiting(self):
+        """Number of connections waiting in the reactor."""
+        return len(self._waiting)
+
+    def counters(self):
+        """A copy of `stats`."""
+        self._lock.acquire()
+        try:
+            return self.stats.copy()
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def tick(self):
+        """Wait up to one second for events and handle them."""
+        if self._epoll is None:
+            self.socket.setblocking(0)
+            self._epoll = select.epoll()
+            self._listen_fd = self.socket.fileno()
+            self._epoll.register(self._listen_fd, select.EPOLLIN)
+            self._wakeup = os.pipe()
+            for fd in self._wakeup:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._epoll.register(self._wakeup[0], select.EPOLLIN)
+        try:
+            events = self._epoll.poll(1.0)
+        except (IOError, select.error), e:
+            if e.args[0] in socket_error_eintr:
+                return
+            if not self.ready:
+                return
+            raise
+        for fd, event in events:
+            if fd == self._listen_fd:
+                self._accept()
+            elif self._wakeup and fd == self._wakeup[0]:
+                self._unpark()
+            else:
+                self._read(fd, event)
+        now = time.time()
+        if now - self._expired >= 1:
+            self._expire(now)
+            self._expired = now
+
+    def _accept(self):
+        while True:
+            try:
+                s, addr = self.socket.accept()
+            except socket.error, x:
+                if x.args[0] in socket_errors_nonblocking or \
+                   x.args[0] in socket_error_eintr or \
+                   x.args[0] in socket_errors_to_ignore:
+                    return
+                raise
+            prevent_socket_inheritance(s)
+            if not self.ready:
+                s.close()
+                return
+            conn = ReactorHTTPConnection(s, self.wsgi_app,
+                                         self._environ(addr), self)
+            self._count('accepted')
+            self._register(conn)
+
+    def _environ(self, addr):
+        environ = self.environ.copy()
+        if environ.get("SERVER_SOFTWARE") is None:
+            environ["SERVER_SOFTWARE"] = "%s WSGI Server" % self.version
+        environ["ACTUAL_SERVER_PROTOCOL"] = self.protocol
+        environ["SERVER_NAME"] = self.server_name
+        if isinstance(self.bind_addr, basestring):
+            environ["SERVER_PORT"] = ""
+        else:
+            environ["SERVER_PORT"] = str(self.bind_addr[1])
+            environ["REMOTE_ADDR"] = addr[0]
+            environ["REMOTE_PORT"] = str(addr[1])
+        return environ
+
+    def _register(self, conn):
+        conn.socket.setblocking(0)
+        conn.since = time.time()
+        fd = conn.socket.fileno()
+        self._waiting[fd] = conn
+        try:
+            self._epoll.register(fd, select.EPOLLIN)
+        except (IOError, ValueError):
+            self._drop(fd, conn)
+
+    def park(self, conn):
+        """Take back `conn` from a worker, called from the worker thread:
+        queue it and wake up the loop, which registers it."""
+        self._lock.acquire()
+        try:
+            if self.ready and self._wakeup is not None:
+                self._parked.append(conn)
+                self.stats['parked'] += 1
+                self._wake()
+                return
+        finally:
+            self._lock.release()
+        # stopping, nobody would pick it up
+        _cpwsgi_server.CPHTTPConnection.close(conn)
+
+    def _wake(self):
+        # called with self._lock held, the loop closes the pipe under it
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError, e:
+            # a full pipe has a wakeup pending already
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _unpark(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+        self._lock.acquire()
+        try:
+            parked, self._parked = self._parked, []
+        finally:
+            self._lock.release()
+        for conn in parked:
+            self._register(conn)
+
+    def _read(self, fd, event):
+        conn = self._waiting.get(fd)
+        if conn is None:
+            return
+        try:
+            data = conn.socket.recv(8192)
+        except socket.error, e:
+            if e.args[0] in socket_errors_nonblocking or \
+               e.args[0] in socket_error_eintr:
+                return
+            data = ''
+        if not data:
+            self._drop(fd, conn)
+            return
+        conn.head += data
+        if len(conn.head) > self.max_head or \
+           [end for end in _HEAD_END if end in conn.head]:
+            self._unregister(fd)
+            _prefill(conn.rfile, conn.head)
+            conn.head = ''
+            conn.socket.settimeout(self.timeout)
+            self._count('dispatched')
+            conn.queued = time.time()
+            self.requests.put(conn)
+
+    def _unregister(self, fd):
+        self._waiting.pop(fd, None)
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+
+    def _drop(self, fd, conn):
+        self._unregister(fd)
+        self._count('closed')
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+    def _expire(self, now):
+        for fd, conn in self._waiting.items():
+            if conn.head:
+                limit = self.timeout
+            else:
+                limit = self.keepalive_timeout
+            if now - conn.since > limit:
+                self._count('expired')
+                self._drop(fd, conn)
+
+    def start(self):
+        """Run the loop until `stop()`; the loop thread closes epoll, the
+        wakeup pipe and the waiting connections itself on the way out."""
+        self._loop = threading.currentThread()
+        self._closed.clear()
+        try:
+            _cpwsgi_server.CPWSGIServer.start(self)
+        finally:
+            self._close()
+
+    def stop(self):
+        """Stop the loop, wait for it to clean up, then close the
+        listening socket and stop the workers."""
+        self._lock.acquire()
+        try:
+            self.ready = False
+            if self._wakeup is not None:
+                self._wake()
+        finally:
+            self._lock.release()
+        if threading.currentThread() is not self._loop:
+            self._closed.wait(self.shutdown_timeout)
+        _cpwsgi_server.CPWSGIServer.stop(self)
+
+    def _close(self):
+        # in the loop thread, after it has left tick() for good
+        self._lock.acquire()
+        try:
+            parked, self._parked = self._parked, []
+            wakeup, self._wakeup = self._wakeup, None
+        finally:
+            self._lock.release()
+        try:
+            if wakeup is not None:
+                for fd in wakeup:
+                    os.close(fd)
+            for conn in parked:
+                try:
+                    _cpwsgi_server.CPHTTPConnection.close(conn)
+                except socket.error:
+                    pass
+            for fd, conn in self._waiting.items():
+                self._drop(fd, conn)
+            if self._epoll is not None:
+                self._epoll.close()
+                self._epoll = None
+        finally:
+            self._closed.set()
+
+if __name__ == '__main__':
+    # python lib/reactor.py [-n connections] [-p path] host:port pid: open
+    # keep-alive connections to a running agent (pid), send one request on
+    # each and leave them idle, then print the server's threads and memory
+    import getopt
+    opts, args = getopt.getopt(sys.argv[1:], 'n:p:')
+    opts = dict(opts)
+    total = int(opts.get('-n', 500))
+    path = opts.get('-p', '/system/jobs/list')
+    host, port = args[0].split(':')
+    pid = int(args[1])
+
+    def usage(pid):
+        res = {}
+        for line in open('/proc/%d/status' % pid):
+            key, value = line.split(':', 1)
+            if key in ('VmRSS', 'Threads'):
+                res[key] = value.strip()
+        return "threads %(Threads)4s  rss %(VmRSS)10s" % res
+
+    request = ("GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (path, host))
+    conns = []
+    print "%6d connections  %s" % (0, usage(pid))
+    step = max(1, total // 5)
+    start = time.time()
+    for i in xrange(total):
+        s = socket.create_connection((host, int(port)))
+        s.sendall(request)
+        s.settimeout(30)
+        data = s.recv(65536)
+        if not data.startswith('HTTP/1.1 200'):
+            print >>sys.stderr, "unexpected answer:", data[:40]
+        conns.append(s)
+        if (i + 1) % step == 0:
+            time.sleep(2)   # let the pool controller react
+            print "%6d connections  %s" % (i + 1, usage(pid))
+    print "%.1f s" % (time.time() - start)
+    for s in conns:
+        s.close()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Response cache for the agent's polled endpoints.
+
+cherrypy's `MemoryCache` scans all expirations every 0.1 s in a thread of
+its own, has one limit for everything and no idea which pages may be
+cached for how long. `ResponseCache` instead
+
+ - caches only routes with a TTL (`ttl.<route> = seconds` in the [cache]
+   section of systrac.ini, or `default_ttl`), the route being the path
+   without the positional arguments of the handler as in /monitoring/self,
+ - keys entries on path and query string and spreads them over `shards`
+   dicts with a lock each, so no lock is held over the whole cache (with
+   the GIL this doesn't make lookups faster: counting hits and checking
+   the expiry make one about 1.2 to 1.5 times as expensive as a lookup in
+   a bare locked dict, see `python lib/respcache.py`),
+ - keeps a heap of expiry times per shard: expired entries are dropped
+   from the top of the heap when something is stored, and the entries
+   closest to expiry make room when a shard is full; nothing scans,
+ - sends an `ETag` made from the md5 of the body and answers a matching
+   `If-None-Match` with 304.
+
+A hit is answered in the `before_handler` hook, the page handler is not
+called. Streamed bodies (/etc/munin/plugins) are stored once they have
+been sent, so their ETag is only sent from the second request on.
+
+Requests with another method than GET or HEAD drop the cached entries
+below the parent of their route (a POST to /etc/munin/plugin/foo drops
+/etc/munin/plugins); handlers changing state on GET call `invalidate()`.
+A client can skip the cache with `Cache-Control: no-cache`.
+"""
+
+import heapq, threading, time
+from hashlib import md5
+
+import cherrypy as cp
+from cherrypy.lib import http
+import instrument
+
+__all__ = ['ResponseCache', 'invalidate', 'invalidator']
+
+_SKIP_HEADERS = ('Date', 'Content-Length', 'Age', 'ETag')
+_STATS = ('hits', 'misses', 'not_modified', 'stored', 'expired', 'evicted',
+          'invalidated')
+
+
+class _Shard(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = {}       # key -> (expires, created, status, headers,
+                                #         body, etag)
+        self.heap = []          # (expires, key), possibly outdated
+        self.stats = dict.fromkeys(_STATS, 0)
+
+    def _pop(self):
+        """Remove the entry at the top of the heap, if still current.
+        Returns the expiry time it had."""
+        expires, key = heapq.heappop(self.heap)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == expires:
+            del self.entries[key]
+            return expires
+        return None
+
+    def put(self, key, entry, now):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            if self._pop() is not None:
+                self.stats['expired'] += 1
+        self.entries[key] = entry
+        heapq.heappush(heap, (entry[0], key))
+        while len(self.entries) > self.size:
+            if self._pop() is not None:
+                self.stats['evicted'] += 1
+        if len(heap) > 2 * self.size:
+            # drop the outdated items left by invalidate() and overwrites
+            self.heap = [(e[0], k) for k, e in self.entries.iteritems()]
+            heapq.heapify(self.heap)
+        self.stats['stored'] += 1
+
+
+class ResponseCache(object):
+    """Cache of whole responses, enabled with `config()`.
+
+    `ttls` maps routes to seconds, routes without an entry are cached for
+    `default_ttl` seconds (not at all if 0). `max_entries` is shared evenly
+    by the shards.
+    """
+
+    def __init__(self, ttls=None, default_ttl=0, shards=16, max_entries=1000):
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        size = max(1, max_entries // max(1, shards))
+        self.shards = [_Shard(size) for i in xrange(max(1, shards))]
+
+    def config(self):
+        """The cherrypy config enabling the cache tool, to be merged into
+        the application config."""
+        return {'tools.response_cache.on': True,
+                'tools.response_cache.cache': self}
+
+    def ttl(self, route):
+        return self.ttls.get(route, self.default_ttl)
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key, now=None):
+        """The entry for `key` or None, counting hits and misses. `now`
+        saves the clock lookup, the request's start time will do."""
+        shard = self.shards[hash(key) % len(self.shards)]
+        if now is None:
+            now = time.time()
+        shard.lock.acquire()
+        try:
+            entry = shard.entries.get(key)
+            if entry is None or entry[0] <= now:
+                shard.stats['misses'] += 1
+                return None
+            shard.stats['hits'] += 1
+            return entry
+        finally:
+            shard.lock.release()
+
+    def put(self, key, ttl, status, headers, body, now=None):
+        """Store a response for `ttl` seconds, returns its ETag."""
+        now = now or time.time()
+        etag = '"%s"' % md5(body).hexdigest()
+        entry = (now + ttl, now, status, headers, body, etag)
+        shard = self._shard(key)
+        shard.lock.acquire()
+        try:
+            shard.put(key, entry, now)
+        finally:
+            shard.lock.release()
+        return etag
+
+    def invalidate(self, prefix):
+        """Drop all entries whose key starts with `prefix`."""
+        for shard in self.shards:
+            shard.lock.acquire()
+            try:
+                keys = [k for k in shard.entries if k.startswith(prefix)]
+                for key in keys:
+                    del shard.entries[key]
+                shard.stats['invalidated'] += len(keys)
+            finally:
+                shard.lock.release()
+
+    def _count(self, key, name):
+        shard = self._shard(key)
+        shard.lock.acquire()
+        try:
+            shard.stats[name] += 1
+        finally:
+            shard.lock.release()
+
+    def stats(self):
+        """Counters of all shards, the number of entries and their size."""
+        res = dict.fromkeys(_STATS, 0)
+        res.update(entries=0, bytes=0, shards=len(self.shards))
+        for shard in self.shards:
+            shard.lock.acquire()
+            try:
+                for name, n in shard.stats.iteritems():
+                    res[name] += n
+                res['entries'] += len(shard.entries)
+                res['bytes'] += sum([len(e[4])
+                                     for e in shard.entries.itervalues()])
+            finally:
+                shard.lock.release()
+        return res
+
+
+def _parent(route):
+    return route.rstrip('/').rsplit('/', 1)[0] + '/'
+
+def _key():
+    request = cp.request
+    path = request.path_info
+    if request.query_string:
+        path += '?' + request.query_string
+    return path
+
+def _matches(header, etag):
+    """Whether the If-None-Match `header` lists `etag`."""
+    if header is None:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+def _not_modified(response):
+    response.status = 304
+    response.body = ''
+
+def _lookup(cache):
+    """Answer the request from `cache` or have the response stored."""
+    request = cp.request
+    if request.method not in ('GET', 'HEAD'):
+        # after the handler, or a concurrent GET could store the old state
+        request.hooks.attach('before_finalize', cache.invalidate,
+                             prefix=_parent(instrument.route()))
+        return
+    ttl = cache.ttl(instrument.route())
+    if ttl <= 0:
+        return
+    key = _key()
+    no_cache = 'no-cache' in request.headers.get('Cache-Control', '') or \
+               request.headers.get('Pragma') == 'no-cache'
+    entry = not no_cache and cache.get(key, cp.response.time)
+    if not entry:
+        if request.method == 'GET':
+            request.hooks.attach('before_finalize', _store, priority=80,
+                                 cache=cache, key=key, ttl=ttl)
+        return
+    expires, created, status, headers, body, etag = entry
+    response = cp.response
+    response.status = status
+    response.headers = rh = http.HeaderMap()
+    for name, value in headers:
+        dict.__setitem__(rh, name, value)
+    rh['ETag'] = etag
+    rh['Age'] = str(int(max(0, response.time - created)))
+    if _matches(request.headers.get('If-None-Match'), etag):
+        cache._count(key, 'not_modified')
+        _not_modified(response)
+    else:
+        response.body = body
+    request.handler = None
+
+def _store(cache, key, ttl):
+    response = cp.response
+    status = http.valid_status(response.status)[0]
+    if status != 200 or response.headers.get('Pragma') == 'no-cache':
+        return
+    headers = [(k, v) for k, v in response.headers.iteritems()
+               if k not in _SKIP_HEADERS]
+    if response.stream:
+        response.body = _tee(response.body, cache, key, ttl, status, headers)
+        return
+    body = response.collapse_body()
+    if not isinstance(body, str):
+        return
+    etag = cache.put(key, ttl, status, headers, body)
+    response.headers['ETag'] = etag
+    if _matches(cp.request.headers.get('If-None-Match'), etag):
+        cache._count(key, 'not_modified')
+        _not_modified(response)
+
+def _tee(body, cache, key, ttl, status, headers):
+    output = []
+    for chunk in body:
+        output.append(chunk)
+        yield chunk
+    # only complete bodies of plain strings are stored
+    if not [c for c in output if not isinstance(c, str)]:
+        cache.put(key, ttl, status, headers, ''.join(output))
+
+cp.tools.response_cache = cp.Tool('before_handler', _lookup, priority=20)
+
+
+def invalidate(prefix=None):
+    """Drop the cached responses below `prefix`, by default below the
+    parent of the current request's route: a handler for
+    /system/services/start calls it to drop /system/services/list."""
+    invalidator(prefix)()
+
+def invalidator(prefix=None):
+    """Return a function doing what `invalidate(prefix)` would do now, to
+    be called later from any thread, e.g. by a job the request started
+    once it is done."""
+    conf = cp.request.toolmaps.get('tools', {}).get('response_cache', {})
+    cache = conf.get('cache')
+    if not conf.get('on') or cache is None:
+        return lambda: None
+    if prefix is None:
+        prefix = _parent(instrument.route())
+    return lambda: cache.invalidate(prefix)
+
+
+if __name__ == '__main__':
+    # python lib/respcache.py [-t threads] [-n lookups]: time lookups of
+    # 100 hot keys from several threads against a single locked dict with
+    # MemoryCache's full expiration scan and against the sharded cache
+    import getopt, sys
+    opts, args = getopt.getopt(sys.argv[1:], 't:n:')
+    opts = dict(opts)
+    threads = int(opts.get('-t', 8))
+    lookups = int(opts.get('-n', 100000))
+    keys = ['/system/services/list?n=%d' % i for i in xrange(100)]
+    body = 'x' * 4096
+
+    class Scanned(object):
+        """One dict and one lock, expired by scanning every 0.1 s."""
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.entries = {}
+            self.running = True
+            t = threading.Thread(target=self.expire)
+            t.setDaemon(True)
+            t.start()
+        def expire(self):
+            while self.running:
+                now = time.time()
+                self.lock.acquire()
+                try:
+                    for key, entry in self.entries.items():
+                        if entry[0] <= now:
+                            del self.entries[key]
+                finally:
+                    self.lock.release()
+                time.sleep(0.1)
+        def get(self, key, now=None):
+            self.lock.acquire()
+            try:
+                return self.entries.get(key)
+            finally:
+                self.lock.release()
+        def put(self, key, ttl, status, headers, body):
+            self.lock.acquire()
+            try:
+                self.entries[key] = (time.time() + ttl, status, headers, body)
+            finally:
+                self.lock.release()
+
+    def run(cache):
+        for key in keys:
+            cache.put(key, 600, '200 OK', [], body)
+        def client(offset):
+            get = cache.get
+            now = time.time()   # as _lookup passes the request's start
+            for i in xrange(lookups):
+                get(keys[(offset + i) % len(keys)], now)
+        workers = [threading.Thread(target=client, args=(i,))
+                   for i in xrange(threads)]
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.time() - start
+        return threads * lookups / elapsed, elapsed
+
+    scanned = Scanned()
+    print "%d threads, %d lookups each" % (threads, lookups)
+    print "single lock, scan:  %9.0f lookups/s (%.2f s)" % run(scanned)
+    scanned.running = False
+    print "sharded, heap:      %9.0f lookups/s (%.2f s)" % run(
+        ResponseCache(default_ttl=600))
+
+    # expiry cost: store 100000 short lived entries, time the puts
+    cache = ResponseCache(shards=16, max_entries=10000)
+    start = time.time()
+    for i in xrange(100000):
+        cache.put('/k/%d' % i, 0.001, '200 OK', [], body)
+    print "100000 puts with expiry and eviction: %.2f s, %r" % (
+        time.time() - start, cache.stats())
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Precompiled request routing.
+
+cherrypy's default `Dispatcher` walks the object tree with `getattr` on
+every request and collects the `_cp_config` of each node on the way. The
+component tree of the agent is built once at startup (providers are
+attached with `setattr` in the `__init__` of the base modules) and never
+changes afterwards, so `RoutingDispatcher` walks it once, on the first
+request, and keeps
+
+ - a flat dict from normalized path to `(handler, config, is_index)` for
+   all paths naming an exposed method or a node with an `index`, and
+ - a trie of the exposed nodes for paths with trailing positional
+   arguments (`/system/processes/info/<pid>`) and `default` handlers.
+
+Lookups follow the rules of the default dispatcher: the deepest matching
+node wins, a `default` method is preferred over the node itself and
+remaining path atoms are passed as positional arguments.
+"""
+
+import threading
+
+import cherrypy as cp
+from cherrypy._cpdispatch import LateParamPageHandler
+
+__all__ = ['RoutingDispatcher', 'compile_routes']
+
+
+class Route(object):
+    """A node of the routing trie."""
+    __slots__ = ['children', 'obj', 'conf', 'target', 'is_default']
+
+    def __init__(self, obj, conf):
+        self.children = {}
+        self.obj = obj
+        self.conf = conf
+        # the handler for requests ending here or below
+        self.target = None
+        self.is_default = False
+        defhandler = getattr(obj, 'default', None)
+        if defhandler is not None and getattr(defhandler, 'exposed', False):
+            self.target = defhandler
+            self.is_default = True
+        elif getattr(obj, 'exposed', False):
+            self.target = obj
+
+
+def _exposed_attributes(obj):
+    """Yield `(name, value)` for the exposed attributes of `obj` without
+    triggering properties (like extension points) or option descriptors."""
+    seen = set()
+    for name, value in getattr(obj, '__dict__', {}).items():
+        if getattr(value, 'exposed', False):
+            seen.add(name)
+            yield name, value
+    for klass in type(obj).__mro__:
+        for name, value in klass.__dict__.items():
+            if name in seen or isinstance(value, property) or \
+               not getattr(value, 'exposed', False):
+                continue
+            seen.add(name)
+            yield name, getattr(obj, name)
+
+
+def compile_routes(root, app_config):
+    """Walk the tree below `root` once and return `(trie, exact)`.
+
+    `exact` maps the path without leading and trailing slashes (and with
+    '.' replaced by '_', like the default dispatcher does) to
+    `(handler, config, is_index)`.
+    """
+    conf = {}
+    conf.update(getattr(root, '_cp_config', {}))
+    conf.update(app_config.get('/', {}))
+    trie = Route(root, conf)
+    exact = {}
+    stack = [(trie, '', set([id(root)]))]
+    while stack:
+        node, path, parents = stack.pop()
+        for name, value in _exposed_attributes(node.obj):
+            curpath = path + '/' + name
+            conf = node.conf.copy()
+            conf.update(getattr(value, '_cp_config', {}))
+            conf.update(app_config.get(curpath, {}))
+            child = node.children[name] = Route(value, conf)
+            if name == 'index':
+                if not child.is_default and child.target is not None:
+                    exact[path.strip('/')] = (child.target, conf, True)
+            elif id(value) not in parents:
+                if not child.is_default and child.target is not None and \
+                   not hasattr(value, 'index'):
+                    exact[curpath.strip('/')] = (child.target, conf, False)
+                stack.append((child, curpath, parents | set([id(value)])))
+    return trie, exact
+
+
+class RoutingDispatcher(object):
+    """Drop-in replacement for `cherrypy.dispatch.Dispatcher` using
+    precompiled routes.
+
+    The tree is compiled on the first request of each application; call
+    `reset()` after changing the tree.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def reset(self):
+        self._routes = {}
+
+    def __call__(self, path_info):
+        """Set handler and config for the current request."""
+        request = cp.request
+        func, vpath = self.find_handler(path_info)
+        if func:
+            # Decode any leftover %2F in the virtual_path atoms.
+            vpath = [x.replace("%2F", "/") for x in vpath]
+            request.handler = LateParamPageHandler(func, *vpath)
+        else:
+            request.handler = cp.NotFound()
+
+    def _get_routes(self, app):
+        routes = self._routes.get(app)
+        if routes is None:
+            self._lock.acquire()
+            try:
+                routes = self._routes.get(app)
+                if routes is None:
+                    routes = self._routes[app] = compile_routes(app.root,
+                                                                app.config)
+            finally:
+                self._lock.release()
+        return routes
+
+    def find_handler(self, path):
+        """Return the page handler and the virtual path for `path` and set
+        `request.config`, see `cherrypy.dispatch.Dispatcher.find_handler`.
+        """
+        request = cp.request
+        app = request.app
+        trie, exact = self._get_routes(app)
+
+        key = path.strip('/')
+        hit = exact.get(key.replace('.', '_'))
+        if hit is not None:
+            handler, conf, is_index = hit
+            base = cp.config.copy()
+            base.update(conf)
+            request.config = base
+            request.is_index = is_index
+            return handler, []
+
+        names = [x for x in key.split('/') if x]
+        trail = [trie]
+        node = trie
+        for name in names:
+            node = node.children.get(name.replace('.', '_'))
+            if node is None:
+                break
+            trail.append(node)
+
+        # config for path atoms below the deepest node, if any
+        conf = trail[-1].conf
+        if len(app.config) > 1:
+            curpath = '/' + '/'.join(names[:len(trail) - 1])
+            for name in names[len(trail) - 1:]:
+                curpath = curpath.rstrip('/') + '/' + name
+                if curpath in app.config:
+                    conf = conf.copy()
+                    conf.update(app.config[curpath])
+
+        for i in xrange(len(trail) - 1, -1, -1):
+            route = trail[i]
+            if route.target is None:
+                continue
+            base = cp.config.copy()
+            base.update(conf)
+            if route.is_default:
+                base.update(getattr(route.target, '_cp_config', {}))
+                request.config = base
+                request.is_index = path.endswith('/')
+            else:
+                request.config = base
+                request.is_index = False
+            return route.target, names[i:]
+
+        base = cp.config.copy()
+        base.update(conf)
+        request.config = base
+        return None, []
+
+
+if __name__ == '__main__':
+    # compare the dispatch cost of both dispatchers for deep paths
+    import time
+    from cherrypy._cpdispatch import Dispatcher
+    from cherrypy._cprequest import Request, Response
+
+    class Node(object):
+        exposed = True
+
+        def index(self):
+            return 'index'
+        index.exposed = True
+
+        def info(self, *args):
+            return 'info'
+        info.exposed = True
+
+    root = Node()
+    node = root
+    for i in range(8):
+        child = Node()
+        setattr(node, 'level%d' % i, child)
+        node = child
+
+    app = cp.Application(root, config={'/': {}})
+    request = Request(None, None)
+    request.app = app
+    cp.serving.load(request, Response())
+
+    deep = '/' + '/'.join(['level%d' % i for i in range(8)])
+    paths = ['/', deep + '/', deep + '/info', deep + '/info/1234/5678']
+    rounds = 20000
+    for path in paths:
+        for dispatcher in (Dispatcher(), RoutingDispatcher()):
+            start = time.time()
+            for i in xrange(rounds):
+                dispatcher.find_handler(path)
+            elapsed = time.time() - start
+            print "%-18s %-62s %6.2f usec" % (dispatcher.__class__.__name__,
+                                             path, elapsed / rounds * 1e6)
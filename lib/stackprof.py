@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Sampling profiler producing folded stacks for flame graphs.
+
+`StackSampler` runs a thread which looks at the stacks of all other
+threads (`sys._current_frames()`) `hz` times per second for `seconds`
+seconds. Stacks are counted as tuples of code objects, formatting them
+only happens in `folded()`, which returns one line per distinct stack in
+the collapsed format understood by flamegraph.pl and speedscope:
+
+    CP WSGIServer Thread-N;run (threading.py:...);...;leaf (x.py:12) 42
+
+Thread names have their numbers replaced by N so the stacks of all
+workers of a pool are added up.
+"""
+
+import os, re, sys, threading, time
+
+__all__ = ['StackSampler']
+
+_DIGITS = re.compile(r'\d+')
+
+
+def _thread_names():
+    return dict([(t.ident, _DIGITS.sub('N', t.getName()))
+                 for t in threading.enumerate()])
+
+def _label(code):
+    path = code.co_filename.split(os.sep)
+    return '%s (%s:%d)' % (code.co_name, '/'.join(path[-2:]),
+                           code.co_firstlineno)
+
+
+class StackSampler(object):
+
+    def __init__(self, hz=100, seconds=30):
+        self.hz = hz
+        self.seconds = seconds
+        self.stacks = {}        # (thread name, code, code, ...) -> count
+        self.samples = 0
+        self.started = self.stopped = None
+        self.elapsed = 0.0      # time spent sampling
+        self._stop = threading.Event()
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run,
+                                        name='StackSampler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and \
+           self._thread is not threading.currentThread():
+            self._thread.join()
+
+    def _run(self):
+        interval = 1.0 / self.hz
+        own = threading.currentThread().ident
+        deadline = self.started + self.seconds
+        names = {}
+        try:
+            while not self._stop.isSet():
+                start = time.time()
+                if start >= deadline:
+                    break
+                self.sample(own, names)
+                spent = time.time() - start
+                self.elapsed += spent
+                self._stop.wait(max(0, interval - spent))
+        finally:
+            self.stopped = time.time()
+
+    def sample(self, own=None, names=None):
+        """Count the current stack of every thread but `own`. `names`
+        caches the thread names by id between calls."""
+        if names is None:
+            names = {}
+        stacks = self.stacks
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = names.get(ident)
+            if name is None:
+                # a thread started since the last sample
+                names.update(_thread_names())
+                name = names.setdefault(ident, 'thread')
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.append(name)
+            stack.reverse()
+            stack = tuple(stack)
+            stacks[stack] = stacks.get(stack, 0) + 1
+        frame = None
+        self.samples += 1
+
+    def state(self):
+        return {'running': self.running(), 'hz': self.hz,
+                'seconds': self.seconds, 'samples': self.samples,
+                'stacks': len(self.stacks), 'started': self.started,
+                'stopped': self.stopped,
+                # share of one cpu used by the sampling thread
+                'overhead': self.elapsed / max(
+                    (self.stopped or time.time()) - (self.started or 0), 1e-6)}
+
+    def folded(self):
+        """The collected stacks, one `frame;frame;... count` line each."""
+        lines = []
+        for stack, count in self.stacks.items():
+            frames = [stack[0]] + [_label(code) for code in stack[1:]]
+            lines.append('%s %d' % (';'.join(frames), count))
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    # python lib/stackprof.py [hz]: run a busy loop on 8 threads without
+    # and with sampling and print the slowdown
+    hz = int((sys.argv[1:] or [100])[0])
+
+    def work(n=1000000):
+        total = 0
+        for i in xrange(n):
+            total += len(str(i))
+        return total
+
+    def run():
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return time.time() - start
+
+    # cost of one sample with 40 idle threads, like a grown server pool
+    import Queue
+    queue = Queue.Queue()
+    idle = [threading.Thread(target=queue.get) for i in xrange(40)]
+    for t in idle:
+        t.setDaemon(True)
+        t.start()
+    sampler = StackSampler()
+    names = {}
+    start = time.time()
+    for i in xrange(1000):
+        sampler.sample(None, names)
+    cost = (time.time() - start) / 1000
+    print "%.3f ms per sample of %d threads, %.2f%% of a cpu at %d Hz" % (
+        cost * 1000, threading.activeCount(), cost * hz * 100, hz)
+    for t in idle:
+        queue.put(None)
+
+    # alternate the runs so both see the same machine
+    base, sampled = [], []
+    for i in xrange(4):
+        base.append(run())
+        sampler = StackSampler(hz, 60)
+        sampler.start()
+        sampled.append(run())
+        sampler.stop()
+    print "8 busy threads: without %.3f s, with %d Hz %.3f s: %+.1f%%" % (
+        min(base), hz, min(sampled), (min(sampled) / min(base) - 1) * 100)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""In-process index of the apt package lists and the dpkg status file.
+
+Each `*_Packages` file in the apt lists directory and the dpkg status file
+are mmap()ed and scanned once for their stanzas. Per file the index keeps
+the package names, the offsets of their stanzas and postings from the
+lower-cased words of the name and short description to the stanzas. The
+words are also joined into one string, so a search term is found inside
+words (`ssl` in `openssl`) with `str.find` instead of a Python loop. Full
+stanzas are only parsed when `info()` asks for one, straight from the
+mapped file.
+
+`refresh()` stat()s the files (at most every `check_interval` seconds)
+and only rescans the ones that were added, replaced or modified, so an
+`apt-get update` touching one list doesn't rebuild everything.
+"""
+
+import mmap, os, re, threading, time
+from array import array
+from bisect import bisect_right
+from glob import glob
+
+__all__ = ['AptIndex', 'parse_stanza', 'parse_stanzas', 'iter_stanzas']
+
+_WORDS = re.compile(r'[a-z0-9]+')
+
+
+def parse_stanza(text):
+    """Parse one RFC822-style stanza into a dict. Continuation lines are
+    appended to the value with a newline, like dpkg prints them."""
+    fields = {}
+    key = None
+    for line in text.split('\n'):
+        if not line:
+            continue
+        if line[0] in ' \t':
+            if key is not None:
+                fields[key] += '\n' + line[1:]
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            key = None
+            continue
+        fields[key] = value.strip()
+    return fields
+
+def iter_stanzas(data):
+    """Yield `(offset, length)` of each stanza in `data` (a string or
+    mmap), stanzas are separated by empty lines."""
+    start = 0
+    size = len(data)
+    while start < size:
+        # skip blank lines between stanzas
+        while start < size and data[start] == '\n':
+            start += 1
+        if start >= size:
+            break
+        end = data.find('\n\n', start)
+        if end < 0:
+            end = size
+        yield start, end - start
+        start = end + 2
+
+def parse_stanzas(data):
+    """Yield the stanzas in `data` (e.g. the output of `dpkg -s a b c`) as
+    dicts, see `parse_stanza`."""
+    for offset, length in iter_stanzas(data):
+        yield parse_stanza(data[offset:offset + length])
+
+def _tokens(text):
+    return _WORDS.findall(text.lower())
+
+
+class _IndexedFile(object):
+    """The index of one Packages/status file."""
+
+    def __init__(self, path, installed_only=False):
+        self.path = path
+        self.sig = None
+        self.map = None
+        self.names = []
+        self.descs = []
+        self.offsets = array('L')
+        self.lengths = array('L')
+        self.byname = {}
+        self.postings = {}
+        self.tokens = []
+        self.words = '\n'
+        self.starts = array('L')
+        self.installed_only = installed_only
+
+    def load(self, sig):
+        fileobj = open(self.path, 'rb')
+        try:
+            if sig[1]:
+                data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = ''
+        finally:
+            fileobj.close()
+        names, descs = [], []
+        offsets, lengths = array('L'), array('L')
+        byname, postings = {}, {}
+        for offset, length in iter_stanzas(data):
+            name = desc = status = None
+            # only look at the fields the index needs
+            pos, end = offset, offset + length
+            while pos < end and (name is None or desc is None or
+                                 (self.installed_only and status is None)):
+                eol = data.find('\n', pos, end)
+                if eol < 0:
+                    eol = end
+                if data[pos] not in ' \t':
+                    line = data[pos:eol]
+                    if line.startswith('Package:'):
+                        name = line[8:].strip()
+                    elif line.startswith('Description:'):
+                        desc = line[12:].strip()
+                    elif line.startswith('Status:'):
+                        status = line[7:].strip()
+                pos = eol + 1
+            if not name:
+                continue
+            if self.installed_only and not (status or '').endswith(
+                                                        ' installed'):
+                continue
+            row = len(names)
+            names.append(name)
+            descs.append(desc or '')
+            offsets.append(offset)
+            lengths.append(length)
+            byname.setdefault(name, []).append(row)
+            words = set(_tokens(desc or ''))
+            words.update(_tokens(name))
+            words.add(name.lower())
+            for word in words:
+                rows = postings.get(word)
+                if rows is None:
+                    rows = postings[word] = array('L')
+                rows.append(row)
+        (self.map, self.names, self.descs, self.offsets, self.lengths,
+         self.byname, self.postings) = (data, names, descs, offsets, lengths,
+                                        byname, postings)
+        tokens = sorted(postings)
+        # '\n' + token + '\n' + token ..., starts[i] is where tokens[i] is
+        starts = array('L')
+        pos = 1
+        for token in tokens:
+            starts.append(pos)
+            pos += len(token) + 1
+        self.tokens, self.starts = tokens, starts
+        self.words = '\n' + '\n'.join(tokens) + '\n'
+        self.sig = sig
+
+    def match(self, term):
+        """Rows with a word containing `term`."""
+        rows = set()
+        words, starts, tokens = self.words, self.starts, self.tokens
+        pos = words.find(term)
+        while pos >= 0:
+            i = bisect_right(starts, pos) - 1
+            rows.update(self.postings[tokens[i]])
+            # continue after this word
+            pos = words.find(term, starts[i] + len(tokens[i]))
+        return rows
+
+    def stanza(self, row):
+        offset = self.offsets[row]
+        return self.map[offset:offset + self.lengths[row]]
+
+
+class AptIndex(object):
+    """Searchable index over `status_file` and the `*_Packages` files in
+    `lists_dir`. Entries from the status file (installed packages) take
+    precedence over the lists."""
+
+    def __init__(self, status_file='/var/lib/dpkg/status',
+                 lists_dir='/var/lib/apt/lists', check_interval=10):
+        self.status_file = status_file
+        self.lists_dir = lists_dir
+        self.check_interval = check_interval
+        self._files = {}
+        self._order = []
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names())
+
+    def sources(self):
+        paths = []
+        if self.status_file and os.path.isfile(self.status_file):
+            paths.append(self.status_file)
+        if self.lists_dir:
+            paths.extend(sorted(glob(os.path.join(self.lists_dir,
+                                                  '*_Packages'))))
+        return paths
+
+    def refresh(self, force=False):
+        """Rescan the files that changed since the last call, at most every
+        `check_interval` seconds unless `force` is set. Returns the paths
+        that were (re)loaded."""
+        now = time.time()
+        if not force and now - self._checked < self.check_interval:
+            return []
+        self._lock.acquire()
+        try:
+            if not force and now - self._checked < self.check_interval:
+                return []
+            loaded = []
+            files = {}
+            order = []
+            for path in self.sources():
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                sig = (st.st_ino, st.st_size, st.st_mtime)
+                indexed = self._files.get(path)
+                if indexed is None or indexed.sig != sig:
+                    indexed = _IndexedFile(path,
+                                           path == self.status_file)
+                    indexed.load(sig)
+                    loaded.append(path)
+                files[path] = indexed
+                order.append(indexed)
+            # swap in the new state, readers use either the old or the new
+            # one. Replaced maps are closed by the garbage collector once the
+            # last reader is done with them.
+            self._order = order
+            self._files = files
+            self._checked = time.time()
+            return loaded
+        finally:
+            self._lock.release()
+
+    def _names(self):
+        names = set()
+        for indexed in self._order:
+            names.update(indexed.byname)
+        return names
+
+    def search(self, query, limit=None):
+        """Return `[{'name': ..., 'desc': ...}]` for all packages where each
+        word of `query` is part of the name or a word of the short
+        description, like `apt-cache search X | grep X`, sorted by name."""
+        self.refresh()
+        terms = _tokens(query)
+        if not terms:
+            return []
+        found = {}
+        for indexed in self._order:
+            rows = None
+            for term in terms:
+                matches = indexed.match(term)
+                if rows is None:
+                    rows = matches
+                else:
+                    rows &= matches
+                if not rows:
+                    break
+            for row in rows or ():
+                name = indexed.names[row]
+                if name not in found:
+                    found[name] = indexed.descs[row]
+        res = [{'name': name, 'desc': found[name]} for name in sorted(found)]
+        if limit:
+            res = res[:limit]
+        return res
+
+    def stanza(self, name):
+        """The raw stanza for package `name` or None."""
+        self.refresh()
+        for indexed in self._order:
+            rows = indexed.byname.get(name)
+            if rows:
+                return indexed.stanza(rows[0])
+        return None
+
+    def info(self, name):
+        """All fields of package `name` as a dict, or None."""
+        stanza = self.stanza(name)
+        if stanza is None:
+            return None
+        return parse_stanza(stanza)
+
+    def installed(self, fields=None):
+        """Yield a dict for each installed package, restricted to `fields`
+        if given. Stanzas are parsed one at a time."""
+        self.refresh()
+        status = self._files.get(self.status_file)
+        if status is None:
+            return
+        for row in xrange(len(status.names)):
+            info = parse_stanza(status.stanza(row))
+            if fields:
+                info = dict([(f, info.get(f)) for f in fields])
+            yield info
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['bench']:
+        # python aptindex.py bench [query...]: time building the index of
+        # this host and searching it
+        index = AptIndex()
+        start = time.time()
+        index.refresh(force=True)
+        print "indexed %d packages from %d files in %.1f ms" % (
+            len(index), len(index._order), (time.time() - start) * 1000)
+        for query in sys.argv[2:] or ['lib', 'python', 'zlib']:
+            start = time.time()
+            for i in xrange(100):
+                res = index.search(query)
+            print "search %-10s %5d results %8.3f ms" % (
+                query, len(res), (time.time() - start) * 10)
+        sys.exit(0)
+
+    import shutil, tempfile, unittest
+
+    STATUS = """Package: foo
+Status: install ok installed
+Version: 1.0
+Description: the foo tool
+ Does foo things.
+ .
+ And more.
+
+Package: removed
+Status: deinstall ok config-files
+Description: gone
+
+"""
+    PACKAGES = """Package: foo
+Version: 1.1
+Description: the foo tool
+
+Package: libbar2
+Version: 2.0
+Description: Bar library - runtime files
+
+Package: libbar-dev
+Version: 2.0
+Description: bar library - development files
+
+Package: foobar
+Version: 0.1
+Description: unrelated tool
+"""
+
+    class TestAptIndex(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.status = os.path.join(self.dir, 'status')
+            self.lists = os.path.join(self.dir, 'lists')
+            os.mkdir(self.lists)
+            self.write(self.status, STATUS)
+            self.write(os.path.join(self.lists, 'x_main_Packages'), PACKAGES)
+            self.index = AptIndex(self.status, self.lists, check_interval=0)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def write(self, path, data):
+            fileobj = open(path, 'w')
+            fileobj.write(data)
+            fileobj.close()
+
+        def test_search(self):
+            self.assertEqual([p['name'] for p in self.index.search('libbar')],
+                             ['libbar-dev', 'libbar2'])
+            self.assertEqual(self.index.search('bar runtime'),
+                             [{'name': 'libbar2',
+                               'desc': 'Bar library - runtime files'}])
+            self.assertEqual(self.index.search('removed'), [])
+            self.assertEqual(self.index.search('nothere'), [])
+
+        def test_search_inside_words(self):
+            self.assertEqual([p['name'] for p in self.index.search('bar')],
+                             ['foobar', 'libbar-dev', 'libbar2'])
+            self.assertEqual([p['name'] for p in self.index.search('oba')],
+                             ['foobar'])
+            self.assertEqual([p['name'] for p in self.index.search('ibrar')],
+                             ['libbar-dev', 'libbar2'])
+            self.assertEqual([p['name'] for p in self.index.search('r2')],
+                             ['libbar2'])
+
+        def test_info(self):
+            info = self.index.info('foo')
+            self.assertEqual(info['Version'], '1.0')
+            self.assertEqual(info['Description'],
+                             'the foo tool\nDoes foo things.\n.\nAnd more.')
+            self.assertEqual(self.index.info('libbar2')['Version'], '2.0')
+            self.assertEqual(self.index.info('nothere'), None)
+
+        def test_installed(self):
+            self.assertEqual(list(self.index.installed(['Package', 'Version'])),
+                             [{'Package': 'foo', 'Version': '1.0'}])
+
+        def test_parse(self):
+            stanzas = list(parse_stanzas(PACKAGES))
+            self.assertEqual(len(stanzas), 4)
+            self.assertEqual(stanzas[1],
+                             {'Package': 'libbar2', 'Version': '2.0',
+                              'Description': 'Bar library - runtime files'})
+            self.assertEqual(parse_stanza('Depends: a (>= 1:2.0)\n')['Depends'],
+                             'a (>= 1:2.0)')
+
+        def test_refresh(self):
+            self.index.refresh()
+            path = os.path.join(self.lists, 'y_main_Packages')
+            self.write(path, "Package: baz\nDescription: baz\n")
+            self.assertEqual(self.index.refresh(), [path])
+            self.assertEqual(len(self.index), 5)
+            self.assertEqual(self.index.refresh(force=True), [])
+
+    unittest.main()
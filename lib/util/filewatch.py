@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Call a function when files change.
+
+On Linux the directories holding the files are watched with inotify(7)
+through ctypes, so nothing is stat()ed until the kernel reports a write,
+rename or delete. Everywhere else (or if inotify is unavailable) the files
+are checked every `interval` seconds. Either way the callback runs in the
+watcher's own daemon thread and has to check for itself whether anything
+relevant changed.
+"""
+
+import os, select, struct, sys, threading
+
+__all__ = ['FileWatcher', 'have_inotify']
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+have_inotify = False
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+        have_inotify = hasattr(_libc, 'inotify_init') and \
+                       hasattr(_libc, 'inotify_add_watch')
+    except (ImportError, OSError):
+        have_inotify = False
+
+
+class FileWatcher(object):
+    """Run `callback()` whenever one of `paths` is written, replaced or
+    removed.
+
+    Editors usually save by writing a new file and renaming it over the old
+    one, so the parent directories are watched rather than the files.
+    """
+
+    def __init__(self, paths, callback, interval=2.0, use_inotify=True):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.callback = callback
+        self.interval = interval
+        self.use_inotify = use_inotify and have_inotify
+        self._stop = threading.Event()
+        self._thread = None
+        self._fd = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.use_inotify:
+            try:
+                self._fd = self._inotify_setup()
+            except OSError:
+                self.use_inotify = False
+        self._stop.clear()
+        if self.use_inotify:
+            target = self._run_inotify
+        else:
+            target = self._run_polling
+        self._thread = threading.Thread(target=target,
+                                        name='FileWatcher')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            if self._thread is not threading.currentThread():
+                self._thread.join(self.interval + 1)
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _notify(self):
+        try:
+            self.callback()
+        except Exception:
+            # never let a broken file kill the watcher thread
+            pass
+
+    # polling
+
+    def _signature(self):
+        sig = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                sig.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _run_polling(self):
+        last = self._signature()
+        while not self._stop.isSet():
+            self._stop.wait(self.interval)
+            current = self._signature()
+            if current != last:
+                last = current
+                self._notify()
+
+    # inotify
+
+    def _inotify_setup(self):
+        import ctypes
+        fd = _libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self._names = {}
+        for path in self.paths:
+            dirname, basename = os.path.split(path)
+            wd = _libc.inotify_add_watch(fd, dirname, IN_MASK)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(),
+                              'inotify_add_watch failed for %s' % dirname)
+            self._names.setdefault(wd, set()).add(basename)
+        return fd
+
+    def _run_inotify(self):
+        fd = self._fd
+        while not self._stop.isSet():
+            # wake up now and then to notice stop()
+            try:
+                ready = select.select([fd], [], [], self.interval)[0]
+            except (select.error, ValueError):
+                return
+            if not ready:
+                continue
+            try:
+                data = os.read(fd, 64 * 1024)
+            except OSError:
+                return
+            changed = False
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if name in self._names.get(wd, ()):
+                    changed = True
+            if changed:
+                self._notify()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Per-module import times, for `main.py --profile-startup`.
+
+`ImportProfiler.install()` wraps `__import__` and `imp.load_source` (used
+by the plugin loader) and records how long each module took to import,
+both in total and without the modules it imported itself.
+"""
+
+import __builtin__
+import imp
+import sys
+import time
+
+__all__ = ['ImportProfiler']
+
+
+class ImportProfiler(object):
+
+    def __init__(self):
+        self.times = {}     # module -> [total, self]
+        self._stack = []
+        self._import = None
+        self._load_source = None
+
+    def install(self):
+        self._import = __builtin__.__import__
+        self._load_source = imp.load_source
+        __builtin__.__import__ = self._wrap(self._import)
+        imp.load_source = self._wrap(self._load_source)
+
+    def uninstall(self):
+        if self._import is not None:
+            __builtin__.__import__ = self._import
+            imp.load_source = self._load_source
+            self._import = self._load_source = None
+
+    def _wrap(self, func):
+        def wrapper(name, *args, **kwargs):
+            if name in sys.modules:
+                return func(name, *args, **kwargs)
+            frame = [name, time.time(), 0.0]
+            self._stack.append(frame)
+            try:
+                return func(name, *args, **kwargs)
+            finally:
+                self._stack.pop()
+                total = time.time() - frame[1]
+                if self._stack:
+                    self._stack[-1][2] += total
+                # relative imports may not be found under `name`, only
+                # count what was actually imported
+                if name in sys.modules and name not in self.times:
+                    self.times[name] = [total, total - frame[2]]
+        return wrapper
+
+    def report(self, out=sys.stdout, limit=30):
+        """Write the `limit` slowest modules (by total time) to `out`."""
+        rows = sorted(self.times.items(), key=lambda i: i[1][0],
+                      reverse=True)
+        toplevel = sum([t[1] for t in self.times.values()])
+        out.write("%-40s %10s %10s\n" % ("MODULE", "TOTAL ms", "SELF ms"))
+        for name, (total, own) in rows[:limit]:
+            out.write("%-40s %10.1f %10.1f\n" % (name, total * 1000,
+                                                 own * 1000))
+        out.write("%-40s %10.1f\n" % ("%d modules" % len(rows),
+                                      toplevel * 1000))
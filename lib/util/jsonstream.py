@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2009 Paul Kölle
+# All rights reserved.
+
+"""Incremental JSON encoding for streamed responses.
+
+`iterencode()` encodes any iterator it finds (generators in particular)
+as a JSON array, one element at a time, so large listings never have to
+be built in memory. Only dicts, lists and tuples holding an iterator are
+walked; everything else is handed to the json module's `dumps`, the
+elements of an iterator in batches of `batch` per call.
+
+Use it together with cherrypy's `response.stream`:
+
+    cp.response.stream = True
+    return iterencode({'status': 200, 'data': (row for row in rows)},
+                      self.json)
+"""
+
+__all__ = ['iterencode']
+
+
+_SCALARS = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+def _is_iterator(obj):
+    return not isinstance(obj, basestring) and hasattr(obj, '__iter__') \
+           and iter(obj) is obj
+
+def _lazy(obj):
+    """Whether `obj` is or holds an iterator."""
+    if isinstance(obj, dict):
+        values = obj.itervalues()
+    elif isinstance(obj, (list, tuple)):
+        values = obj
+    else:
+        return _is_iterator(obj)
+    for value in values:
+        if type(value) not in _SCALARS and _lazy(value):
+            return True
+    return False
+
+def _key(key, dumps):
+    """Encode a dict key, non-strings are converted like json.dumps does."""
+    if not isinstance(key, basestring):
+        if key is None or isinstance(key, bool):
+            key = dumps(key)
+        else:
+            key = str(key)
+    return dumps(key)
+
+def _encode(obj, dumps, batch):
+    if not _lazy(obj):
+        yield dumps(obj)
+    elif isinstance(obj, dict):
+        yield '{'
+        sep = ''
+        for key, value in obj.iteritems():
+            yield '%s%s: ' % (sep, _key(key, dumps))
+            for piece in _encode(value, dumps, batch):
+                yield piece
+            sep = ', '
+        yield '}'
+    else:
+        yield '['
+        sep = ''
+        items = []
+        for item in obj:
+            lazy = type(item) not in _SCALARS and _lazy(item)
+            if not lazy:
+                items.append(item)
+                if len(items) < batch:
+                    continue
+            if items:
+                yield sep + dumps(items)[1:-1]
+                items = []
+                sep = ', '
+            if lazy:
+                yield sep
+                for piece in _encode(item, dumps, batch):
+                    yield piece
+                sep = ', '
+        if items:
+            yield sep + dumps(items)[1:-1]
+        yield ']'
+
+def iterencode(obj, json, chunk_size=8192, batch=100):
+    """Yield the JSON representation of `obj` in chunks of roughly
+    `chunk_size` bytes, encoding iterators as arrays on the fly.
+
+    `json` is the module (or any object with a `dumps` function) used to
+    encode everything that doesn't hold an iterator, up to `batch`
+    elements of an iterator at a time.
+    """
+    buf = []
+    size = 0
+    for piece in _encode(obj, json.dumps, batch):
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
@@ -1,45 +1,135 @@
 import copy
-        
+
 class Node(object):
-    _instances = []
-    
-    def __new__(cls, *args, **kw):
-        self = super(Node, cls).__new__(cls)
-        Node._instances.append(self)
-        return self
-        
-    def __init__(self, parent, name, attributes=None):
+    """A node in a dotted namespace (think DNS names).
+
+    Children are indexed by name, so looking up a child is a dict access;
+    the position is computed once when the node is created.
+    """
+
+    def __init__(self, parent, name, attributes=None, sep='.'):
         self.parent = parent
         self.attributes = attributes or {}
         self.data = name
         self.state = "closed"
         self.children = []
-    
+        self._index = {}
+        self.sep = sep
+        if parent is None:
+            self.position = name
+        else:
+            self.position = parent.position + sep + name
+
     def __repr__(self):
         return "Node instance %s at %s" % (self.data, self.position)
-        
+
     def name(self):
         return self.data
-        
-    def _position(self):
-        if self.parent == None:
-            return self.data
-        return self.parent.position+'.'+self.data
-    position = property(_position, None, None)
-    
+
     def appendNode(self, name, attributes=None):
         if not isinstance(name, basestring):
             raise ValueError("'name' should be a string, not %s" % type(name))
         attributes = attributes or {}
-        n = Node(self, name, attributes=attributes)
+        n = Node(self, name, attributes=attributes, sep=self.sep)
         self.children.append(n)
+        self._index[name] = n
         return n
-    
-    @classmethod
-    def findNode(cls, position):
-        for node in cls._instances:
-            if node.position == position:
-                return node
+
+    def getChild(self, name):
+        return self._index.get(name)
+
+
+class Tree(object):
+    """Metric namespace trie.
+
+    Paths are dotted strings relative to the root node, i.e. "mem.util.free"
+    in a tree rooted at "pcp". Insertion and lookup cost O(depth); every
+    node is also registered in a per-tree path index so `findNode` is a
+    single dict access. There is no state shared between trees.
+    """
+
+    def __init__(self, name, sep='.'):
+        self.sep = sep
+        self.root = Node(None, name, sep=sep)
+        self._paths = {'': self.root}
+
+    def __len__(self):
+        """Number of nodes, not counting the root."""
+        return len(self._paths) - 1
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def insert(self, path, attributes=None):
+        """Add `path` (creating missing intermediate nodes) and return the
+        node at its end."""
+        node = self._paths.get(path)
+        if node is not None:
+            return node
+        node = self.root
+        prefix = ''
+        for part in path.split(self.sep):
+            if prefix:
+                prefix = prefix + self.sep + part
+            else:
+                prefix = part
+            child = node.getChild(part)
+            if child is None:
+                child = node.appendNode(part)
+                self._paths[prefix] = child
+            node = child
+        if attributes:
+            node.attributes.update(attributes)
+        return node
+
+    def findNode(self, path):
+        """Return the node at `path` or None."""
+        return self._paths.get(path)
+
+    def _subtree(self, prefix):
+        if not prefix or prefix == self.sep:
+            return self.root
+        return self._paths.get(prefix)
+
+    def walk(self, prefix=None):
+        """Yield all nodes below `prefix` (default: the root) depth first,
+        in insertion order."""
+        start = self._subtree(prefix)
+        if start is None:
+            return
+        stack = list(reversed(start.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def positions(self, prefix=None):
+        """Return the positions of all nodes below `prefix`."""
+        return [node.position for node in self.walk(prefix)]
+
+    def leaves(self, prefix=None):
+        """Return the positions of all leaf nodes below `prefix`."""
+        return [node.position for node in self.walk(prefix)
+                if not node.children]
+
+    def serialize(self, prefix=None):
+        """Return the subtree at `prefix` as nested dicts,
+        {name: {child: {...}, leaf: None}}, or None for unknown prefixes.
+        """
+        start = self._subtree(prefix)
+        if start is None:
+            return None
+        out = {}
+        stack = [(start, out)]
+        while stack:
+            node, parent = stack.pop()
+            if node.children:
+                d = parent[node.data] = {}
+                stack.extend([(child, d) for child in node.children])
+            else:
+                parent[node.data] = None
+        return out
+
 
 if __name__ == '__main__':
     import unittest
@@ -47,22 +137,52 @@ if __name__ == '__main__':
     class TestNodes(unittest.TestCase):
 
         def setUp(self):
-            self.n1 = Node(None, data='com')
-            self.n2 = Node(self.n1, data='example')
-            self.n3 = Node(self.n1, data='foobar')
-            
+            self.n1 = Node(None, 'com')
+            self.n2 = self.n1.appendNode('example')
+            self.n3 = self.n1.appendNode('foobar')
+
         def test_nodes(self):
             self.assertEqual(self.n1.data, self.n1.position)
             self.assertEqual(self.n2.attributes, {})
+            self.assertEqual(self.n3.position, 'com.foobar')
 
         def test_append(self):
             self.n3.appendNode("example")
             self.n3.appendNode("com", attributes={'one':1})
             self.assertRaises(ValueError, Node.appendNode, self.n1, self.n1)
+            self.assertEqual(self.n3.getChild('com').attributes, {'one':1})
+
+    class TestTree(unittest.TestCase):
+
+        def setUp(self):
+            self.tree = Tree('pcp')
+            for path in ('mem.util.free', 'mem.util.used', 'mem.physmem',
+                         'kernel.all.load'):
+                self.tree.insert(path)
 
         def test_find(self):
-            self.assertEqual(Node.findNode("com.foobar").position,
-                             self.n3.position)
+            self.assertEqual(self.tree.findNode('mem.util').position,
+                             'pcp.mem.util')
+            self.assertEqual(self.tree.findNode('mem.nothere'), None)
+            self.assertEqual(len(self.tree), 8)
+
+        def test_prefix(self):
+            self.assertEqual(self.tree.leaves('mem.util'),
+                             ['pcp.mem.util.free', 'pcp.mem.util.used'])
+            self.assertEqual(self.tree.positions('kernel'),
+                             ['pcp.kernel.all', 'pcp.kernel.all.load'])
+            self.assertEqual(self.tree.leaves('foo'), [])
+
+        def test_serialize(self):
+            self.assertEqual(self.tree.serialize('mem.util'),
+                             {'util': {'free': None, 'used': None}})
+            self.assertEqual(self.tree.serialize('kernel'),
+                             {'kernel': {'all': {'load': None}}})
+            self.assertEqual(self.tree.serialize('foo'), None)
 
+        def test_no_shared_state(self):
+            other = Tree('pcp')
+            other.insert('mem.util.free')
+            self.assertEqual(len(other), 3)
 
     unittest.main()
@@ -7,13 +7,70 @@ import sys, os
 sys.path.insert(0, os.path.abspath('lib'))
 sys.path.insert(0, os.path.abspath('env/modules'))
 
+profiler = None
+if __name__ == '__main__' and '--profile-startup' in sys.argv:
+    # print the import time of each module up to the point where the
+    # server would start, then exit
+    from util.importprof import ImportProfiler
+    profiler = ImportProfiler()
+    profiler.install()
+
 from base import Dispatcher
 from env import Environment
 
+
+def bench_dispatch(env, srv, paths, rounds=2000):
+    """Print the time per request answered by the Dispatcher through
+    cherrypy's WSGI application (no sockets), with memoized extension
+    points and with the memo dropped before each request (cold)."""
+    import time
+    from StringIO import StringIO
+    import cherrypy as cp
+    cp.config.update({'log.screen': False, 'environment': 'embedded'})
+    app = cp.tree.mount(srv, '', srv.app_config())
+
+    def request(path):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'SCRIPT_NAME': '', 'HTTP_HOST': 'localhost:1111',
+                   'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+                   'SERVER_PORT': '1111', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1',
+                   'REMOTE_ADDR': '127.0.0.1', 'REMOTE_PORT': '4711',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(''),
+                   'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+                   'wsgi.multiprocess': False, 'wsgi.run_once': False}
+        status = []
+        body = app(environ, lambda s, h, exc_info=None: status.append(s))
+        ''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        return status[0]
+
+    for path in paths:
+        print "%-24s %s" % (path, request(path))
+        for label, cold in (('memoized', False), ('cold', True)):
+            start = time.time()
+            for i in xrange(rounds):
+                if cold:
+                    env.reset_extensions()
+                request(path)
+            print "    %-10s %8.1f usec/request" % (
+                label, (time.time() - start) / rounds * 1e6)
+
 if __name__ == '__main__':
     path = os.path.abspath('env')
     env = Environment(path)
     srv = env[Dispatcher]
+    if profiler:
+        profiler.uninstall()
+        profiler.report()
+        sys.exit(0)
+    if '--bench-dispatch' in sys.argv:
+        # python main.py --bench-dispatch [path...]
+        bench_dispatch(env, srv, [a for a in sys.argv[1:] if a[:1] == '/']
+                       or ['/system/services/status/nosuch',
+                           '/monitoring/values/nosuch', '/system/'])
+        sys.exit(0)
     print env.components
     print env.log
     print env.config